@@ -60,6 +60,18 @@ update_interval_settings = "{} {} {} {} {}".format( \
 def run_digest_update():
     call_command('update_digests', interactive=False)
     
+# every hour precompute the recommendations shown in the single resource view
+@kronos.register("42 * * * *")
+def run_recommendation_build():
+    call_command('build_recommendations', interactive=False)
+
+
+# every minute push the queued resource updates to the search index
+@kronos.register("* * * * *")
+def run_index_update_processing():
+    call_command('process_lr_index_updates', interactive=False)
+
+
 # update the GeoIP database every first day of the month
 @kronos.register("12 4 1 * *")
 def run_update_geoip_db():
@@ -3,7 +3,6 @@
 import os
 import sys
 import traceback
-from zipfile import ZipFile
 
 # Magic python path, based on http://djangosnippets.org/snippets/281/
 from os.path import abspath, dirname, join
@@ -74,25 +73,33 @@ if __name__ == "__main__":
     ERRONEOUS_EXPORTS = 0
     RESOURCE_NO = 0
     from metashare.repository.models import resourceInfoType_model
-    from metashare.xml_utils import to_xml_string
-    with ZipFile(sys.argv[1], 'w') as out:
-        for resource in resourceInfoType_model.objects.all():
-            # skip rsources marked as deleted
-            if resource.storage_object.deleted == True:
-                continue
+    from metashare.utils import stream_zip
+    from metashare.xml_utils import get_resource_xml
+
+    def _entries():
+        """
+        Yields the archive entries of all resources one after the other.
+        """
+        global SUCCESSFUL_EXPORTS, ERRONEOUS_EXPORTS, RESOURCE_NO
+        # skip resources marked as deleted
+        for resource in resourceInfoType_model.objects \
+                .filter(storage_object__deleted=False) \
+                .select_related('storage_object').iterator():
             try:
                 RESOURCE_NO += 1
-                root_node = resource.export_to_elementtree()
-                xml_string = to_xml_string(
-                  root_node, encoding="utf-8").encode('utf-8')
-                resource_filename = 'resource-{0}.xml'.format(RESOURCE_NO)
-                out.writestr(resource_filename, xml_string)
+                xml_string = get_resource_xml(resource)
                 SUCCESSFUL_EXPORTS += 1
             
             except Exception:
                 ERRONEOUS_EXPORTS += 1
                 print 'Could not export resource id={0}!'.format(resource.id)
                 print traceback.format_exc()
+                continue
+            yield 'resource-{0}.xml'.format(RESOURCE_NO), xml_string
+
+    with open(sys.argv[1], 'wb') as out:
+        for chunk in stream_zip(_entries()):
+            out.write(chunk)
     
     print "Done. Successfully exported {0} files from the database, errors " \
       "occured in {1} cases.".format(SUCCESSFUL_EXPORTS, ERRONEOUS_EXPORTS)
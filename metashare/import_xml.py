@@ -24,9 +24,10 @@ except ImportError:
 
 
 def print_usage():
-    print "\n\tusage: {0} [--id-file=idfile] <file.xml|archive.zip> [<file.xml|archive." \
-      "zip> ...]\n".format(sys.argv[0])
+    print "\n\tusage: {0} [--id-file=idfile] [--bulk] <file.xml|archive.zip> " \
+      "[<file.xml|archive.zip> ...]\n".format(sys.argv[0])
     print "  --id-file=idfile : print identifier of imported resources in idfile"
+    print "  --bulk : import large archives in batched transactions"
     return
 
 if __name__ == "__main__":
@@ -39,20 +40,28 @@ if __name__ == "__main__":
         print_usage()
         sys.exit(-1)
     
-    # Check command line options for --id-file
+    # Check command line options for --id-file and --bulk
     id_filename = None
+    bulk_import = False
     arg_num=1
-    if sys.argv[arg_num].startswith("--id-file="):
-        opt_len = len("--id-file=")
-        id_filename = sys.argv[arg_num][opt_len:]
-        arg_num = arg_num + 1
-        if len(id_filename) == 0:
+    while arg_num < len(sys.argv) and sys.argv[arg_num].startswith("--"):
+        if sys.argv[arg_num].startswith("--id-file="):
+            opt_len = len("--id-file=")
+            id_filename = sys.argv[arg_num][opt_len:]
+            if len(id_filename) == 0:
+                print "Incorrect option"
+                print_usage()
+                sys.exit(-1)
+        elif sys.argv[arg_num] == "--bulk":
+            bulk_import = True
+        else:
             print "Incorrect option"
             print_usage()
             sys.exit(-1)
-        if len(sys.argv) < 3:
-            print_usage()
-            sys.exit(-1)
+        arg_num = arg_num + 1
+    if len(sys.argv) <= arg_num:
+        print_usage()
+        sys.exit(-1)
         
 
     # Check that SOLR is running, or else all resources will stay at status INTERNAL:
@@ -65,7 +74,7 @@ if __name__ == "__main__":
     
     successful_imports = []
     erroneous_imports = []
-    from metashare.xml_utils import import_from_file
+    from metashare.xml_utils import import_from_file, bulk_import_from_file
     from metashare.storage.models import PUBLISHED, MASTER
     from metashare.repository.supermodel import OBJECT_XML_CACHE
     
@@ -74,7 +83,12 @@ if __name__ == "__main__":
     
     for filename in sys.argv[arg_num:]:
         temp_file = open(filename, 'rb')
-        success, failure = import_from_file(temp_file, filename, PUBLISHED, MASTER)
+        if bulk_import:
+            success, failure = bulk_import_from_file(temp_file, filename,
+                                                     PUBLISHED, MASTER)
+        else:
+            success, failure = import_from_file(temp_file, filename, PUBLISHED,
+                                                MASTER)
         successful_imports += success
         erroneous_imports += failure
         temp_file.close()
@@ -100,9 +114,10 @@ if __name__ == "__main__":
         id_file.close()
 
     # Be nice and cleanup cache...
-    _cache_size = sum([len(x) for x in OBJECT_XML_CACHE.values()])
+    _cache_stats = OBJECT_XML_CACHE.get_stats()
     OBJECT_XML_CACHE.clear()
-    print "Cleared OBJECT_XML_CACHE ({} bytes)".format(_cache_size)
+    print "Cleared OBJECT_XML_CACHE ({size} bytes, {hits} hits, {misses} " \
+      "misses, {evictions} evictions)".format(**_cache_stats)
     
     from django.core.management import call_command
-    call_command('rebuild_index', interactive=False)
+    call_command('rebuild_lr_index')
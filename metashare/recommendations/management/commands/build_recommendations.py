@@ -0,0 +1,30 @@
+"""
+Management utility to precompute the recommendations of all published
+resources.
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from metashare import settings
+from metashare.recommendations.recommendations import build_recommendations
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('-k', '--top-k', action='store', type='int',
+                    dest='top_k', default=settings.RECOMMENDATION_TOP_K,
+                    help='number of recommendations per resource and kind'),
+    )
+
+    help = 'Precomputes the recommendations of all published resources'
+
+    def handle(self, *args, **options):
+        """
+        Build the recommendations.
+        """
+        count = build_recommendations(
+          top_k=options.get('top_k') or settings.RECOMMENDATION_TOP_K)
+        self.stdout.write('Built the recommendations of {} resources.\n'
+                          .format(count))
@@ -1,4 +1,19 @@
-from django.db import models
+import atexit
+import heapq
+import logging
+import threading
+import time
+
+from django import db
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+
+from metashare import settings
+
+# Setup logging support.
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(settings.LOG_HANDLER)
 
 
 # the following code is based on http://djangosnippets.org/snippets/2451/
@@ -21,56 +36,24 @@ class TogetherManager(models.Model):
         """
         tells the manager that the given resources have appeared together
         """
-        # pylint: disable-msg=E1101
-        res_count_dict_1 = self.resourcecountdict_set.get_or_create(
-          lrid=res_1.storage_object.identifier)[0]
-        res_count_dict_1.addResource(res_2)
-        # pylint: disable-msg=E1101
-        res_count_dict_2 = self.resourcecountdict_set.get_or_create(
-          lrid=res_2.storage_object.identifier)[0]
-        res_count_dict_2.addResource(res_1)
+        get_together_counts(self.name).add_pair(
+          res_1.storage_object.identifier, res_2.storage_object.identifier)
         
     def getTogetherCount(self, res_1, res_2):
         """
         returns how often the given resources have appeared together
         """
-        try:
-            # pylint: disable-msg=E1101
-            res_count_dict = self.resourcecountdict_set.get(
-              lrid=res_1.storage_object.identifier)
-        except ResourceCountDict.DoesNotExist:
-            return 0
-        try:
-            res_count_pair = res_count_dict.resourcecountpair_set.get(
-              lrid=res_2.storage_object.identifier)
-        except ResourceCountPair.DoesNotExist:
-            return 0
-        return res_count_pair.count
+        return get_together_counts(self.name).get_count(
+          res_1.storage_object.identifier, res_2.storage_object.identifier)
     
-    def getTogetherList(self, res, threshold):
+    def getTogetherList(self, res, threshold, limit=None):
         """
         returns a sorted list of resources that have appeared together with the
         given resource; appearance count must have at least the given threshold;
-        filters deleted and non-published resources
-        """
-        from metashare.repository.models import resourceInfoType_model
-        from metashare.storage.models import PUBLISHED   
-        # get pairs with count above threshold
-        pairs = ResourceCountPair.objects\
-          .filter(container__container__name=self.name)\
-          .filter(container__lrid=res.storage_object.identifier)\
-          .filter(count__gte=threshold).order_by('-count')
-        # collect resources; skip unpublished and deleted resource
-        together_list = []
-        for pair in pairs:
-            resource = resourceInfoType_model.objects.get(
-              storage_object__identifier=pair.lrid)
-            if resource.storage_object.publication_status != PUBLISHED\
-              or resource.storage_object.deleted:
-                continue
-            together_list.append(resource)    
-
-        return together_list
+        filters deleted and non-published resources; returns at most `limit`
+        resources if a limit is given
+        """
+        return get_together_resources(self.name, res, threshold, limit)
               
     def __unicode__(self):
         """
@@ -146,3 +129,404 @@ class ResourceCountPair(models.Model):
         returns the Unicode representation for this pair
         """
         return u'{0}: {1}'.format(self.lrid, self.count)
+
+
+class ResourceRecommendations(models.Model):
+    """
+    precomputed top-K recommendations of the resource with the given id; the
+    recommended resources are stored as space separated lists of storage
+    object identifiers, best first; built by the build_recommendations command
+    """
+    lrid = models.CharField(editable=False, unique=True, blank=False, max_length=64)
+    also_viewed = models.TextField(blank=True)
+    also_downloaded = models.TextField(blank=True)
+    same_creators = models.TextField(blank=True)
+    same_projects = models.TextField(blank=True)
+
+    def getLrids(self, name):
+        """
+        returns the list of storage object identifiers of the recommendations
+        with the given field name
+        """
+        return getattr(self, name).split()
+
+
+class TogetherCounts(object):
+    """
+    in-memory sparse matrix of how often resources have appeared together in
+    the TogetherManager with the given name; storage object identifiers are
+    mapped to compact integer ids; counter increments are collected and written
+    to the database in batches; the counts are reloaded from the database in
+    a background thread every RECOMMENDATION_REFRESH_INTERVAL seconds to
+    include the increments of other processes
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.RLock()
+        # serializes the writers of the database so that the same new rows are
+        # not created twice; also held while reloading the counts
+        self._flush_lock = threading.Lock()
+        # mapping of storage object identifiers to integer ids and back
+        self._ids = {}
+        self._lrids = []
+        # mapping of integer ids to dictionaries of integer ids and counts;
+        # None until the counts have been loaded
+        self._rows = None
+        self._loaded = 0
+        self._reloading = False
+        # counter increments which have not been written to the database yet;
+        # maps pairs of (smaller id, larger id) to increments
+        self._pending = {}
+        self._pending_since = None
+
+    def add_pair(self, lrid_1, lrid_2):
+        """
+        increases the count of the resources with the given storage object
+        identifiers by 1
+        """
+        self._ensure_loaded()
+        with self._lock:
+            id_1 = self._get_id(lrid_1)
+            id_2 = self._get_id(lrid_2)
+            _add_count(self._rows, id_1, id_2, 1)
+            key = (min(id_1, id_2), max(id_1, id_2))
+            self._pending[key] = self._pending.get(key, 0) + 1
+            now = time.time()
+            if self._pending_since is None:
+                self._pending_since = now
+            flush = len(self._pending) >= settings.RECOMMENDATION_BUFFER_SIZE \
+              or now - self._pending_since \
+                >= settings.RECOMMENDATION_FLUSH_INTERVAL
+        if flush:
+            # a running flush or reload also writes the new increments
+            self.flush(blocking=False)
+
+    def get_count(self, lrid_1, lrid_2):
+        """
+        returns how often the resources with the given storage object
+        identifiers have appeared together
+        """
+        self._ensure_loaded()
+        with self._lock:
+            id_1 = self._ids.get(lrid_1)
+            id_2 = self._ids.get(lrid_2)
+            if id_1 is None or id_2 is None:
+                return 0
+            return self._rows.get(id_1, {}).get(id_2, 0)
+
+    def get_top(self, lrid, threshold, limit=None):
+        """
+        returns a list of (storage object identifier, count) tuples of the
+        resources which have appeared together with the resource with the
+        given storage object identifier at least `threshold` times, sorted by
+        descending count; returns at most `limit` tuples if a limit is given
+        """
+        self._ensure_loaded()
+        with self._lock:
+            _id = self._ids.get(lrid)
+            if _id is None:
+                return []
+            items = [(count, other_id) for other_id, count
+                     in self._rows.get(_id, {}).iteritems()
+                     if count >= threshold]
+        if limit is None:
+            items.sort(reverse=True)
+        else:
+            items = heapq.nlargest(limit, items)
+        return [(self._lrids[other_id], count) for count, other_id in items]
+
+    def forget(self, lrid):
+        """
+        removes all counts of the resource with the given storage object
+        identifier from memory, including pending increments
+        """
+        with self._lock:
+            _id = self._ids.get(lrid)
+            if _id is None:
+                return
+            if self._rows is not None:
+                for other_id in self._rows.pop(_id, {}):
+                    self._rows.get(other_id, {}).pop(_id, None)
+            for key in [key for key in self._pending if _id in key]:
+                del self._pending[key]
+
+    def flush(self, blocking=True):
+        """
+        writes the pending counter increments to the database; returns the
+        number of written resource pairs; if `blocking` is False, nothing is
+        written while another thread is writing to the database already
+        """
+        if not self._flush_lock.acquire(blocking):
+            return 0
+        try:
+            return self._flush()
+        finally:
+            self._flush_lock.release()
+
+    def _flush(self):
+        """
+        writes the pending counter increments to the database; must be called
+        while holding the flush lock
+        """
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending = self._pending
+            increments = [(self._lrids[id_1], self._lrids[id_2], inc)
+                          for (id_1, id_2), inc in pending.iteritems()]
+            self._pending = {}
+            self._pending_since = None
+        try:
+            with transaction.commit_on_success():
+                _write_increments(self.name, increments)
+        except db.DatabaseError:
+            LOGGER.error('Failed to write {0} recommendation counts; they '
+                         'will be retried with the next flush.'
+                         .format(len(increments)), exc_info=True)
+            with self._lock:
+                for (id_1, id_2), inc in pending.iteritems():
+                    # skip the counts of resources which have been forgotten
+                    # in the meantime
+                    if self._rows is not None and (id_1 not in self._rows
+                                                   or id_2 not in self._rows):
+                        continue
+                    key = (id_1, id_2)
+                    self._pending[key] = self._pending.get(key, 0) + inc
+                if self._pending and self._pending_since is None:
+                    self._pending_since = time.time()
+            return 0
+        return len(increments)
+
+    def reload(self):
+        """
+        writes the pending counter increments to the database and reloads the
+        counts from there; concurrent reloads are skipped
+        """
+        with self._lock:
+            if self._reloading:
+                return
+            self._reloading = True
+        try:
+            self._reload()
+        finally:
+            with self._lock:
+                self._reloading = False
+
+    def _reload(self):
+        """
+        writes the pending counter increments to the database and reloads the
+        counts from there; must only be called by the thread which has set the
+        reloading flag
+        """
+        # no increments must be written between the flush and the reading of
+        # the counts as they would neither be pending nor read anymore
+        with self._flush_lock:
+            self._load()
+
+    def _load(self):
+        """
+        writes the pending counter increments to the database and loads the
+        counts from there; must be called while holding the flush lock, but
+        not the lock of the counts which is always acquired second
+        """
+        self._flush()
+        pairs = list(ResourceCountPair.objects
+          .filter(container__container__name=self.name)
+          .values_list('container__lrid', 'lrid', 'count'))
+        with self._lock:
+            rows = {}
+            for lrid_1, lrid_2, count in pairs:
+                rows.setdefault(self._get_id(lrid_1), {})[
+                  self._get_id(lrid_2)] = count
+            # keep the increments which have been added in the meantime
+            for (id_1, id_2), inc in self._pending.iteritems():
+                _add_count(rows, id_1, id_2, inc)
+            self._rows = rows
+            self._loaded = time.time()
+
+    def _reload_in_background(self):
+        """
+        reloads the counts in a new thread unless a reload is running already;
+        the current counts are used until the reload has finished
+        """
+        with self._lock:
+            if self._reloading:
+                return
+            self._reloading = True
+        thread = threading.Thread(target=self._background_reload)
+        thread.daemon = True
+        thread.start()
+
+    def _background_reload(self):
+        """
+        the target of the background reload thread
+        """
+        try:
+            self._reload()
+        # pylint: disable-msg=W0703
+        except Exception:
+            LOGGER.error('Failed to reload the recommendation counts.',
+                         exc_info=True)
+        finally:
+            with self._lock:
+                self._reloading = False
+            # the database connection of this thread is not needed anymore
+            db.close_connection()
+
+    def _ensure_loaded(self):
+        """
+        loads the counts on first use and reloads them in the background when
+        they are outdated
+        """
+        if self._rows is None:
+            with self._flush_lock:
+                if self._rows is None:
+                    self._load()
+        elif time.time() - self._loaded \
+                > settings.RECOMMENDATION_REFRESH_INTERVAL:
+            self._reload_in_background()
+
+    def _get_id(self, lrid):
+        """
+        returns the integer id of the given storage object identifier; must be
+        called while holding the lock
+        """
+        _id = self._ids.get(lrid)
+        if _id is None:
+            _id = len(self._lrids)
+            self._ids[lrid] = _id
+            self._lrids.append(lrid)
+        return _id
+
+
+def _add_count(rows, id_1, id_2, inc):
+    """
+    increases the count of the given pair of integer ids in both directions
+    """
+    row_1 = rows.setdefault(id_1, {})
+    row_1[id_2] = row_1.get(id_2, 0) + inc
+    row_2 = rows.setdefault(id_2, {})
+    row_2[id_1] = row_2.get(id_1, 0) + inc
+
+
+def _write_increments(name, increments):
+    """
+    adds the given (storage object identifier, storage object identifier,
+    increment) tuples to the counts of the TogetherManager with the given name
+    in the database
+    """
+    man = TogetherManager.objects.get_or_create(name=name)[0]
+    lrids = set()
+    for lrid_1, lrid_2, _inc in increments:
+        lrids.update((lrid_1, lrid_2))
+    # get or create the count dictionaries of all resources at once
+    dict_ids = dict(ResourceCountDict.objects.filter(container=man,
+      lrid__in=lrids).values_list('lrid', 'id'))
+    missing = lrids.difference(dict_ids)
+    if missing:
+        ResourceCountDict.objects.bulk_create([
+          ResourceCountDict(container=man, lrid=lrid) for lrid in missing])
+        dict_ids.update(ResourceCountDict.objects.filter(container=man,
+          lrid__in=missing).values_list('lrid', 'id'))
+    pair_increments = {}
+    for lrid_1, lrid_2, inc in increments:
+        pair_increments[(dict_ids[lrid_1], lrid_2)] = inc
+        pair_increments[(dict_ids[lrid_2], lrid_1)] = inc
+    existing = set(ResourceCountPair.objects.filter(
+      container__in=dict_ids.values(), lrid__in=lrids)
+      .values_list('container', 'lrid'))
+    new_pairs = []
+    for (dict_id, lrid), inc in pair_increments.iteritems():
+        if (dict_id, lrid) in existing:
+            ResourceCountPair.objects.filter(container=dict_id, lrid=lrid) \
+              .update(count=F('count') + inc)
+        else:
+            new_pairs.append(
+              ResourceCountPair(container_id=dict_id, lrid=lrid, count=inc))
+    ResourceCountPair.objects.bulk_create(new_pairs)
+
+
+# the in-memory counts of this process, by TogetherManager name
+_TOGETHER_COUNTS = {}
+_TOGETHER_COUNTS_LOCK = threading.Lock()
+
+
+def get_together_counts(name):
+    """
+    returns the in-memory counts of the TogetherManager with the given name
+    """
+    counts = _TOGETHER_COUNTS.get(name)
+    if counts is None:
+        with _TOGETHER_COUNTS_LOCK:
+            counts = _TOGETHER_COUNTS.setdefault(name, TogetherCounts(name))
+    return counts
+
+
+def get_together_resources(name, res, threshold, limit=None):
+    """
+    returns a sorted list of published and not deleted resources that have
+    appeared together with the given resource at least `threshold` times in
+    the TogetherManager with the given name; returns at most `limit` resources
+    if a limit is given; the resources are fetched with a single query unless
+    too many of the best candidates are unpublished or deleted
+    """
+    from metashare.repository.models import resourceInfoType_model
+    from metashare.storage.models import PUBLISHED
+    counts = get_together_counts(name)
+    size = limit
+    while True:
+        lrids = [lrid for lrid, _count in counts.get_top(
+          res.storage_object.identifier, threshold, size)]
+        resources = dict((resource.storage_object.identifier, resource)
+          for resource in resourceInfoType_model.objects\
+            .select_related('storage_object', 'identificationInfo')\
+            .filter(storage_object__identifier__in=lrids,
+                    storage_object__publication_status=PUBLISHED,
+                    storage_object__deleted=False))
+        together_list = [resources[lrid] for lrid in lrids
+                         if lrid in resources]
+        if limit is None or len(together_list) >= limit \
+                or len(lrids) < size:
+            return together_list[:limit]
+        # some of the candidates were skipped; try more of them
+        size *= 2
+
+
+def flush_together_counts():
+    """
+    writes the pending counter increments of all in-memory counts to the
+    database
+    """
+    for counts in _TOGETHER_COUNTS.values():
+        counts.flush()
+
+# make sure that no increments are lost when the process terminates regularly
+atexit.register(flush_together_counts)
+
+
+def forget_together_counts(lrid):
+    """
+    removes the resource with the given storage object identifier from all
+    in-memory counts
+    """
+    for counts in _TOGETHER_COUNTS.values():
+        counts.forget(lrid)
+
+
+def reset_together_counts():
+    """
+    drops all in-memory counts, including pending increments
+    """
+    with _TOGETHER_COUNTS_LOCK:
+        _TOGETHER_COUNTS.clear()
+
+
+def _drop_together_counts(sender, instance, **kwargs):
+    """
+    drops the in-memory counts of the deleted TogetherManager
+    """
+    with _TOGETHER_COUNTS_LOCK:
+        _TOGETHER_COUNTS.pop(instance.name, None)
+
+post_delete.connect(_drop_together_counts, sender=TogetherManager)
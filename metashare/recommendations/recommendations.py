@@ -1,12 +1,14 @@
+from django.db import transaction
 from metashare import settings
-from metashare.recommendations.models import TogetherManager, ResourceCountDict, \
-    ResourceCountPair
+from metashare.recommendations.models import ResourceCountDict, \
+    ResourceCountPair, ResourceRecommendations, get_together_counts, \
+    get_together_resources
 from metashare.repository.models import resourceInfoType_model
 from metashare.settings import LOG_HANDLER
-from metashare.storage.models import StorageObject
+from metashare.storage.models import StorageObject, PUBLISHED
+from collections import Counter
 import datetime
 import logging
-import threading
 
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
@@ -22,31 +24,38 @@ class Resource:
 class SessionResourcesTracker:
     """
     Keeps track of resources the user has viewed/downloaded within a session.
+    
+    Only the storage object identifiers of the resources and the times of the
+    last view and download are kept; `save()` stores them in the session as a
+    compact tuple.
     """
-    # a lock used for the thread-safe updating of TogetherManager with new pairs 
-    lock = threading.RLock()
 
     @staticmethod
     def getTracker(request):
         """
         get tracker for the given request; creates new tracker if required
         """
-        tracker = request.session.get('tracker')
-        if not tracker:
-            tracker = SessionResourcesTracker()
-            request.session['tracker'] = tracker
+        tracker = SessionResourcesTracker()
+        data = request.session.get('tracker')
+        # sessions of older versions may still contain pickled tracker objects;
+        # these are replaced by a new tracker
+        if isinstance(data, tuple) and len(data) == 4:
+            tracker.views = set(data[0])
+            tracker.last_view = data[1]
+            tracker.downloads = set(data[2])
+            tracker.last_download = data[3]
         return tracker
     
     def __init__(self):
         
-        # set of resources that have been downloaded together; 
+        # set of identifiers of resources that have been downloaded together; 
         # time intervals between downloads are not longer than MAX_DOWNLOAD_INTERVAL     
         self.downloads = set()
         
         # time of last download
         self.last_download = None
         
-        # set of resources that have been viewed together; 
+        # set of identifiers of resources that have been viewed together; 
         # time intervals between downloads are not longer than MAX_VIEW_INTERVAL
         self.views = set()
         
@@ -54,6 +63,14 @@ class SessionResourcesTracker:
         self.last_view = None
 
 
+    def save(self, request):
+        """
+        Stores this tracker in the session of the given request.
+        """
+        request.session['tracker'] = (tuple(self.views), self.last_view,
+          tuple(self.downloads), self.last_download)
+
+
     def add_view(self, resource, time):
         """
         Tells the tracker that the given resource has been viewed 
@@ -67,7 +84,7 @@ class SessionResourcesTracker:
         if time > _expiration_date:
             # init new 'together' set
             self.views = set()
-            self.views.add(resource)
+            self.views.add(resource.storage_object.identifier)
         else:
             # update TogetherManager
             self._add_resource_to_set(self.views, resource, Resource.VIEW)
@@ -88,7 +105,7 @@ class SessionResourcesTracker:
         if time > _expiration_date:
             # init new 'together' set
             self.downloads = set()
-            self.downloads.add(resource)
+            self.downloads.add(resource.storage_object.identifier)
         else:
             # update TogetherManager
             self._add_resource_to_set(self.downloads, resource, Resource.DOWNLOAD)
@@ -97,18 +114,24 @@ class SessionResourcesTracker:
         
     def _add_resource_to_set(self, res_set, res, res_type):  
         """
-        Adds the given resource to the given resource set; 
-        resource is of the given resource type, 
+        Adds the identifier of the given resource to the given set of resource
+        identifiers; resource is of the given resource type, 
         either Resource.VIEW or Resource.DOWNLOAD.
         """  
-        if not res in res_set:
-            # update TogetherManager with new pairs but make sure that only one
-            # thread updates the TogetherManager at a time 
-            with SessionResourcesTracker.lock:
-                man = TogetherManager.getManager(res_type)
-                for _res in res_set:
-                    man.addResourcePair(_res, res)
-                res_set.add(res)
+        lrid = res.storage_object.identifier
+        if not lrid in res_set:
+            if res_set:
+                # the tracked resources may have been deleted in the meantime;
+                # no counts must be recreated for them
+                res_set.intersection_update(StorageObject.objects.filter(
+                    identifier__in=res_set, deleted=False) \
+                        .values_list('identifier', flat=True))
+            # update the 'together' counts with the new pairs; the counts are
+            # thread-safe
+            counts = get_together_counts(res_type)
+            for _lrid in res_set:
+                counts.add_pair(_lrid, lrid)
+            res_set.add(lrid)
             
             
     def _get_expiration_date(self, seconds, time):
@@ -123,22 +146,24 @@ class SessionResourcesTracker:
         return _expiration_date
     
 
-def get_view_recommendations(resource):
+def get_view_recommendations(resource, limit=None):
     """
     Returns a list of ranked view recommendations for the given resource.
+    
+    At most `limit` recommendations are returned if a limit is given.
     """
-    # TODO: decide what threshold to use; may restrict recommendation to top X resources of the list
-    return TogetherManager.getManager(Resource.VIEW)\
-      .getTogetherList(resource, 0)
+    # TODO: decide what threshold to use
+    return get_together_resources(Resource.VIEW, resource, 0, limit)
     
 
-def get_download_recommendations(resource):
+def get_download_recommendations(resource, limit=None):
     """
     Returns a list of ranked download recommendations for the given resource.
+    
+    At most `limit` recommendations are returned if a limit is given.
     """
-    # TODO: decide what threshold to use; may restrict recommendation to top X resources of the list 
-    return TogetherManager.getManager(Resource.DOWNLOAD)\
-      .getTogetherList(resource, 0)
+    # TODO: decide what threshold to use
+    return get_together_resources(Resource.DOWNLOAD, resource, 0, limit)
 
 
 def get_more_from_same_creators(resource):
@@ -195,21 +220,120 @@ def get_more_from_same_projects_qs(resource):
     return resourceInfoType_model.objects.none()
     
 
+def get_precomputed_recommendations(resource, limit=None):
+    """
+    Returns a tuple of the precomputed 'also viewed' and 'also downloaded'
+    resource lists of the given resource and whether there are resources from
+    the same projects and from the same creators.
+    
+    At most `limit` resources per list are returned if a limit is given. The
+    resources are fetched with a single query; resources which are no longer
+    published are skipped. Returns None if there are no precomputed
+    recommendations for the given resource yet.
+    """
+    try:
+        recommendations = ResourceRecommendations.objects.get(
+            lrid=resource.storage_object.identifier)
+    except ResourceRecommendations.DoesNotExist:
+        return None
+    viewed = recommendations.getLrids('also_viewed')
+    downloaded = recommendations.getLrids('also_downloaded')
+    resources = {}
+    if viewed or downloaded:
+        resources = dict((res.storage_object.identifier, res)
+          for res in resourceInfoType_model.objects \
+            .select_related('storage_object', 'identificationInfo') \
+            .filter(storage_object__identifier__in=set(viewed + downloaded),
+                    storage_object__publication_status=PUBLISHED,
+                    storage_object__deleted=False))
+    return ([resources[lrid] for lrid in viewed if lrid in resources][:limit],
+            [resources[lrid] for lrid in downloaded if lrid in resources][:limit],
+            bool(recommendations.same_projects),
+            bool(recommendations.same_creators))
+
+
+def build_recommendations(top_k=None):
+    """
+    Precomputes the top `top_k` 'also viewed', 'also downloaded', 'same
+    creators' and 'same projects' recommendations of all published resources
+    and replaces the stored `ResourceRecommendations` with them.
+    
+    Returns the number of resources with precomputed recommendations.
+    """
+    if top_k is None:
+        top_k = settings.RECOMMENDATION_TOP_K
+    resources = resourceInfoType_model.objects.filter(
+        storage_object__publication_status=PUBLISHED,
+        storage_object__deleted=False)
+    lrids = set(resources.values_list('storage_object__identifier', flat=True))
+    view_counts = get_together_counts(Resource.VIEW)
+    view_counts.reload()
+    download_counts = get_together_counts(Resource.DOWNLOAD)
+    download_counts.reload()
+    same_creators = _get_shared_value_rankings(resources,
+        'resourceCreationInfo__resourceCreator', top_k)
+    same_projects = _get_shared_value_rankings(resources,
+        'resourceCreationInfo__fundingProject', top_k)
+    recommendations = []
+    for lrid in lrids:
+        recommendations.append(ResourceRecommendations(lrid=lrid,
+            also_viewed=' '.join(_get_top_together(view_counts, lrid, lrids,
+                                                   top_k)),
+            also_downloaded=' '.join(_get_top_together(download_counts, lrid,
+                                                       lrids, top_k)),
+            same_creators=' '.join(same_creators.get(lrid, ())),
+            same_projects=' '.join(same_projects.get(lrid, ()))))
+    with transaction.commit_on_success():
+        ResourceRecommendations.objects.all().delete()
+        # insert in chunks to stay below the query parameter limit of SQLite
+        for i in xrange(0, len(recommendations), 100):
+            ResourceRecommendations.objects.bulk_create(
+                recommendations[i:i + 100])
+    return len(recommendations)
+
+
+def _get_top_together(counts, lrid, lrids, top_k):
+    """
+    Returns the identifiers of the at most `top_k` resources from the given
+    identifiers which have appeared together with the resource with the given
+    identifier most often according to the given `TogetherCounts`.
+    """
+    return [other for other, _count in counts.get_top(lrid, 0)
+            if other in lrids][:top_k]
+
+
+def _get_shared_value_rankings(resources, field, top_k):
+    """
+    Returns a dictionary which maps the storage object identifiers of the given
+    resources to the identifiers of the at most `top_k` other resources that
+    share most values of the given many-to-many field with them.
+    """
+    lrids_by_value = {}
+    values_by_lrid = {}
+    for lrid, value in resources.values_list('storage_object__identifier',
+                                             field):
+        if value is not None:
+            lrids_by_value.setdefault(value, set()).add(lrid)
+            values_by_lrid.setdefault(lrid, set()).add(value)
+    rankings = {}
+    for lrid, values in values_by_lrid.iteritems():
+        shared = Counter()
+        for value in values:
+            shared.update(lrids_by_value[value])
+        del shared[lrid]
+        rankings[lrid] = [other for other, _count in shared.most_common(top_k)]
+    return rankings
+
+
 def repair_recommendations():
     """
     Checks if the recommendations contain links to documents no longer
     available. Removes those links when found.
+    
+    The session trackers only contain resource identifiers, so sessions do not
+    need to be repaired; recommendations of unavailable resources are never
+    returned.
     """
-    from django.contrib.sessions.models import Session
-    from django.contrib.sessions.backends.db import SessionStore
-    for session in Session.objects.all():
-        session_dict = session.get_decoded()
-        if 'tracker' in session_dict:
-            LOGGER.info("removing tracker for session '{}'"
-                .format(session.session_key))
-            del session_dict['tracker']
-            session.session_data = SessionStore().encode(session_dict)
-            session.save()
     for _dict in ResourceCountDict.objects.all():
         try:
             StorageObject.objects.get(identifier=_dict.lrid)
@@ -6,17 +6,20 @@ from django.core.urlresolvers import reverse
 from django.test.client import Client
 from metashare import test_utils, settings
 from metashare.recommendations.models import TogetherManager, ResourceCountPair, \
-    ResourceCountDict
+    ResourceCountDict, ResourceRecommendations, flush_together_counts, \
+    get_together_counts
 from metashare.recommendations.recommendations import Resource, \
     SessionResourcesTracker, get_more_from_same_creators,\
-    get_more_from_same_projects
+    get_more_from_same_projects, build_recommendations, \
+    get_precomputed_recommendations
 from metashare.repository import views
 from metashare.settings import ROOT_PATH, LOG_HANDLER
 from metashare.storage.models import PUBLISHED, INGESTED, StorageObject
 from metashare.test_utils import create_user
 from metashare.stats.models import LRStats, UsageStats
 from metashare.sync.sync_utils import remove_resource
-from metashare.stats.model_utils import saveLRStats, UPDATE_STAT
+from metashare.stats.model_utils import saveLRStats, flush_lr_stats, \
+    UPDATE_STAT
 from django.db.utils import IntegrityError
 from django.core.management import call_command
 from metashare.repository.models import resourceInfoType_model
@@ -118,6 +121,22 @@ class SimpleTogetherManagerTest(django.test.TestCase):
         self.assertEquals(2, man.getTogetherCount(self.res_1, self.res_2))
         self.assertEquals(2, man.getTogetherCount(self.res_2, self.res_1))
         
+    def test_serialized_flush(self):
+        """
+        tests that a non-blocking flush leaves the increments pending while
+        another thread is writing the counts
+        """
+        man = TogetherManager.getManager(Resource.VIEW)
+        man.addResourcePair(self.res_1, self.res_2)
+        counts = get_together_counts(Resource.VIEW)
+        # pylint: disable-msg=W0212
+        with counts._flush_lock:
+            self.assertEquals(0, counts.flush(blocking=False))
+        self.assertEquals(0, len(ResourceCountPair.objects.all()))
+        self.assertEquals(1, counts.flush())
+        self.assertEquals(2, len(ResourceCountPair.objects.all()))
+        self.assertEquals(1, man.getTogetherCount(self.res_1, self.res_2))
+
     def test_delete_deep(self):
         """
         tests that deep deleting a resource removes it from the counts
@@ -126,6 +145,7 @@ class SimpleTogetherManagerTest(django.test.TestCase):
         self.assertEquals(0, man.getTogetherCount(self.res_1, self.res_2))
         man.addResourcePair(self.res_1, self.res_2)
         self.assertEquals(1, man.getTogetherCount(self.res_1, self.res_2))
+        flush_together_counts()
         self.assertEquals(2, len(ResourceCountPair.objects.all()))
         self.assertEquals(2, len(ResourceCountDict.objects.all()))
         self.res_1.delete_deep()
@@ -142,6 +162,7 @@ class SimpleTogetherManagerTest(django.test.TestCase):
         self.assertEquals(0, man.getTogetherCount(self.res_1, self.res_2))
         man.addResourcePair(self.res_1, self.res_2)
         self.assertEquals(1, man.getTogetherCount(self.res_1, self.res_2))
+        flush_together_counts()
         self.assertEquals(2, len(ResourceCountPair.objects.all()))
         self.assertEquals(2, len(ResourceCountDict.objects.all()))
         self.assertEquals(3, len(resourceInfoType_model.objects.all())) 
@@ -161,6 +182,7 @@ class SimpleTogetherManagerTest(django.test.TestCase):
     def test_unique_together_constraint(self):
         man = TogetherManager.getManager(Resource.VIEW)
         man.addResourcePair(self.res_1, self.res_2)
+        flush_together_counts()
         res_count_dict = man.resourcecountdict_set.get(
           lrid=self.res_1.storage_object.identifier)
         try:
@@ -243,6 +265,62 @@ class TogetherManagerTest(django.test.TestCase):
         self.assertEquals(self.res_2, sorted_res[1])
         self.assertEquals(self.res_4, sorted_res[2])
         
+    def test_limit(self):
+        man = TogetherManager.getManager(Resource.VIEW)
+        sorted_res = man.getTogetherList(self.res_1, 0, 2)
+        self.assertEqual(2, len(sorted_res))
+        self.assertEquals(self.res_3, sorted_res[0])
+        self.assertEquals(self.res_2, sorted_res[1])
+        # only the best resources are fetched, with a single query
+        self.assertEqual(1, test_utils.count_queries(
+            man.getTogetherList, self.res_1, 0, 2))
+        # skipped resources are replaced by the next best ones
+        self.res_3.storage_object.publication_status = INGESTED
+        self.res_3.storage_object.save()
+        sorted_res = man.getTogetherList(self.res_1, 0, 2)
+        self.assertEqual([self.res_2, self.res_4], sorted_res)
+
+    def test_persistence(self):
+        man = TogetherManager.getManager(Resource.DOWNLOAD)
+        flush_together_counts()
+        res_count_dict = man.resourcecountdict_set.get(
+          lrid=self.res_1.storage_object.identifier)
+        self.assertEquals(15, res_count_dict.resourcecountpair_set.get(
+          lrid=self.res_2.storage_object.identifier).count)
+        res_count_dict = man.resourcecountdict_set.get(
+          lrid=self.res_4.storage_object.identifier)
+        self.assertEquals(5, res_count_dict.resourcecountpair_set.get(
+          lrid=self.res_1.storage_object.identifier).count)
+        # further increments are added to the stored counts
+        man.addResourcePair(self.res_4, self.res_1)
+        flush_together_counts()
+        self.assertEquals(6, res_count_dict.resourcecountpair_set.get(
+          lrid=self.res_1.storage_object.identifier).count)
+
+    def test_build_recommendations(self):
+        self.assertEqual(None, get_precomputed_recommendations(self.res_1))
+        call_command('build_recommendations', top_k=2)
+        self.assertEqual(4, len(ResourceRecommendations.objects.all()))
+        recommendations = ResourceRecommendations.objects.get(
+          lrid=self.res_1.storage_object.identifier)
+        self.assertEqual([self.res_3.storage_object.identifier,
+                          self.res_2.storage_object.identifier],
+                         recommendations.getLrids('also_viewed'))
+        also_viewed, also_downloaded, _, _ = \
+          get_precomputed_recommendations(self.res_1)
+        self.assertEqual([self.res_3, self.res_2], also_viewed)
+        self.assertEqual([self.res_2, self.res_3], also_downloaded)
+        # resources which are no longer published are skipped
+        self.res_3.storage_object.publication_status = INGESTED
+        self.res_3.storage_object.save()
+        also_viewed, also_downloaded, _, _ = \
+          get_precomputed_recommendations(self.res_1, 1)
+        self.assertEqual([self.res_2], also_viewed)
+        self.assertEqual([self.res_2], also_downloaded)
+        # the recommendations are replaced when they are built again
+        self.assertEqual(3, build_recommendations(2))
+        self.assertEqual(3, len(ResourceRecommendations.objects.all()))
+
     def test_threshold_filter(self):
         man = TogetherManager.getManager(Resource.VIEW)
         sorted_res = man.getTogetherList(self.res_1, 5)
@@ -392,8 +470,16 @@ class SessionResourcesTrackerTest(django.test.TestCase):
         self.assertEquals(1, len(man.getTogetherList(self.res_2, 0)))
         self.assertEquals(1, man.getTogetherCount(self.res_1, self.res_2))
         # deep delete resource
+        _deleted_lrid = self.res_1.storage_object.identifier
         self.res_1.delete_deep()
         self.assertEquals(0, len(man.getTogetherList(self.res_2, 0)))
+        # viewing another resource in the same session must not count the
+        # deleted resource again
+        tracker.add_view(self.res_3, datetime.datetime(2012, 7, 16, 18, 0, 2))
+        self.assertEquals(1, man.getTogetherCount(self.res_2, self.res_3))
+        flush_together_counts()
+        self.assertFalse(ResourceCountDict.objects.filter(
+            lrid=_deleted_lrid).exists())
         
         # test downloads:
         man = TogetherManager.getManager(Resource.DOWNLOAD)
@@ -464,6 +550,13 @@ class SessionTest(django.test.TestCase):
         view_res = man.getTogetherList(self.res_2, 0)
         self.assertEqual(1, len(view_res))
         self.assertEqual(1, man.getTogetherCount(self.res_1, self.res_2))
+        # the session only holds the identifiers of the viewed resources
+        views, last_view, downloads, last_download = client_1.session['tracker']
+        self.assertEqual(set((self.res_1.storage_object.identifier,
+                              self.res_2.storage_object.identifier)), set(views))
+        self.assertTrue(last_view)
+        self.assertEqual((), downloads)
+        self.assertEqual(None, last_download)
         
         response = client_1.get(self.res_3.get_absolute_url(), follow = True)
         self.assertEquals(200, response.status_code)
@@ -512,6 +605,7 @@ class SessionTest(django.test.TestCase):
         saveLRStats(self.res_2, UPDATE_STAT)
         saveLRStats(self.res_3, UPDATE_STAT)
         saveLRStats(self.res_4, UPDATE_STAT)
+        flush_lr_stats()
         self.assertEquals(9, len(LRStats.objects.all()))
         self.assertEquals(219, len(UsageStats.objects.all()))
         remove_resource(self.res_1.storage_object)
@@ -16,7 +16,8 @@ from metashare.repository.models import personInfoType_model, \
 from metashare.storage.models import MASTER
 import logging
 from metashare.settings import LOG_HANDLER
-from metashare.repository.model_utils import get_root_resources
+from metashare.repository.model_utils import filter_by_lookup_index, \
+    get_root_resource_count
 
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
@@ -41,8 +42,8 @@ class PersonLookup(ModelLookup):
     def get_query(self, request, term):
         #results = super(PersonLookup, self).get_query(request, term)
         # Since MultiTextFields cannot be searched using query sets (they are base64-encoded and pickled),
-        # we must do the searching by hand.
-        # Note: this is inefficient, but in practice fast enough it seems (tested with >1000 resources)
+        # we must do the final matching by hand; the lookup index narrows down
+        # the candidates in the database beforehand.
         lcterm = term.lower()
         def matches(person):
             'Helper function to group the search code for a person'
@@ -55,13 +56,14 @@ class PersonLookup(ModelLookup):
         if term == '*':
             results = persons
         else:
-            results = [p for p in persons if matches(p)]
+            results = [p for p in filter_by_lookup_index(persons, term)
+                       if matches(p)]
         print_query_results(results)
         return results
 
     def format_item(self, item):
         fmt_item = super(PersonLookup, self).format_item(item)
-        count = get_root_resources(item).__len__()
+        count = get_root_resource_count(item)
         lab = fmt_item['label']
         fmt_item['label'] = ungettext(_AUTO_SUGGEST_SG_TPL,
             _AUTO_SUGGEST_PL_TPL, count) % {'label': lab, 'count': count}
@@ -75,8 +77,8 @@ class GenericUnicodeLookup(ModelLookup):
     '''
     def get_query(self, request, term):
         # Since Subclassables and some other classes cannot be searched using query sets,
-        # we must do the searching by hand.
-        # Note: this is inefficient, but in practice fast enough it seems (tested with >1000 resources)
+        # we must do the final matching by hand; the lookup index narrows down
+        # the candidates in the database beforehand.
         lcterm = term.lower()
         def matches(item):
             'Helper function to group the search code for a database item'
@@ -90,14 +92,15 @@ class GenericUnicodeLookup(ModelLookup):
         if term == '*':
             results = items
         else:
-            results = [p for p in items if matches(p)]
+            results = [p for p in filter_by_lookup_index(items, term)
+                       if matches(p)]
         results = self.filter_results(results)
         print_query_results(results)
         return results
     
     def format_item(self, item):
         fmt_item = super(GenericUnicodeLookup, self).format_item(item)
-        count = get_root_resources(item).__len__()
+        count = get_root_resource_count(item)
         lab = fmt_item['label']
         fmt_item['label'] = ungettext(_AUTO_SUGGEST_SG_TPL,
             _AUTO_SUGGEST_PL_TPL, count) % {'label': lab, 'count': count}
@@ -203,7 +206,8 @@ class ProjectLookup(ModelLookup):
         if term == '*':
             results = projects
         else:
-            results = [p for p in projects if matches(p)]
+            results = [p for p in filter_by_lookup_index(projects, term)
+                       if matches(p)]
         print_query_results(results)
         return results
     
@@ -218,7 +222,7 @@ class ProjectLookup(ModelLookup):
 
     def format_item(self, item):
         fmt_item = super(ProjectLookup, self).format_item(item)
-        count = get_root_resources(item).__len__()
+        count = get_root_resource_count(item)
         lab = fmt_item['label']
         fmt_item['label'] = ungettext(_AUTO_SUGGEST_SG_TPL,
             _AUTO_SUGGEST_PL_TPL, count) % {'label': lab, 'count': count}
@@ -229,8 +233,8 @@ class OrganizationLookup(ModelLookup):
     
     def get_query(self, request, term):
         # Since MultiTextFields cannot be searched using query sets (they are base64-encoded and pickled),
-        # we must do the searching by hand.
-        # Note: this is inefficient, but in practice fast enough it seems (tested with >1000 resources)
+        # we must do the final matching by hand; the lookup index narrows down
+        # the candidates in the database beforehand.
         lcterm = term.lower()
         def matches(org):
             'Helper function to group the search code for a person'
@@ -243,7 +247,8 @@ class OrganizationLookup(ModelLookup):
         if term == '*':
             results = orgs
         else:
-            results = [p for p in orgs if matches(p)]
+            results = [p for p in filter_by_lookup_index(orgs, term)
+                       if matches(p)]
         print_query_results(results)
         return results
 
@@ -1,4 +1,5 @@
 import datetime
+import logging
 
 from django import forms
 from django.contrib import admin, messages
@@ -41,6 +42,10 @@ from metashare.storage.models import PUBLISHED, INGESTED, INTERNAL, \
 from metashare.utils import verify_subclass, create_breadcrumb_template_params
 
 
+# Setup logging support.
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(settings.LOG_HANDLER)
+
 csrf_protect_m = method_decorator(csrf_protect)
 
 
@@ -342,34 +347,35 @@ class ResourceModelAdmin(SchemaModelAdmin):
     ingest_action.short_description = _("Ingest selected internal resources")
 
     def export_xml_action(self, request, queryset):
-        from StringIO import StringIO
-        from zipfile import ZipFile
-        from metashare.xml_utils import to_xml_string
+        from metashare.utils import stream_zip
+        from metashare.xml_utils import get_resource_xml
         from django import http
 
         zipfilename = "resources_export.zip"
-        in_memory = StringIO()
-        with ZipFile(in_memory, 'w') as zipfile:
-            for obj in queryset:
-                try:
-                    xml_string = to_xml_string(obj.export_to_elementtree(),
-                                               encoding="utf-8").encode("utf-8")
-                    resource_filename = \
-                        'resource-{0}.xml'.format(obj.storage_object.id)
-                    zipfile.writestr(resource_filename, xml_string)
 
+        def entries():
+            # the archive entries are only created while the response is
+            # streamed to the client so that no export is kept in memory;
+            # as the response has already been started, a resource which
+            # cannot be exported is only logged and left out of the archive
+            for obj in queryset.select_related('storage_object').iterator():
+                try:
+                    xml_string = get_resource_xml(obj)
+                # pylint: disable-msg=W0703
                 except Exception:
-                    raise Http404(_('Could not export resource "%(name)s" '
-                        'with primary key %(key)s.') \
-                            % {'name': force_unicode(obj),
-                               'key': escape(obj.storage_object.id)})
-            zipfile.close()
-
-        response = http.HttpResponse(mimetype='application/zip')
+                    LOGGER.error(u'Could not export resource "{0}" with '
+                        'primary key {1}.'.format(force_unicode(obj),
+                                                  obj.storage_object.id),
+                        exc_info=True)
+                    continue
+                resource_filename = \
+                    'resource-{0}.xml'.format(obj.storage_object.id)
+                yield resource_filename, xml_string
+
+        response = http.HttpResponse(stream_zip(entries()),
+                                     mimetype='application/zip')
         response['Content-Disposition'] = \
             'attachment; filename=%s' % (zipfilename)
-        in_memory.seek(0)
-        response.write(in_memory.read())  
         return response
 
     export_xml_action.short_description = \
@@ -28,7 +28,7 @@ from metashare.repository.editor.inlines import ReverseInlineModelAdmin
 from metashare.repository.editor.related_mixin import RelatedAdminMixin
 from metashare.repository.editor.schemamodel_mixin import SchemaModelLookup
 from metashare.storage.models import MASTER
-from metashare.repository.model_utils import get_root_resources
+from metashare.repository.model_utils import find_root_resources
 from metashare.repository.supermodel import REQUIRED, RECOMMENDED, OPTIONAL
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
@@ -158,7 +158,7 @@ class SchemaModelAdmin(admin.ModelAdmin, RelatedAdminMixin, SchemaModelLookup):
             if request.user.is_superuser:
                 return True
             # find out to which resourceInfoType_model instance the obj belongs
-            root_resources = get_root_resources(obj)
+            root_resources = find_root_resources(obj)
             if len(root_resources) == 0:
                 # some model instances are created before the (future) root
                 # resource is actually saved, e.g., toolServiceInfo; in this
@@ -532,7 +532,7 @@ class SchemaModelAdmin(admin.ModelAdmin, RelatedAdminMixin, SchemaModelLookup):
                 context, context_instance=context_instance)
         # redirection for resources and their parts which are no master copies:
         else:
-            for res in [r for r in get_root_resources(obj)
+            for res in [r for r in find_root_resources(obj)
                         if not r.storage_object.master_copy]:
                 context['redirection_url'] = model_utils.get_lr_master_url(res)
                 context['resource'] = res
@@ -0,0 +1,88 @@
+"""
+Management utility to add the database columns which have been added to
+existing models to the tables of an existing installation and to fill the new
+columns and tables with the data of the existing entries.
+
+`syncdb` only creates missing tables but does not alter existing ones, so this
+command has to be run once after upgrading an existing installation and
+running `syncdb`.
+"""
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F
+
+from metashare.repository.models import actorInfoType_model, \
+    documentationInfoType_model, projectInfoType_model, \
+    targetResourceInfoType_model, LookupIndexEntry, LOOKUP_INDEX_MODELS, \
+    update_lookup_index
+# pylint: disable-msg=W0212
+from metashare.repository.supermodel import _get_content_hash_models
+from metashare.storage.models import StorageObject
+
+
+# the columns which have been added to existing tables as pairs of model class
+# and field name; all of these fields must allow NULL values
+NEW_COLUMNS = (
+    (StorageObject, 'status_modified'),
+    (documentationInfoType_model, 'content_hash'),
+    (targetResourceInfoType_model, 'content_hash'),
+    (actorInfoType_model, 'content_hash'),
+    (projectInfoType_model, 'content_hash'),
+)
+
+
+def _fill_new_columns():
+    """
+    Fills the new columns and tables with sensible initial values for the
+    existing entries.
+    """
+    # the status of existing storage objects has last been changed at the
+    # latest when their metadata has been modified
+    StorageObject.objects.filter(status_modified__isnull=True) \
+        .update(status_modified=F('modified'))
+    # the content hashes would otherwise be computed lazily on the first
+    # duplicate check; they have to be computed for the most specific classes
+    # as these define the XML serialization
+    for _model in _get_content_hash_models()[0]:
+        if any(not _cls._meta.abstract and not _cls._meta.proxy
+               for _cls in _model.__subclasses__()):
+            continue
+        for _instance in _model.objects.filter(content_hash__isnull=True) \
+                .iterator():
+            _instance.update_content_hash()
+    # the auto-completion lookup index is a new table which `syncdb` creates
+    # empty; without its entries no existing entity could be found
+    if not LookupIndexEntry.objects.exists():
+        for _model in LOOKUP_INDEX_MODELS:
+            for _instance in _model.objects.iterator():
+                update_lookup_index(_instance)
+
+
+class Command(BaseCommand):
+
+    help = 'Adds the columns of new model fields to existing database tables'
+
+    def handle(self, *args, **options):
+        """
+        Add and fill the new columns.
+        """
+        _cursor = connection.cursor()
+        _qn = connection.ops.quote_name
+        with transaction.commit_on_success():
+            for _model, _field_name in NEW_COLUMNS:
+                _field = _model._meta.get_field(_field_name)
+                _table = _model._meta.db_table
+                _columns = [_col[0] for _col in connection.introspection \
+                            .get_table_description(_cursor, _table)]
+                if _field.column in _columns:
+                    continue
+                _cursor.execute('ALTER TABLE {0} ADD COLUMN {1} {2} NULL'
+                    .format(_qn(_table), _qn(_field.column),
+                            _field.db_type(connection)))
+                if _field.db_index:
+                    _cursor.execute('CREATE INDEX {0} ON {1} ({2})'.format(
+                        _qn('{0}_{1}'.format(_table, _field.column)),
+                        _qn(_table), _qn(_field.column)))
+                self.stdout.write('Added column {0}.{1}.\n'
+                                  .format(_table, _field.column))
+            _fill_new_columns()
@@ -0,0 +1,39 @@
+"""
+Management utility to push queued resource updates to the search index.
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from metashare import settings
+from metashare.repository.search_indexes import process_lr_index_updates
+from metashare.stats.model_utils import flush_lr_stats
+from metashare.utils import Lock
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('-b', '--batch-size', action='store', type='int',
+                    dest='batch_size', default=settings.INDEX_BATCH_SIZE,
+                    help='number of resources sent to the index at once'),
+    )
+
+    help = 'Updates the search index entries of all resources with queued ' \
+        'index updates'
+
+    def handle(self, *args, **options):
+        """
+        Process the queued index updates.
+        """
+        try:
+            # make sure that overlapping runs don't process the same updates
+            lock = Lock('index_updates')
+            lock.acquire()
+            # make sure that this process' pending view/download events are
+            # part of the updates
+            flush_lr_stats()
+            process_lr_index_updates(
+              batch_size=options.get('batch_size') or settings.INDEX_BATCH_SIZE)
+        finally:
+            lock.release()
@@ -0,0 +1,36 @@
+"""
+Management utility to rebuild the auto-completion lookup index of all reusable
+entities, e.g., after loading fixtures.
+"""
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from metashare import settings
+from metashare.repository.models import LookupIndexEntry, \
+    LOOKUP_INDEX_MODELS, update_lookup_index
+
+# Setup logging support.
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(settings.LOG_HANDLER)
+
+
+class Command(BaseCommand):
+
+    help = 'Rebuilds the auto-completion lookup index of all reusable entities'
+
+    def handle(self, *args, **options):
+        """
+        Rebuild the lookup index.
+        """
+        with transaction.commit_on_success():
+            LookupIndexEntry.objects.all().delete()
+        for model in LOOKUP_INDEX_MODELS:
+            _done = 0
+            for instance in model.objects.iterator():
+                with transaction.commit_on_success():
+                    update_lookup_index(instance)
+                _done += 1
+            self.stdout.write('Indexed {} instances of {}.\n'
+                              .format(_done, model.__name__))
@@ -0,0 +1,56 @@
+"""
+Management utility to (re-)build the search index of language resources in
+parallel.
+"""
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from metashare import settings
+from metashare.repository.search_indexes import rebuild_lr_index
+
+
+# accepted formats of the `--since` option
+_SINCE_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--processes', action='store', type='int',
+                    dest='processes', default=settings.INDEX_WORKERS,
+                    help='number of worker processes for building index '
+                         'documents'),
+        make_option('-b', '--batch-size', action='store', type='int',
+                    dest='batch_size', default=settings.INDEX_BATCH_SIZE,
+                    help='number of resources sent to the index at once'),
+        make_option('-s', '--since', action='store', dest='since',
+                    default=None,
+                    help='only reindex resources whose metadata or status '
+                         'changed since the given date '
+                         '(YYYY-MM-DD[THH:MM:SS]) instead of rebuilding the '
+                         'whole index'),
+    )
+
+    help = 'Rebuilds the search index of all published resources in parallel'
+
+    def handle(self, *args, **options):
+        """
+        Rebuild the search index.
+        """
+        _since = options.get('since')
+        if _since:
+            for _format in _SINCE_FORMATS:
+                try:
+                    _since = datetime.strptime(_since, _format)
+                    break
+                except ValueError:
+                    continue
+            else:
+                raise CommandError('Invalid date for --since: {}'
+                                   .format(_since))
+        rebuild_lr_index(
+          processes=options.get('processes') or settings.INDEX_WORKERS,
+          batch_size=options.get('batch_size') or settings.INDEX_BATCH_SIZE,
+          since=_since or None)
@@ -4,12 +4,15 @@ Methods for model data conversion between different representations.
 
 import logging
 
-from django.db.models import OneToOneField, Sum
+from django.core.cache import cache
+from django.db.models import Sum
 
 from metashare.repository.models import resourceInfoType_model, \
     corpusInfoType_model, lexicalConceptualResourceInfoType_model, \
-    languageDescriptionInfoType_model, toolServiceInfoType_model
-from metashare.settings import LOG_HANDLER
+    languageDescriptionInfoType_model, toolServiceInfoType_model, \
+    ResourceFacets, LookupIndexEntry, get_lookup_index_name, get_lookup_words
+from metashare.repository.supermodel import get_model_graph_revision
+from metashare.settings import LOG_HANDLER, ROOT_RESOURCES_CACHE_TIMEOUT
 from metashare.stats.models import LRStats
 
 
@@ -51,6 +54,16 @@ def get_related_models(instance, parent):
     return result
 
 
+# maximum number of ids which are looked up with a single `IN` query when
+# finding the resources which contain model instances
+_ROOT_RESOURCES_CHUNK_SIZE = 500
+
+# maps model classes to the sets of model classes whose instances may be on the
+# way to the resources containing instances of them, see
+# `_get_root_path_models()`
+_ROOT_PATH_MODELS = {}
+
+
 def get_root_resources(*instances):
     """
     Returns the set of `resourceInfoType_model` instances which somewhere
@@ -60,71 +73,243 @@ def get_root_resources(*instances):
     this instance will be in the returned set, too. The returned set can be
     empty.
     """
-    return _get_root_resources(set(), *instances)
+    return _get_resources(get_root_resource_ids(*instances))
 
 
-def _get_root_resources(ignore, *instances):
+def find_root_resources(*instances):
     """
     Returns the set of `resourceInfoType_model` instances which somewhere
-    contain the given model instances.
-    
-    If any of the given instances is a `resourceInfoType_model` itself, then
-    this instance will be in the returned set, too. The returned set can be
-    empty. All instances which are found in the given ignore set will not be
-    looked at. The ignore set will be extended with the given instances.
+    contain the given model instances just like `get_root_resources()`.
+
+    In contrast to `get_root_resources()`, the model graph is always walked
+    and no cached answers are used as these may be stale if the model graph
+    has been changed by another process. This function is meant for access
+    decisions.
     """
     result = set()
+    others = []
     for instance in instances:
-        if instance in ignore:
+        if not instance:
             continue
-        ignore.add(instance)
+        if isinstance(instance, resourceInfoType_model):
+            result.add(instance.pk)
+        else:
+            others.append(instance)
+    if others:
+        result.update(_find_root_resource_ids(others))
+    return _get_resources(result)
+
+
+def _get_resources(ids):
+    """
+    Returns the set of `resourceInfoType_model` instances with the given ids.
+    """
+    ids = list(ids)
+    result = set()
+    for i in xrange(0, len(ids), _ROOT_RESOURCES_CHUNK_SIZE):
+        result.update(resourceInfoType_model.objects \
+            .filter(pk__in=ids[i:i + _ROOT_RESOURCES_CHUNK_SIZE]) \
+            .select_related('storage_object'))
+    return result
 
+
+def get_root_resource_ids(*instances):
+    """
+    Returns the set of ids of the `resourceInfoType_model` instances which
+    somewhere contain the given model instances.
+
+    The answer for a single model instance is cached until an instance of one
+    of the model classes on the way to the resources changes (see
+    `get_model_graph_revision()`), at most for `ROOT_RESOURCES_CACHE_TIMEOUT`
+    seconds.
+    """
+    result = set()
+    uncached = []
+    revisions = {}
+    for instance in instances:
+        # an instance may be None, in which case we ignore it
+        if not instance:
+            continue
         # `resourceInfoType_model` instances are our actual results
         if isinstance(instance, resourceInfoType_model):
-            result.add(instance)
-        # an instance may be None, in which case we ignore it
-        elif instance:
-            # There are 3 possibilities for going backward in our model graph:
-
-            # case (1): we have to follow a `ForeignKey` with a name starting
-            #   with "back_to_":
-            for rel in [r for r in instance._meta.get_all_field_names()
-                        if r.startswith('back_to_')]:
-                result.update(_get_root_resources(ignore,
-                                                  getattr(instance, rel)))
-
-            # case (2): we have to follow "reverse" `ForeignKey`s and
-            #   `OneToOneField`s which are pointing at the current instance from
-            #   a model which is closer to the searched root model:
-            for rel in instance._meta.get_all_related_objects():
-                accessor_name = rel.get_accessor_name()
-                # the accessor name may point to a field which is None, so test
-                # first, if a field instance is actually available (?)
-                if hasattr(instance, accessor_name):
-                    accessor = getattr(instance, accessor_name)
-                    if isinstance(rel.field, OneToOneField):
-                        # in the case of `OneToOneField`s the accessor is the
-                        # new instance itself
-                        result.update(_get_root_resources(ignore, accessor))
-                    else:
-                        result.update(_get_root_resources(ignore,
-                                                          *accessor.all()))
+            result.add(instance.pk)
+            continue
+        if instance.__class__ not in revisions:
+            revisions[instance.__class__] = get_model_graph_revision(
+                _get_root_path_models(instance.__class__))
+        cached = cache.get(_get_root_resources_cache_key(instance,
+                                revisions[instance.__class__]))
+        if cached is None:
+            uncached.append(instance)
+        else:
+            result.update(cached)
+    if len(uncached) == 1:
+        found = _find_root_resource_ids(uncached)
+        cache.set(_get_root_resources_cache_key(uncached[0],
+                        revisions[uncached[0].__class__]),
+                  found, ROOT_RESOURCES_CACHE_TIMEOUT)
+        result.update(found)
+    elif uncached:
+        # the model graph is walked only once for all uncached instances; as
+        # the answer cannot be attributed to the single instances anymore, it
+        # is not cached
+        result.update(_find_root_resource_ids(uncached))
+    return result
+
+
+def get_root_resource_count(instance):
+    """
+    Returns the number of resources which contain the given model instance.
+    """
+    return len(get_root_resource_ids(instance))
+
+
+def _get_root_path_models(model):
+    """
+    Returns the set of model classes whose instances may be on the way from an
+    instance of the given model class up to the resources which contain it,
+    including the given model class itself.
 
-            # case (2): we have to follow the "reverse" part of a `ManyToMany`
-            #   field which is pointing at the current instance from a model
-            #   which is closer to the searched root model:
-            for rel in instance._meta.get_all_related_many_to_many_objects():
-                result.update(_get_root_resources(ignore,
-                        *getattr(instance, rel.get_accessor_name()).all()))
+    Only changes of instances of these model classes can change the resources
+    which contain an instance of the given model class.
+    """
+    if model not in _ROOT_PATH_MODELS:
+        result = set()
+        todo = [model]
+        while todo:
+            _model = todo.pop()
+            if _model in result:
+                continue
+            result.add(_model)
+            if issubclass(_model, resourceInfoType_model):
+                continue
+            # the same relations as in `_get_referencing_ids()`
+            todo.extend(f.rel.to for f in _model._meta.fields
+                        if f.name.startswith('back_to_'))
+            todo.extend(rel.model
+                        for rel in _model._meta.get_all_related_objects())
+            todo.extend(rel.model for rel
+                        in _model._meta.get_all_related_many_to_many_objects())
+        _ROOT_PATH_MODELS[model] = result
+    return _ROOT_PATH_MODELS[model]
+
+
+def _get_root_resources_cache_key(instance, revision):
+    """
+    Returns the cache key of the ids of the resources which contain the given
+    model instance in the given model graph revision.
+    """
+    return 'root_resources_{0}_{1}_{2}'.format(instance.__class__.__name__,
+                                               instance.pk, revision)
 
+
+def _find_root_resource_ids(instances):
+    """
+    Returns the set of ids of the `resourceInfoType_model` instances which
+    somewhere contain the given model instances.
+
+    The model graph is walked backwards level by level: all instances of a
+    model class which are found on the current level are looked at together
+    with one query per relation.
+    """
+    result = set()
+    seen = set()
+    level = {}
+    for instance in instances:
+        seen.add((instance.__class__, instance.pk))
+        level.setdefault(instance.__class__, set()).add(instance.pk)
+    while level:
+        next_level = {}
+        for model, ids in level.iteritems():
+            for rel_model, rel_ids in _get_referencing_ids(model, list(ids)):
+                for rel_id in rel_ids:
+                    if rel_id is None or (rel_model, rel_id) in seen:
+                        continue
+                    seen.add((rel_model, rel_id))
+                    if issubclass(rel_model, resourceInfoType_model):
+                        result.add(rel_id)
+                    else:
+                        next_level.setdefault(rel_model, set()).add(rel_id)
+        level = next_level
     return result
 
 
+def _get_referencing_ids(model, ids, only_models=None):
+    """
+    Yields tuples of a model class and the set of ids of those of its instances
+    which reference the instances of the given model class with the given ids,
+    i.e., which are one step closer to the root resources.
+
+    If a collection of model classes is given as `only_models`, then only
+    references from instances of these model classes are looked up.
+    """
+    def _wanted(_model):
+        return only_models is None or _model in only_models
+    back_to_fields = [f for f in model._meta.fields
+                      if f.name.startswith('back_to_') and _wanted(f.rel.to)]
+    for i in xrange(0, len(ids), _ROOT_RESOURCES_CHUNK_SIZE):
+        chunk = ids[i:i + _ROOT_RESOURCES_CHUNK_SIZE]
+        # There are 3 possibilities for going backward in our model graph:
+
+        # case (1): we have to follow a `ForeignKey` with a name starting with
+        #   "back_to_":
+        if back_to_fields:
+            rows = list(model.objects.filter(pk__in=chunk).values_list(
+                *[f.attname for f in back_to_fields]))
+            for idx, field in enumerate(back_to_fields):
+                yield field.rel.to, set(row[idx] for row in rows)
+
+        # case (2): we have to follow "reverse" `ForeignKey`s and
+        #   `OneToOneField`s which are pointing at the current instances from a
+        #   model which is closer to the searched root model:
+        for rel in model._meta.get_all_related_objects():
+            if not _wanted(rel.model):
+                continue
+            yield rel.model, set(rel.model.objects.filter(
+                    **{'{0}__in'.format(rel.field.name): chunk}) \
+                .values_list('pk', flat=True))
+
+        # case (3): we have to follow the "reverse" part of a `ManyToMany`
+        #   field which is pointing at the current instances from a model which
+        #   is closer to the searched root model:
+        for rel in model._meta.get_all_related_many_to_many_objects():
+            if not _wanted(rel.model):
+                continue
+            yield rel.model, set(rel.model.objects.filter(
+                    **{'{0}__in'.format(rel.field.name): chunk}) \
+                .values_list('pk', flat=True))
+
+
+def filter_by_lookup_index(queryset, term):
+    """
+    Restricts the given query set of reusable entities to those instances which
+    contain all words of the given search term in their `LookupIndexEntry`
+    tokens; returns the query set unchanged if the term does not contain any
+    words.
+
+    The result may contain false positives (e.g., if the words of the term
+    appear in a different order), so the candidates still have to be checked.
+    """
+    model_name = get_lookup_index_name(queryset.model)
+    for word in set(get_lookup_words(term)):
+        queryset = queryset.filter(id__in=LookupIndexEntry.objects.filter(
+            model_name=model_name, token__startswith=word).values('object_id'))
+    return queryset
+
+
 def get_resource_linguality_infos(res_obj):
     """
     Returns a list of all linguality types of the given language resource
     instance.
     """
+    return get_resource_facets(res_obj).linguality_types
+
+
+def _get_resource_linguality_infos(res_obj):
+    """
+    Collects the list of all linguality types of the given language resource
+    instance from the resource model graph.
+    """
     result = []
     corpus_media = res_obj.resourceComponentType.as_subclass()
 
@@ -194,6 +379,14 @@ def get_resource_license_types(res_obj):
     Returns a list of license under which the given language resource is
     available.
     """
+    return get_resource_facets(res_obj).licences
+
+
+def _get_resource_license_types(res_obj):
+    """
+    Collects the list of licences under which the given language resource is
+    available from the resource model graph.
+    """
     return [licence for licence_info in
             res_obj.distributionInfo.licenceinfotype_model_set.all()
             for licence in licence_info.get_licence_display_list()]
@@ -203,6 +396,15 @@ def get_resource_media_types(res_obj):
     """
     Returns a list of all media types of the given language resource instance.
     """
+    return [media_type.lower() for media_type
+            in get_resource_facets(res_obj).media_types]
+
+
+def _get_resource_media_types(res_obj):
+    """
+    Collects the list of all (not lower-cased) media types of the given language
+    resource instance from the resource model graph.
+    """
     result = []
     corpus_media = res_obj.resourceComponentType.as_subclass()
 
@@ -253,11 +455,124 @@ def get_resource_media_types(res_obj):
             result.extend(corpus_media.outputInfo \
                           .get_mediaType_display_list())
 
-    result_lower = []
-    for res in result:
-        result_lower.append(res.lower())
+    return result
+
+
+def _get_resource_language_names(res_obj):
+    """
+    Collects the list of all language names of the given language resource
+    instance from the resource model graph.
+    """
+    result = []
+    corpus_media = res_obj.resourceComponentType.as_subclass()
+
+    if isinstance(corpus_media, corpusInfoType_model):
+        media_type = corpus_media.corpusMediaType
+        for corpus_info in media_type.corpustextinfotype_model_set.all():
+            result.extend([lang.languageName for lang in
+                           corpus_info.languageinfotype_model_set.all()])
+        if media_type.corpusAudioInfo:
+            result.extend([lang.languageName for lang in
+                           media_type.corpusAudioInfo.languageinfotype_model_set.all()])
+        for corpus_info in media_type.corpusvideoinfotype_model_set.all():
+            result.extend([lang.languageName for lang in
+                           corpus_info.languageinfotype_model_set.all()])
+        if media_type.corpusTextNgramInfo:
+            result.extend([lang.languageName for lang in
+                        media_type.corpusTextNgramInfo.languageinfotype_model_set.all()])
+        if media_type.corpusImageInfo:
+            result.extend([lang.languageName for lang in
+                           media_type.corpusImageInfo.languageinfotype_model_set.all()])
+
+    elif isinstance(corpus_media, lexicalConceptualResourceInfoType_model):
+        lcr_media_type = corpus_media.lexicalConceptualResourceMediaType
+        if lcr_media_type.lexicalConceptualResourceAudioInfo:
+            result.extend([lang.languageName for lang in lcr_media_type \
+                    .lexicalConceptualResourceAudioInfo.languageinfotype_model_set.all()])
+        if lcr_media_type.lexicalConceptualResourceTextInfo:
+            result.extend([lang.languageName for lang in lcr_media_type \
+                    .lexicalConceptualResourceTextInfo.languageinfotype_model_set.all()])
+        if lcr_media_type.lexicalConceptualResourceVideoInfo:
+            result.extend([lang.languageName for lang in lcr_media_type \
+                    .lexicalConceptualResourceVideoInfo.languageinfotype_model_set.all()])
+        if lcr_media_type.lexicalConceptualResourceImageInfo:
+            result.extend([lang.languageName for lang in lcr_media_type \
+                    .lexicalConceptualResourceImageInfo.languageinfotype_model_set.all()])
+
+    elif isinstance(corpus_media, languageDescriptionInfoType_model):
+        ld_media_type = corpus_media.languageDescriptionMediaType
+        if ld_media_type.languageDescriptionTextInfo:
+            result.extend([lang.languageName for lang in ld_media_type \
+                        .languageDescriptionTextInfo.languageinfotype_model_set.all()])
+        if ld_media_type.languageDescriptionVideoInfo:
+            result.extend([lang.languageName for lang in ld_media_type \
+                        .languageDescriptionVideoInfo.languageinfotype_model_set.all()])
+        if ld_media_type.languageDescriptionImageInfo:
+            result.extend([lang.languageName for lang in ld_media_type \
+                        .languageDescriptionImageInfo.languageinfotype_model_set.all()])
 
-    return result_lower
+    elif isinstance(corpus_media, toolServiceInfoType_model):
+        if corpus_media.inputInfo:
+            result.extend(corpus_media.inputInfo.languageName)
+        if corpus_media.outputInfo:
+            result.extend(corpus_media.outputInfo.languageName)
+
+    return result
+
+
+def get_resource_language_names(res_obj):
+    """
+    Returns a list of all language names of the given language resource
+    instance.
+    """
+    return get_resource_facets(res_obj).languages
+
+
+def get_resource_facets(res_obj):
+    """
+    Returns the `ResourceFacets` summary of the given language resource
+    instance, creating it if it does not exist, yet.
+    """
+    try:
+        return res_obj.facets
+    except ResourceFacets.DoesNotExist:
+        return update_resource_facets(res_obj)
+
+
+def update_resource_facets(res_obj):
+    """
+    Recomputes the `ResourceFacets` summary of the given language resource
+    instance from the resource model graph and returns it.
+    """
+    try:
+        facets = ResourceFacets.objects.get(resource=res_obj)
+    except ResourceFacets.DoesNotExist:
+        facets = ResourceFacets(resource=res_obj)
+    facets.resource_type = \
+        res_obj.resourceComponentType.as_subclass().resourceType or ''
+    facets.languages = _get_resource_language_names(res_obj)
+    facets.media_types = _get_resource_media_types(res_obj)
+    facets.linguality_types = _get_resource_linguality_infos(res_obj)
+    facets.licences = _get_resource_license_types(res_obj)
+    facets.save()
+    return facets
+
+
+def get_resource_view_cache_key(storage_object):
+    """
+    Returns the cache key of the metadata dependent parts of the single
+    resource view for the given storage object in its current revision.
+    """
+    return 'resource_view_{0}_{1}'.format(storage_object.identifier,
+                                          storage_object.revision)
+
+
+def invalidate_resource_view_cache(storage_object):
+    """
+    Removes the cached metadata dependent parts of the single resource view for
+    the given storage object in its current revision.
+    """
+    cache.delete(get_resource_view_cache_key(storage_object))
 
 def get_lr_stat_action_count(obj_identifier, stats_action):
     """
@@ -1,9 +1,11 @@
 # pylint: disable-msg=C0302
 import logging
+import re
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.db import models
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.template.defaultfilters import slugify
 
 from metashare.accounts.models import EditorGroup
@@ -22,7 +24,7 @@ from metashare.settings import DJANGO_BASE, LOG_HANDLER, DJANGO_URL
 from metashare.stats.model_utils import saveLRStats, DELETE_STAT, UPDATE_STAT
 from metashare.storage.models import StorageObject, MASTER, COPY_CHOICES
 from metashare.recommendations.models import ResourceCountPair, \
-    ResourceCountDict
+    ResourceCountDict, ResourceRecommendations, forget_together_counts
 
 
 # Setup logging support.
@@ -228,6 +230,9 @@ class resourceInfoType_model(SchemaModel):
             # delete recommendations
             ResourceCountPair.objects.filter(lrid=self.storage_object.identifier).delete()
             ResourceCountDict.objects.filter(lrid=self.storage_object.identifier).delete()
+            forget_together_counts(self.storage_object.identifier)
+            ResourceRecommendations.objects.filter(
+                lrid=self.storage_object.identifier).delete()
             
         # Call delete() method from super class with all arguments but keep_stats
         super(resourceInfoType_model, self).delete(*args, **kwargs)
@@ -804,6 +809,9 @@ class documentationInfoType_model(SubclassableModel):
     class Meta:
         verbose_name = "Documentation"
 
+    content_hash = models.CharField(max_length=32, null=True, blank=True,
+      editable=False, db_index=True)
+
 
 DOCUMENTINFOTYPE_DOCUMENTTYPE_CHOICES = _make_choices_from_list([
   u'article', u'book', u'booklet', u'manual', u'techReport',
@@ -1403,6 +1411,9 @@ class targetResourceInfoType_model(SchemaModel):
     class Meta:
         verbose_name = "Target resource"
 
+    content_hash = models.CharField(max_length=32, null=True, blank=True,
+      editable=False, db_index=True)
+
 
     __schema_name__ = 'targetResourceInfoType'
     __schema_fields__ = (
@@ -2585,6 +2596,9 @@ class actorInfoType_model(SubclassableModel):
     class Meta:
         verbose_name = "Actor"
 
+    content_hash = models.CharField(max_length=32, null=True, blank=True,
+      editable=False, db_index=True)
+
 
 # pylint: disable-msg=C0103
 class organizationInfoType_model(actorInfoType_model):
@@ -3439,6 +3453,9 @@ class projectInfoType_model(SchemaModel):
     class Meta:
         verbose_name = "Project"
 
+    content_hash = models.CharField(max_length=32, null=True, blank=True,
+      editable=False, db_index=True)
+
 
     __schema_name__ = 'projectInfoType'
     __schema_fields__ = (
@@ -7911,3 +7928,178 @@ class documentUnstructuredString_model(InvisibleStringModel, documentationInfoTy
             # pylint: disable-msg=W0201
             self.id = _compute_documentationInfoType_key()
         super(documentUnstructuredString_model, self).save(*args, **kwargs)
+
+
+class ResourceFacets(models.Model):
+    """
+    Denormalized summary of frequently needed facet values of a resource.
+
+    The summary is recomputed whenever the metadata of the resource changes
+    (see `StorageObject.update_storage()`) so that the search index, the single
+    resource view and various template tags don't have to walk the complete
+    resource model graph again and again.
+    """
+    resource = models.OneToOneField(resourceInfoType_model,
+      related_name='facets', editable=False)
+
+    resource_type = models.CharField(max_length=100, blank=True,
+      editable=False)
+
+    languages = MultiTextField(blank=True, editable=False)
+
+    media_types = MultiTextField(blank=True, editable=False)
+
+    linguality_types = MultiTextField(blank=True, editable=False)
+
+    licences = MultiTextField(blank=True, editable=False)
+
+    def __unicode__(self):
+        """
+        Returns the Unicode representation for this facet summary instance.
+        """
+        return u'<ResourceFacets of resource #{0}>'.format(self.resource_id)
+
+
+class LookupIndexEntry(models.Model):
+    """
+    A searchable token of a reusable entity which is offered by the
+    auto-completion of the editor, e.g., a person or an organization.
+
+    Most names of these entities are stored in pickled `DictField`s which cannot
+    be searched in the database. Therefore each word of an entity's names and
+    Unicode representation is indexed here with all of its suffixes, so that a
+    substring search of a word becomes an indexed prefix search of the tokens.
+    The entries are kept in sync when an entity is saved or deleted (see
+    `update_lookup_index()`).
+    """
+    # the name of the topmost concrete model class of the indexed entity, so
+    # that, e.g., persons and organizations can also be found as actors
+    model_name = models.CharField(max_length=100, editable=False)
+
+    # indexed as the entries of an entity are replaced whenever it changes
+    object_id = models.IntegerField(db_index=True, editable=False)
+
+    token = models.CharField(max_length=50, db_index=True, editable=False)
+
+    def __unicode__(self):
+        """
+        Returns the Unicode representation for this lookup index entry.
+        """
+        return u'<LookupIndexEntry {0} of {1} #{2}>'.format(self.token,
+          self.model_name, self.object_id)
+
+
+# the model classes whose instances are indexed in the `LookupIndexEntry` table
+LOOKUP_INDEX_MODELS = (personInfoType_model, organizationInfoType_model,
+  documentInfoType_model, projectInfoType_model, targetResourceInfoType_model)
+
+# the maximum number of lookup index entries which are inserted at once
+_LOOKUP_INDEX_INSERT_SIZE = 100
+
+_LOOKUP_INDEX_WORD_REGEX = re.compile(r'\w+', re.UNICODE)
+
+
+def get_lookup_index_name(model):
+    """
+    Returns the name under which instances of the given model class are found
+    in the `LookupIndexEntry` table.
+
+    Instances of model classes with multi-table inheritance share their id with
+    their topmost concrete superclass, so the name of that class is used.
+    """
+    for parent in model._meta.get_parent_list():
+        if not parent._meta.parents:
+            return parent.__name__
+    return model.__name__
+
+
+def get_lookup_words(text):
+    """
+    Returns the list of lower case words of the given text, cut to the maximum
+    lookup index token length.
+    """
+    max_length = LookupIndexEntry._meta.get_field('token').max_length
+    return [word[:max_length]
+            for word in _LOOKUP_INDEX_WORD_REGEX.findall(text.lower())]
+
+
+def get_lookup_tokens(text):
+    """
+    Returns the set of lookup index tokens of the given text, i.e., all suffixes
+    of all its lower case words, cut to the maximum token length.
+    """
+    max_length = LookupIndexEntry._meta.get_field('token').max_length
+    result = set()
+    for word in _LOOKUP_INDEX_WORD_REGEX.findall(text.lower()):
+        for i in xrange(len(word)):
+            result.add(word[i:i + max_length])
+    return result
+
+
+def _get_lookup_index_text(instance):
+    """
+    Returns the text of the given entity which is indexed in the
+    `LookupIndexEntry` table: its current Unicode representation and all
+    values of its `DictField`s.
+    """
+    try:
+        # the cached Unicode representation may not be up to date, yet
+        texts = [instance.real_unicode_()]
+    # pylint: disable-msg=W0703
+    except Exception:
+        texts = [unicode(instance)]
+    for field in instance._meta.fields:
+        if isinstance(field, DictField):
+            value = getattr(instance, field.name)
+            if value:
+                texts.extend(value.itervalues())
+    return u' '.join(texts)
+
+
+def update_lookup_index(instance):
+    """
+    Recomputes the `LookupIndexEntry` tokens of the given entity.
+    """
+    model_name = get_lookup_index_name(instance.__class__)
+    LookupIndexEntry.objects.filter(model_name=model_name,
+                                    object_id=instance.id).delete()
+    entries = [LookupIndexEntry(model_name=model_name, object_id=instance.id,
+                                token=token)
+               for token in get_lookup_tokens(_get_lookup_index_text(instance))]
+    for i in xrange(0, len(entries), _LOOKUP_INDEX_INSERT_SIZE):
+        LookupIndexEntry.objects.bulk_create(
+            entries[i:i + _LOOKUP_INDEX_INSERT_SIZE])
+
+
+def _update_lookup_index(sender, instance, raw=False, **kwargs):
+    """
+    Keeps the `LookupIndexEntry` tokens of a saved entity in sync.
+    """
+    if not raw:
+        update_lookup_index(instance)
+
+
+def _update_lookup_index_m2m(sender, instance, action, reverse, **kwargs):
+    """
+    Keeps the `LookupIndexEntry` tokens of an entity in sync whose many-to-many
+    relations (e.g., the affiliations of a person) are part of its Unicode
+    representation.
+    """
+    if not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        update_lookup_index(instance)
+
+
+def _remove_from_lookup_index(sender, instance, **kwargs):
+    """
+    Removes the `LookupIndexEntry` tokens of a deleted entity.
+    """
+    LookupIndexEntry.objects.filter(model_name=get_lookup_index_name(sender),
+                                    object_id=instance.id).delete()
+
+
+for _model in LOOKUP_INDEX_MODELS:
+    post_save.connect(_update_lookup_index, sender=_model)
+    post_delete.connect(_remove_from_lookup_index, sender=_model)
+    for _field in _model._meta.many_to_many:
+        m2m_changed.connect(_update_lookup_index_m2m,
+                            sender=_field.rel.through)
@@ -1,12 +1,15 @@
 import logging
 import os
 import re
+from multiprocessing import Pool
+from traceback import format_exc
 
 from haystack.indexes import CharField, IntegerField, RealTimeSearchIndex
 from haystack import indexes, connections as haystack_connections, \
     connection_router as haystack_connection_router
 
-from django.db.models import signals
+from django.db.models import signals, Q
+from django.db.models.query import QuerySet
 from django.utils.translation import ugettext as _
 from unidecode import unidecode
 
@@ -17,8 +20,10 @@ from metashare.repository.models import resourceInfoType_model, \
     languageDescriptionInfoType_model
 from metashare.repository.search_fields import LabeledCharField, \
     LabeledMultiValueField
-from metashare.storage.models import StorageObject, INGESTED, PUBLISHED
-from metashare.settings import LOG_HANDLER
+from metashare.repository.supermodel import prefetch_schema_trees
+from metashare.storage.models import StorageObject, INGESTED, PUBLISHED, \
+    IndexUpdate, _close_db_connection
+from metashare.settings import LOG_HANDLER, INDEX_BATCH_SIZE
 from metashare.stats.model_utils import DOWNLOAD_STAT, VIEW_STAT
 
 
@@ -39,6 +44,203 @@ def update_lr_index_entry(res_obj):
         .update_object(res_obj)
 
 
+def update_lr_index_entries(resources, batch_size=INDEX_BATCH_SIZE):
+    """
+    Updates/creates the search index entries for the given published language
+    resource objects.
+
+    The resources are processed in batches of `batch_size` resources: the
+    complete metadata of a batch is loaded with a few queries only and all
+    index documents of a batch are sent to the search index at once.
+    """
+    _connection = haystack_connections[haystack_connection_router.for_write()]
+    _index = _connection.get_unified_index().get_index(resourceInfoType_model)
+    _backend = _connection.get_backend()
+    for batch in _prefetched_batches(resources, batch_size):
+        _backend.update(_index, batch)
+
+
+def enqueue_lr_index_update(res_obj):
+    """
+    Schedules an update of the search index entry of the given language
+    resource object.
+
+    The update is done asynchronously by `process_lr_index_updates()`; until
+    then, further updates of the same resource are coalesced with this one.
+    """
+    IndexUpdate.objects.get_or_create(
+        identifier=res_obj.storage_object.identifier)
+
+
+def process_lr_index_updates(batch_size=INDEX_BATCH_SIZE):
+    """
+    Updates the search index entries of all language resources for which an
+    update has been scheduled with `enqueue_lr_index_update()`.
+
+    The updates are processed in batches of `batch_size` resources. Returns the
+    number of processed updates.
+    """
+    _index = _get_lr_index_and_backend()[0]
+    _count = 0
+    while True:
+        _updates = list(IndexUpdate.objects.order_by('id')[:batch_size])
+        if not _updates:
+            break
+        _identifiers = [_update.identifier for _update in _updates]
+        # dequeue the updates before indexing so that changes which happen
+        # during the indexing are queued again
+        IndexUpdate.objects.filter(
+            pk__in=[_update.pk for _update in _updates]).delete()
+        try:
+            update_lr_index_entries(_index.index_queryset().filter(
+                storage_object__identifier__in=_identifiers), batch_size)
+        except:
+            LOGGER.error('Error while processing index updates; they will be '
+                         'retried later.', exc_info=True)
+            for _identifier in _identifiers:
+                IndexUpdate.objects.get_or_create(identifier=_identifier)
+            raise
+        _count += len(_updates)
+    LOGGER.info('Processed {} index updates.'.format(_count))
+    return _count
+
+
+def _get_lr_index_and_backend():
+    """
+    Returns a pair of the language resource search index and the search
+    backend to write to.
+    """
+    _connection = haystack_connections[haystack_connection_router.for_write()]
+    return _connection.get_unified_index().get_index(resourceInfoType_model), \
+        _connection.get_backend()
+
+
+def _index_id_range(id_range):
+    """
+    Sends the index documents of all published language resources in the given
+    triple of first resource id, last resource id and minimum modification
+    date (or None) to the search index without committing.
+
+    Returns a pair of the number of indexed resources and an error message or
+    None on success. No exceptions are raised so that this function can be
+    safely used in a worker process.
+    """
+    _first_id, _last_id, _since = id_range
+    try:
+        _index, _backend = _get_lr_index_and_backend()
+        _resources = _index.index_queryset().filter(pk__gte=_first_id,
+                                                    pk__lte=_last_id)
+        if _since is not None:
+            _resources = _resources.filter(_changed_since(_since))
+        _resources = list(_resources)
+        if _resources:
+            _backend.update(_index, _resources, commit=False)
+        return len(_resources), None
+    except:
+        return 0, format_exc()
+
+
+def _changed_since(since):
+    """
+    Returns a `Q` object which matches all language resources whose metadata,
+    publication status or deletion status flag has changed at or after the
+    given `datetime`.
+    """
+    return Q(storage_object__modified__gte=since) \
+        | Q(storage_object__status_modified__gte=since)
+
+
+def rebuild_lr_index(processes=1, batch_size=INDEX_BATCH_SIZE, since=None):
+    """
+    (Re-)builds the search index entries of all published language resources.
+
+    The resources are split into id ranges of `batch_size` resources which are
+    indexed in a pool of `processes` worker processes. The search index is
+    only committed once at the end.
+
+    processes (optional): the number of worker processes; if 1, all resources
+        are indexed in the current process
+    batch_size (optional): the number of resources which are sent to the
+        search index at once
+    since (optional): if given, the index is not cleared and only resources
+        whose metadata, publication status or deletion status flag has changed
+        at or after this `datetime` are reindexed or removed from the index
+
+    Returns the number of indexed resources.
+    """
+    _index, _backend = _get_lr_index_and_backend()
+    _resources = _index.index_queryset()
+    if since is None:
+        LOGGER.info('Clearing the search index.')
+        _backend.clear(models=[resourceInfoType_model], commit=False)
+    else:
+        _resources = _resources.filter(_changed_since(since))
+        # resources which have been deleted or unpublished in the meantime
+        # must not remain in the index
+        for resource in resourceInfoType_model.objects \
+                .filter(_changed_since(since)) \
+                .exclude(pk__in=_index.index_queryset().values('pk')):
+            _backend.remove(resource, commit=False)
+
+    _ids = list(_resources.order_by('pk').values_list('pk', flat=True))
+    _id_ranges = [(_ids[i], _ids[min(i + batch_size, len(_ids)) - 1], since)
+                  for i in range(0, len(_ids), batch_size)]
+    LOGGER.info('Indexing {} resources in {} batches.'.format(len(_ids),
+                                                            len(_id_ranges)))
+    if processes > 1 and len(_id_ranges) > 1:
+        _close_db_connection()
+        _pool = Pool(processes, _close_db_connection)
+        try:
+            _results = list(_pool.imap_unordered(_index_id_range, _id_ranges))
+        finally:
+            _pool.close()
+            _pool.join()
+    else:
+        _results = [_index_id_range(_id_range) for _id_range in _id_ranges]
+
+    _count = 0
+    for _indexed, _error in _results:
+        _count += _indexed
+        if _error is not None:
+            LOGGER.error('Error while indexing resources: {}'.format(_error))
+    _backend.conn.commit()
+    LOGGER.info('Indexed {} resources.'.format(_count))
+    return _count
+
+
+def _prefetched_batches(resources, batch_size):
+    """
+    Yields lists of at most `batch_size` of the given language resource
+    objects, each with the complete schema trees of its resources prefetched.
+    """
+    batch = []
+    for resource in resources:
+        batch.append(resource)
+        if len(batch) >= batch_size:
+            prefetch_schema_trees(batch)
+            yield batch
+            batch = []
+    if batch:
+        prefetch_schema_trees(batch)
+        yield batch
+
+
+class _PrefetchingQuerySet(QuerySet):
+    """
+    A `QuerySet` of language resource objects which bulk loads the complete
+    schema trees of its resources in batches of `INDEX_BATCH_SIZE` resources
+    while being iterated.
+
+    This way the large number of `prepare_*()` methods of our search index do
+    not hit the database anymore when (re-)building the search index.
+    """
+    def iterator(self):
+        for batch in _prefetched_batches(
+                super(_PrefetchingQuerySet, self).iterator(), INDEX_BATCH_SIZE):
+            for resource in batch:
+                yield resource
+
+
 class PatchedRealTimeSearchIndex(RealTimeSearchIndex):
     """
     A patched version of the `RealTimeSearchIndex` which works around Haystack
@@ -303,9 +505,13 @@ class resourceInfoType_modelIndex(PatchedRealTimeSearchIndex,
         Returns the default QuerySet to index when doing a full index update.
 
         In our case this is a QuerySet containing only published resources that
-        have not been deleted, yet.
+        have not been deleted, yet. The complete metadata of the resources is
+        loaded in batches while iterating over the QuerySet.
         """
-        return self.read_queryset()
+        return _PrefetchingQuerySet(model=self.get_model()) \
+            .select_related('storage_object') \
+            .filter(storage_object__deleted=False,
+                    storage_object__publication_status=PUBLISHED)
 
     def read_queryset(self):
         """
@@ -371,6 +577,9 @@ class resourceInfoType_modelIndex(PatchedRealTimeSearchIndex,
         if instance.storage_object.publication_status == PUBLISHED:
             LOGGER.info("Published resource #{0} scheduled for reindexing." \
                         .format(instance.id))
+            # load the complete resource metadata at once instead of hitting
+            # the database again and again in the various prepare methods
+            prefetch_schema_trees([instance])
             super(resourceInfoType_modelIndex, self) \
                 .update_object(instance, using=using, **kwargs)
         # make sure that there are no index entries for ingested/unpublished
@@ -509,67 +718,13 @@ class resourceInfoType_modelIndex(PatchedRealTimeSearchIndex,
         """
         Collect the data to filter the resources on Language Name
         """
-        result = []
-        corpus_media = obj.resourceComponentType.as_subclass()
-
-        if isinstance(corpus_media, corpusInfoType_model):
-            media_type = corpus_media.corpusMediaType
-            for corpus_info in media_type.corpustextinfotype_model_set.all():
-                result.extend([lang.languageName for lang in
-                               corpus_info.languageinfotype_model_set.all()])
-            if media_type.corpusAudioInfo:
-                result.extend([lang.languageName for lang in
-                               media_type.corpusAudioInfo.languageinfotype_model_set.all()])
-            for corpus_info in media_type.corpusvideoinfotype_model_set.all():
-                result.extend([lang.languageName for lang in
-                               corpus_info.languageinfotype_model_set.all()])
-            if media_type.corpusTextNgramInfo:
-                result.extend([lang.languageName for lang in
-                            media_type.corpusTextNgramInfo.languageinfotype_model_set.all()])
-            if media_type.corpusImageInfo:
-                result.extend([lang.languageName for lang in
-                               media_type.corpusImageInfo.languageinfotype_model_set.all()])
-
-        elif isinstance(corpus_media, lexicalConceptualResourceInfoType_model):
-            lcr_media_type = corpus_media.lexicalConceptualResourceMediaType
-            if lcr_media_type.lexicalConceptualResourceAudioInfo:
-                result.extend([lang.languageName for lang in lcr_media_type \
-                        .lexicalConceptualResourceAudioInfo.languageinfotype_model_set.all()])
-            if lcr_media_type.lexicalConceptualResourceTextInfo:
-                result.extend([lang.languageName for lang in lcr_media_type \
-                        .lexicalConceptualResourceTextInfo.languageinfotype_model_set.all()])
-            if lcr_media_type.lexicalConceptualResourceVideoInfo:
-                result.extend([lang.languageName for lang in lcr_media_type \
-                        .lexicalConceptualResourceVideoInfo.languageinfotype_model_set.all()])
-            if lcr_media_type.lexicalConceptualResourceImageInfo:
-                result.extend([lang.languageName for lang in lcr_media_type \
-                        .lexicalConceptualResourceImageInfo.languageinfotype_model_set.all()])
-
-        elif isinstance(corpus_media, languageDescriptionInfoType_model):
-            ld_media_type = corpus_media.languageDescriptionMediaType
-            if ld_media_type.languageDescriptionTextInfo:
-                result.extend([lang.languageName for lang in ld_media_type \
-                            .languageDescriptionTextInfo.languageinfotype_model_set.all()])
-            if ld_media_type.languageDescriptionVideoInfo:
-                result.extend([lang.languageName for lang in ld_media_type \
-                            .languageDescriptionVideoInfo.languageinfotype_model_set.all()])
-            if ld_media_type.languageDescriptionImageInfo:
-                result.extend([lang.languageName for lang in ld_media_type \
-                            .languageDescriptionImageInfo.languageinfotype_model_set.all()])
-
-        elif isinstance(corpus_media, toolServiceInfoType_model):
-            if corpus_media.inputInfo:
-                result.extend(corpus_media.inputInfo.languageName)
-            if corpus_media.outputInfo:
-                result.extend(corpus_media.outputInfo.languageName)
-
-        return result
+        return model_utils.get_resource_language_names(obj)
 
     def prepare_resourceTypeFilter(self, obj):
         """
         Collect the data to filter the resources on Resource Type
         """
-        resType = obj.resourceComponentType.as_subclass().resourceType
+        resType = model_utils.get_resource_facets(obj).resource_type
         if resType:
             return [resType]
         return []
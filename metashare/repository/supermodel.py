@@ -1,7 +1,9 @@
 import datetime
 import logging
 import re
+import time
 import urllib
+from hashlib import md5
 from Queue import Queue
 from traceback import format_exc
 from xml.etree.ElementTree import Element, fromstring, tostring
@@ -12,16 +14,20 @@ from django.core.exceptions import ValidationError, ObjectDoesNotExist, \
     ImproperlyConfigured
 from django.db import models, IntegrityError
 from django.db.models.fields import related
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.fields.related import ForeignRelatedObjectsDescriptor, \
-    OneToOneField
+    OneToOneField, ForeignKey, ManyToManyField
+from django.db.models.query import prefetch_related_objects
+from django.db.models.signals import post_delete, pre_delete, m2m_changed
 
 import metashare.repository.models
 from metashare.repository.fields import MultiSelectField, MultiTextField, \
     MetaBooleanField, DictField
 from metashare.settings import LOG_HANDLER, \
-    CHECK_FOR_DUPLICATE_INSTANCES
+    CHECK_FOR_DUPLICATE_INSTANCES, OBJECT_XML_CACHE_SIZE
 from metashare.storage.models import MASTER
-from metashare.utils import SimpleTimezone, prettify_camel_case_string
+from metashare.utils import LRUCache, SimpleTimezone, \
+    prettify_camel_case_string
 
 
 # Setup logging support.
@@ -47,7 +53,24 @@ SCHEMA_URL = 'http://metashare.ilsp.gr/META-XMLSchema/v{0}/' \
 METASHARE_ID_REGEXP = re.compile('<metashareId>.+</metashareId>',
   re.I|re.S|re.U)
 
-OBJECT_XML_CACHE = {}
+# serialised XML Strings of schema model instances, used for finding duplicate
+# instances; entries are removed whenever an instance is saved or deleted
+OBJECT_XML_CACHE = LRUCache(OBJECT_XML_CACHE_SIZE)
+
+# maximum number of instances whose related objects are loaded with a single
+# query in prefetch_schema_trees()
+PREFETCH_CHUNK_SIZE = 500
+
+# pair of the set of model classes with a content_hash field and the set of all
+# model classes whose instances may be contained in instances of these, see
+# _get_content_hash_models()
+_CONTENT_HASH_MODELS = None
+
+# the cache key template of the per model class counters which are increased
+# whenever an instance of the model class or one of its many-to-many relations
+# changes, i.e., whenever cached information about the model graph (see
+# `get_root_resources()`) which depends on the model class may be stale
+_MODEL_GRAPH_REVISION_KEY = 'model_graph_revision_{0}'
 
 # This import is required for at least an `eval` in the `_classify` function:
 # pylint: disable-msg=W0611
@@ -75,6 +98,12 @@ def _classify(class_name):
     except NameError:
         return None
 
+def _get_xml_cache_key(obj):
+    """
+    Returns the key of the given schema model instance in OBJECT_XML_CACHE.
+    """
+    return '{}_{}'.format(type(obj).__name__.lower(), obj.id)
+
 def _make_choices_from_list(source_list):
     """
     Converts a given list of Strings to tuple choices.
@@ -393,9 +422,11 @@ class SchemaModel(models.Model):
                 elif isinstance(_field, DictField):
                     _value = _value.items()
 
-                # For ManyToManyFields, compute all related objects.
+                # For ManyToManyFields, compute all related objects.  They are
+                # sorted in Python so that objects which have been loaded with
+                # prefetch_schema_trees() are used without further queries.
                 if isinstance(_value, models.Manager):
-                    _value = _value.all().order_by('id')
+                    _value = sorted(_value.all(), key=lambda obj: obj.id)
 
                 # If the value is not yet of list type, we wrap it in a list.
                 elif not isinstance(_value, list):
@@ -608,21 +639,30 @@ class SchemaModel(models.Model):
         query_set = cls.objects.filter(**kwargs).order_by('id')
 
         _duplicates = []
-        if query_set.count() > 1:
+        if query_set.count() > 1 and hasattr(_object, 'content_hash'):
+            # Reusable models carry an indexed fingerprint of their canonical
+            # XML serialization, hence we only have to serialize candidates
+            # which have not been fingerprinted yet instead of all of them.
+            _obj_hash = _object.update_content_hash()
+            for _candidate in query_set.filter(content_hash__isnull=True) \
+                .exclude(pk=_object.pk).iterator():
+                _candidate.update_content_hash()
+
+            # Fingerprints are reset whenever a contained object changes (see
+            # invalidate_content_hashes()), but we still double check all hash
+            # matches so that a hash collision cannot merge distinct objects.
+            _obj_value = _object.get_canonical_xml()
+            for _candidate in query_set.filter(content_hash=_obj_hash) \
+                .exclude(pk=_object.pk):
+                if _obj_value == _candidate.get_canonical_xml():
+                    _duplicates.append(_candidate)
+                else:
+                    _candidate.update_content_hash()
+
+        elif query_set.count() > 1:
             # We now know that there may exist at least one duplicate for the
             # given _object;  we have to check the related objects to be sure.
-            
-            # Convert the current object into its serialised XML String and
-            # remove any META-SHARE related id from this String.
-            cache_key = '{}_{}'.format(type(_object).__name__.lower(),
-              _object.id)
-            if OBJECT_XML_CACHE.has_key(cache_key):
-                _obj_value = OBJECT_XML_CACHE[cache_key]
-            
-            else:
-                _obj_value = tostring(_object.export_to_elementtree())
-                _obj_value = METASHARE_ID_REGEXP.sub('', _obj_value)
-                OBJECT_XML_CACHE[cache_key] = _obj_value
+            _obj_value = _object.get_canonical_xml()
 
             # Iterate over all potential duplicates, ordered by increasing id.
             for _candidate in query_set.iterator():
@@ -630,23 +670,42 @@ class SchemaModel(models.Model):
                 if _candidate == _object:
                     continue
 
-                # Convert candidate into XML String and remove META-SHARE id.
-                cache_key = '{}_{}'.format(type(_candidate).__name__.lower(),
-                  _candidate.id)
-                if OBJECT_XML_CACHE.has_key(cache_key):
-                    _check = OBJECT_XML_CACHE[cache_key]
-
-                else:
-                    _check = tostring(_candidate.export_to_elementtree())
-                    _check = METASHARE_ID_REGEXP.sub('', _check)
-                    OBJECT_XML_CACHE[cache_key] = _check
-
                 # If both XML Strings are equal, we have found a duplicate!
-                if _obj_value == _check:
+                if _obj_value == _candidate.get_canonical_xml():
                     _duplicates.append(_candidate)
 
         return _duplicates
 
+    def get_canonical_xml(self):
+        """
+        Returns the serialised XML String of this instance without any
+        META-SHARE related id, as used for finding duplicate instances.
+        """
+        cache_key = _get_xml_cache_key(self)
+        _value = OBJECT_XML_CACHE.get(cache_key)
+        if _value is None:
+            _value = tostring(self.export_to_elementtree())
+            _value = METASHARE_ID_REGEXP.sub('', _value)
+            OBJECT_XML_CACHE[cache_key] = _value
+        return _value
+
+    def update_content_hash(self):
+        """
+        Computes the fingerprint of the canonical XML serialization of this
+        instance and stores it in its content_hash field.
+
+        Only available for models which have a content_hash field, i.e., the
+        reusable models whose duplicates are looked up on import. The indexed
+        field holds the fingerprint or None if it has not been computed since
+        the last change of the instance or a contained object.  Returns the
+        new fingerprint.
+        """
+        _hash = md5(self.get_canonical_xml()).hexdigest()
+        # update the row directly so that save() does not reset the hash again
+        type(self).objects.filter(pk=self.pk).update(content_hash=_hash)
+        self.content_hash = _hash
+        return _hash
+
     @staticmethod
     def _cleanup(objects, only_remove_duplicates=False):
         """
@@ -677,11 +736,7 @@ class SchemaModel(models.Model):
             if obj.id:
                 try:
                     LOGGER.debug(u'Deleting object {0}'.format(obj))
-                    cache_key = '{}_{}'.format(type(obj).__name__.lower(),
-                      obj.id)
-
-                    if OBJECT_XML_CACHE.has_key(cache_key):
-                        OBJECT_XML_CACHE.pop(cache_key)
+                    OBJECT_XML_CACHE.pop(_get_xml_cache_key(obj))
 
                     if obj.__schema_name__ == "resourceInfo":
                         storage_object = obj.storage_object
@@ -1281,10 +1336,19 @@ class SchemaModel(models.Model):
         '''
             Override the superclass method to trigger cache updating.
         '''
+        if hasattr(self, 'content_hash'):
+            # the fingerprint is recomputed on the next duplicate check
+            self.content_hash = None
+        OBJECT_XML_CACHE.pop(_get_xml_cache_key(self))
+        _created = self.pk is None
         super(SchemaModel, self).save(force_insert, force_update, using)
+        if not _created:
+            # a new instance cannot be contained in any other instance, yet
+            invalidate_content_hashes(self)
         cache_key = '{}_{}'.format(self.__schema_name__, self.id)
         #print u'deleting {}_{}'.format(self.__schema_name__, self.id)
         cache.delete(cache_key)
+        increase_model_graph_revision(type(self))
 
 
     def delete_deep(self, keep_stats=False):
@@ -1337,6 +1401,10 @@ class SubclassableModel(SchemaModel):
         return self.__class__.__name__
 
     def as_subclass(self):
+        # instances which have been loaded by prefetch_schema_trees() already
+        # know their most specific subclass instance
+        if hasattr(self, '_subclass_instance'):
+            return self._subclass_instance
         # pylint: disable-msg=E1101
         subclasses = self.__class__.__subclasses__()
         for subclass in subclasses:
@@ -1371,3 +1439,258 @@ class InvisibleStringModel(SchemaModel):
         if not self.value:
             return u''
         return self.value
+
+
+def _remove_from_xml_cache(sender, instance, **kwargs):
+    """
+    Removes the given deleted schema model instance from OBJECT_XML_CACHE.
+
+    This is a signal handler so that it also covers cascading deletions.
+    """
+    if isinstance(instance, SchemaModel):
+        OBJECT_XML_CACHE.pop(_get_xml_cache_key(instance))
+        increase_model_graph_revision(type(instance))
+
+post_delete.connect(_remove_from_xml_cache)
+
+
+def _invalidate_before_delete(sender, instance, **kwargs):
+    """
+    Invalidates the content hashes of all instances which contain the given
+    schema model instance which is about to be deleted.
+    """
+    if isinstance(instance, SchemaModel):
+        invalidate_content_hashes(instance)
+
+pre_delete.connect(_invalidate_before_delete)
+
+
+def _model_graph_changed(sender, instance, action, model, **kwargs):
+    """
+    Increases the model graph revisions and invalidates the affected content
+    hashes when a many-to-many relation of a schema model instance has changed.
+    """
+    if isinstance(instance, SchemaModel) \
+            and action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_content_hashes(instance)
+        # the relation may have been changed from either side
+        increase_model_graph_revision(type(instance))
+        increase_model_graph_revision(model)
+
+m2m_changed.connect(_model_graph_changed)
+
+
+def _get_content_hash_models():
+    """
+    Returns a pair of the set of schema model classes which have a content_hash
+    field and the set of all schema model classes whose instances may be
+    contained in the XML serialization of instances of these model classes.
+    """
+    global _CONTENT_HASH_MODELS
+    if _CONTENT_HASH_MODELS is None:
+        _hashed = set(_model for _model in models.get_models()
+            if issubclass(_model, SchemaModel)
+                and 'content_hash' in _model._meta.get_all_field_names())
+        _contained = set()
+        _todo = list(_hashed)
+        while _todo:
+            _model = _todo.pop()
+            if _model in _contained:
+                continue
+            _contained.add(_model)
+            _todo.extend(_cls for _cls in _model.__subclasses__()
+                         if not _cls._meta.abstract and not _cls._meta.proxy)
+            for _field in _model._meta.fields:
+                if isinstance(_field, related.ForeignKey) \
+                        and not _field.name.startswith('back_to_'):
+                    _todo.append(_field.rel.to)
+            _todo.extend(_field.rel.to for _field in _model._meta.many_to_many)
+            _todo.extend(_rel.model for _rel
+                         in _model._meta.get_all_related_objects()
+                         if _rel.field.name.startswith('back_to_'))
+        _CONTENT_HASH_MODELS = (_hashed, set(_model for _model in _contained
+                                             if issubclass(_model, SchemaModel)))
+    return _CONTENT_HASH_MODELS
+
+
+def invalidate_content_hashes(instance):
+    """
+    Resets the content hash and the cached XML serialization of the given
+    schema model instance and of all instances which contain it, e.g., of a
+    person when its communication information or one of its affiliations has
+    changed.
+
+    The content hashes are recomputed on the next duplicate check, see
+    `SchemaModel._check_for_duplicates()`.
+    """
+    # pylint: disable-msg=W0212
+    from metashare.repository.model_utils import _get_referencing_ids
+    _hashed, _contained = _get_content_hash_models()
+    if type(instance) not in _contained:
+        return
+    _seen = set([(type(instance), instance.pk)])
+    _level = {type(instance): set([instance.pk])}
+    while _level:
+        _next_level = {}
+        for _model, _ids in _level.iteritems():
+            for _cls in [_model] + _model.__subclasses__():
+                for _id in _ids:
+                    OBJECT_XML_CACHE.pop(
+                        '{}_{}'.format(_cls.__name__.lower(), _id))
+            if _model in _hashed:
+                _model.objects.filter(pk__in=_ids).update(content_hash=None)
+            for _rel_model, _rel_ids in _get_referencing_ids(_model,
+                    list(_ids), only_models=_contained):
+                for _id in _rel_ids:
+                    if _id is not None and (_rel_model, _id) not in _seen:
+                        _seen.add((_rel_model, _id))
+                        _next_level.setdefault(_rel_model, set()).add(_id)
+        _level = _next_level
+
+
+def get_model_graph_revision(model_classes):
+    """
+    Returns the current revision of the schema model graph with respect to the
+    instances and relations of the given model classes.
+
+    Cached information which has been computed from instances of these model
+    classes is valid as long as the revision does not change. The revision
+    counters are kept in the Django cache, so changes made by other processes
+    are only noticed with a cache backend which is shared between all processes
+    (e.g., memcached), but not with a process local one like `LocMemCache`.
+    """
+    keys = sorted(_MODEL_GRAPH_REVISION_KEY.format(_model._meta.db_table)
+                  for _model in model_classes)
+    revisions = cache.get_many(keys)
+    for key in keys:
+        if revisions.get(key) is None:
+            # start from the current time so that a revision is not reused when
+            # the counter has been evicted from the cache
+            cache.add(key, int(time.time() * 1000))
+            revisions[key] = cache.get(key)
+    return md5(','.join(str(revisions[key]) for key in keys)).hexdigest()
+
+
+def increase_model_graph_revision(model_class):
+    """
+    Increases the revision of the schema model graph with respect to the given
+    model class and the model classes it inherits from, invalidating all cached
+    information which has been computed from instances of these model classes.
+    """
+    for _model in [model_class] + list(model_class._meta.get_parent_list()):
+        key = _MODEL_GRAPH_REVISION_KEY.format(_model._meta.db_table)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # the counter does not exist (anymore)
+            cache.add(key, int(time.time() * 1000))
+
+
+def _resolve_subclasses(objects):
+    """
+    Resolves the given `SubclassableModel` instances of a single class to their
+    most specific subclass instances with one query per subclass.
+
+    The resolved instance is remembered on each of the given instances so that
+    later calls of `as_subclass()` do not hit the database anymore. Returns the
+    list of resolved instances.
+    """
+    resolved = dict((obj.pk, obj) for obj in objects)
+    _cls = objects[0].__class__
+    for subclass in _cls.__subclasses__():
+        if subclass._meta.abstract or subclass._meta.proxy:
+            continue
+        _pks = resolved.keys()
+        children = []
+        for i in range(0, len(_pks), PREFETCH_CHUNK_SIZE):
+            children.extend(subclass._default_manager.filter(
+                pk__in=_pks[i:i + PREFETCH_CHUNK_SIZE]))
+        if children:
+            for child in _resolve_subclasses(children):
+                resolved[child.pk] = child
+    for obj in objects:
+        obj._subclass_instance = resolved[obj.pk]
+    return [obj._subclass_instance for obj in objects]
+
+
+def _prefetch_single_relation(objects, field):
+    """
+    Loads the targets of the given `ForeignKey`/`OneToOneField` for all given
+    instances with as few queries as possible and caches them on the instances.
+    """
+    _cache_name = field.get_cache_name()
+    _to_field = field.rel.field_name
+    _keys = list(set(getattr(obj, field.attname) for obj in objects
+                     if not hasattr(obj, _cache_name))
+                 - set((None,)))
+    _targets = {}
+    for i in range(0, len(_keys), PREFETCH_CHUNK_SIZE):
+        for target in field.rel.to._default_manager.filter(**{
+                '{}__in'.format(_to_field): _keys[i:i + PREFETCH_CHUNK_SIZE]}):
+            _targets[getattr(target, _to_field)] = target
+    for obj in objects:
+        if not hasattr(obj, _cache_name):
+            _key = getattr(obj, field.attname)
+            if _key is not None and _key in _targets:
+                setattr(obj, _cache_name, _targets[_key])
+
+
+def prefetch_schema_trees(objects):
+    """
+    Loads the complete trees of schema model instances below the given schema
+    model instances (e.g., resources) in a breadth-first manner.
+
+    All related objects are cached on their parent instances so that a
+    subsequent traversal of the trees via foreign keys, one-to-one fields,
+    many-to-many fields, reverse `*_set` managers and `as_subclass()` does not
+    hit the database anymore. The number of queries only depends on the
+    number of different relations in the trees and not on the number of given
+    instances.
+    """
+    _visited = set()
+    _level = list(objects)
+    while _level:
+        # group the instances of the current tree level by class, resolving
+        # subclassable instances to their most specific subclasses first
+        _groups = {}
+        for obj in _level:
+            if not isinstance(obj, SchemaModel) or obj.pk is None \
+                    or id(obj) in _visited:
+                continue
+            _visited.add(id(obj))
+            _groups.setdefault(obj.__class__, []).append(obj)
+        _resolved_groups = {}
+        for _cls, _objs in _groups.iteritems():
+            if issubclass(_cls, SubclassableModel):
+                _objs = _resolve_subclasses(_objs)
+            for obj in _objs:
+                _visited.add(id(obj))
+                _resolved_groups.setdefault(obj.__class__, []).append(obj)
+
+        _level = []
+        for _cls, _objs in _resolved_groups.iteritems():
+            for _field_name in _cls.get_fields_flat():
+                if _field_name.endswith('_set'):
+                    _many = True
+                else:
+                    try:
+                        field = _cls._meta.get_field(_field_name)
+                    except FieldDoesNotExist:
+                        continue
+                    if isinstance(field, ManyToManyField):
+                        _many = True
+                    elif isinstance(field, ForeignKey):
+                        _many = False
+                    else:
+                        continue
+                for i in range(0, len(_objs), PREFETCH_CHUNK_SIZE):
+                    _chunk = _objs[i:i + PREFETCH_CHUNK_SIZE]
+                    if _many:
+                        prefetch_related_objects(_chunk, [_field_name])
+                        for obj in _chunk:
+                            _level.extend(getattr(obj, _field_name).all())
+                    else:
+                        _prefetch_single_relation(_chunk, field)
+                        _cache_name = field.get_cache_name()
+                        _level.extend(getattr(obj, _cache_name, None)
+                                      for obj in _chunk)
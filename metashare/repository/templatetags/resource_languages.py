@@ -1,8 +1,9 @@
 from django import template
 
+from metashare.repository.model_utils import get_resource_language_names
 from metashare.repository.models import corpusInfoType_model, \
     toolServiceInfoType_model, lexicalConceptualResourceInfoType_model, \
-    languageDescriptionInfoType_model
+    languageDescriptionInfoType_model, resourceInfoType_model
 
 register = template.Library()
 
@@ -25,7 +26,11 @@ class ResourceLanguages(template.Node):
         result = []
         corpus_media = self.context_var.resolve(context)
     
-        if isinstance(corpus_media, corpusInfoType_model):
+        if isinstance(corpus_media, resourceInfoType_model):
+            # for resources we can use the precomputed facet summary
+            result = list(get_resource_language_names(corpus_media))
+
+        elif isinstance(corpus_media, corpusInfoType_model):
             media_type = corpus_media.corpusMediaType
             for corpus_info in media_type.corpustextinfotype_model_set.all():
                 result.extend([lang.languageName for lang in
@@ -83,7 +88,10 @@ class ResourceLanguages(template.Node):
 
 def resource_languages(parser, token):
     """
-    Use it like this: {% load_languages object.resourceComponentType.as_subclass %}
+    Use it like this: {% resource_languages object %}
+
+    The argument may either be a resource or the subclass instance of its
+    resource component type.
     """
     tokens = token.contents.split()
     if len(tokens) != 2:
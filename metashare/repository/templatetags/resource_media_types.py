@@ -1,8 +1,9 @@
 from django import template
 
+from metashare.repository.model_utils import get_resource_facets
 from metashare.repository.models import corpusInfoType_model, \
     toolServiceInfoType_model, lexicalConceptualResourceInfoType_model, \
-    languageDescriptionInfoType_model
+    languageDescriptionInfoType_model, resourceInfoType_model
 from metashare.settings import STATIC_URL
 
 register = template.Library()
@@ -26,7 +27,11 @@ class ResourceMediaTypes(template.Node):
         result = []
         corpus_media = self.context_var.resolve(context)
     
-        if isinstance(corpus_media, corpusInfoType_model):
+        if isinstance(corpus_media, resourceInfoType_model):
+            # for resources we can use the precomputed facet summary
+            result = list(get_resource_facets(corpus_media).media_types)
+
+        elif isinstance(corpus_media, corpusInfoType_model):
             media_type = corpus_media.corpusMediaType
             for corpus_info in media_type.corpustextinfotype_model_set.all():
                 result.append(corpus_info.mediaType)
@@ -106,7 +111,10 @@ class ResourceMediaTypes(template.Node):
 
 def resource_media_types(parser, token):
     """
-    Use it like this: {% load_languages object.resourceComponentType.as_subclass %}
+    Use it like this: {% resource_media_types object %}
+
+    The argument may either be a resource or the subclass instance of its
+    resource component type.
     """
     tokens = token.contents.split()
     if len(tokens) != 2:
@@ -2,6 +2,8 @@
 import logging
 import shutil
 import django.db.models
+from StringIO import StringIO
+from zipfile import ZipFile
 
 from django.contrib import admin
 from django.contrib.admin.sites import LOGIN_FORM_KEY
@@ -19,6 +21,7 @@ from metashare.repository import models
 from metashare.repository.editor.lookups import PersonLookup, ActorLookup, \
     DocumentationLookup, DocumentLookup, ProjectLookup, OrganizationLookup, \
     TargetResourceLookup
+from metashare.repository.model_utils import filter_by_lookup_index
 from metashare.repository.models import languageDescriptionInfoType_model, \
     lexicalConceptualResourceInfoType_model, personInfoType_model,\
     resourceInfoType_model
@@ -776,6 +779,30 @@ class EditorTest(TestCase):
         self.assertContains(response, 'Are you sure?', msg_prefix=
             'expected the superuser to be allowed to delete manager')
 
+    def test_superuser_can_export_resources(self):
+        """
+        Verifies that the XML export action streams a zip archive with the
+        metadata of all selected resources.
+        """
+        # make sure that the stored metadata of the published resource is set
+        EditorTest.testfixture3.storage_object.update_storage()
+        client = test_utils.get_client_with_user_logged_in(EditorTest.superuser_login)
+        response = client.post(ADMINROOT + 'repository/resourceinfotype_model/',
+            {"action": "export_xml_action", admin.ACTION_CHECKBOX_NAME:
+             [EditorTest.testfixture3.id, EditorTest.testfixture4.id]})
+        self.assertEqual('application/zip', response['Content-Type'])
+        _zip = ZipFile(StringIO(response.content))
+        _published = 'resource-{0}.xml'.format(
+            EditorTest.testfixture3.storage_object.id)
+        _internal = 'resource-{0}.xml'.format(
+            EditorTest.testfixture4.storage_object.id)
+        self.assertEqual(sorted([_published, _internal]), sorted(_zip.namelist()))
+        # the stored serialization of the published resource is reused
+        self.assertEqual(StorageObject.objects.get(
+                id=EditorTest.testfixture3.storage_object.id).metadata,
+            _zip.read(_published).decode('utf-8'))
+        self.assertIn('<resourceInfo', _zip.read(_internal))
+
 class LookupTest(TestCase):
     """
     Test the lookup functionalities
@@ -901,6 +928,30 @@ class LookupTest(TestCase):
         self.assertContains(response, 'Nice project',
             msg_prefix='a superuser must see the lookup for TargetResource.')
 
+    def test_lookup_index(self):
+        """
+        Verifies that the lookup index is kept in sync with the reusable
+        entities.
+        """
+        person = personInfoType_model.objects.create(
+            surname={'en': u'Zyxwvuts'}, givenName={'en': u'Test'})
+        person_id = person.id
+        persons = personInfoType_model.objects.all()
+        self.assertEqual([person_id],
+            [p.id for p in filter_by_lookup_index(persons, u'xwv')])
+        person.surname = {'en': u'Qwerty'}
+        person.save()
+        self.assertFalse(filter_by_lookup_index(persons, u'xwv').exists())
+        self.assertEqual([person_id],
+            [p.id for p in filter_by_lookup_index(persons, u'wert tes')])
+        # persons must be found as actors, too
+        self.assertTrue(filter_by_lookup_index(
+            models.actorInfoType_model.objects.all(), u'qwe') \
+                .filter(id=person_id).exists())
+        person.delete()
+        self.assertFalse(models.LookupIndexEntry.objects.filter(
+            model_name='actorInfoType_model', object_id=person_id).exists())
+
 
 class DataUploadTests(TestCase):
     """
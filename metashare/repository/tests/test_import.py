@@ -8,8 +8,10 @@ from django.test.client import Client
 from metashare import test_utils
 from metashare.accounts.models import EditorGroup
 from metashare.repository.models import documentUnstructuredString_model, \
-    documentInfoType_model
+    documentInfoType_model, personInfoType_model
 from metashare.settings import DJANGO_BASE, ROOT_PATH, LOG_HANDLER
+from metashare.storage.models import PUBLISHED, MASTER
+from metashare.xml_utils import bulk_import_from_file
 
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
@@ -73,6 +75,39 @@ class ImportTest(TestCase):
             'Could not import file {} -- successes is {}, failures is {}'
                 .format(xml_path, successes, failures))
 
+    def test_import_reuses_duplicate_persons(self):
+        """
+        Asserts that persons are found as duplicates via their content hash
+        when the same XML file is imported twice.
+        """
+        _path = '{}/repository/fixtures/testfixture.xml'.format(ROOT_PATH)
+        self._test_import_xml_file(_path)
+        _person_count = personInfoType_model.objects.count()
+        self._test_import_xml_file(_path)
+        self.assertEqual(_person_count, personInfoType_model.objects.count())
+        _hashes = personInfoType_model.objects.exclude(
+            content_hash__isnull=True).values_list('content_hash', flat=True)
+        self.assertTrue(len(_hashes) > 0)
+        for _hash in _hashes:
+            self.assertEqual(32, len(_hash))
+
+    def test_content_hash_is_reset_on_contained_changes(self):
+        """
+        Asserts that the content hash of a person is reset when only its
+        communication information is changed.
+        """
+        self._test_import_xml_file('{}/repository/fixtures/testfixture.xml'
+                                   .format(ROOT_PATH))
+        _person = personInfoType_model.objects.filter(
+            communicationInfo__isnull=False)[0]
+        _old_hash = _person.update_content_hash()
+        _comm_info = _person.communicationInfo
+        _comm_info.email = ['changed.address@example.org']
+        _comm_info.save()
+        _person = personInfoType_model.objects.get(pk=_person.pk)
+        self.assertIsNone(_person.content_hash)
+        self.assertNotEqual(_old_hash, _person.update_content_hash())
+
     def test_broken_xml(self):
         _currfile = '{}/repository/fixtures/broken.xml'.format(ROOT_PATH)
         successes, failures = test_utils.import_xml_or_zip(_currfile)
@@ -92,6 +127,28 @@ class ImportTest(TestCase):
         self.assertEqual(1, len(failures), 'Could not import file {} -- successes is {}, failures is {}'.format(_currfile, successes, failures))
         self.assertEquals('broken.xml', failures[0][0])
 
+    def test_bulk_import_zip(self):
+        _currfile = '{}/repository/fixtures/tworesources.zip'.format(ROOT_PATH)
+        with open(_currfile, 'rb') as _zip:
+            successes, failures = bulk_import_from_file(_zip, _currfile,
+                PUBLISHED, MASTER, batch_size=1)
+        self.assertEqual(2, len(successes), 'Could not import file {}'.format(_currfile))
+        self.assertEqual(0, len(failures), 'Could not import file {}'.format(_currfile))
+        for resource in successes:
+            self.assertEqual(PUBLISHED,
+                resource.storage_object.publication_status)
+            self.assertTrue(resource.storage_object.digest_checksum,
+                'The bulk imported resource must be stored completely.')
+
+    def test_bulk_import_broken_zip(self):
+        _currfile = '{}/repository/fixtures/onegood_onebroken.zip'.format(ROOT_PATH)
+        with open(_currfile, 'rb') as _zip:
+            successes, failures = bulk_import_from_file(_zip, _currfile,
+                PUBLISHED, MASTER)
+        self.assertEqual(1, len(successes), 'Could not import file {} -- successes is {}, failures is {}'.format(_currfile, successes, failures))
+        self.assertEqual(1, len(failures), 'Could not import file {} -- successes is {}, failures is {}'.format(_currfile, successes, failures))
+        self.assertEquals('broken.xml', failures[0][0])
+
     def test_import_bug_1(self):
         """
         This constellation caused an import error with a Postgres DB backend.
@@ -9,9 +9,17 @@ from xml.etree.ElementTree import fromstring, register_namespace
 
 from metashare import test_utils
 from metashare.repository.models import resourceInfoType_model, \
-    SCHEMA_NAMESPACE, lingualityInfoType_model
-from metashare.repository.model_utils import get_root_resources
+    SCHEMA_NAMESPACE, lingualityInfoType_model, ResourceFacets, \
+    personInfoType_model
+from metashare.repository.model_utils import get_root_resources, \
+    find_root_resources, \
+    get_resource_facets, get_resource_language_names, \
+    _get_resource_language_names, _get_resource_media_types, \
+    _get_resource_linguality_infos, _get_resource_license_types
+from metashare.repository.supermodel import OBJECT_XML_CACHE
 from metashare.settings import ROOT_PATH, LOG_HANDLER
+from metashare.storage.models import INTERNAL, PUBLISHED
+from metashare.utils import LRUCache
 from metashare.xml_utils import to_xml_string
 
 # Setup logging support.
@@ -114,6 +122,33 @@ class ModelTest(TestCase):
         num_after = lingualityInfoType_model.objects.all().count()
         self.assertEquals(num_before - 1, num_after)
 
+    def test_lru_cache(self):
+        cache = LRUCache(10)
+        cache['a'] = 'aaaa'
+        cache['b'] = 'bbbb'
+        self.assertEqual('aaaa', cache.get('a'))
+        # 'b' is now the least recently used entry and has to be evicted
+        cache['c'] = 'cccc'
+        self.assertFalse(cache.has_key('b'))
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(8, cache.size)
+        self.assertEqual({'entries': 2, 'size': 8, 'max_size': 10, 'hits': 1,
+                          'misses': 1, 'evictions': 1}, cache.get_stats())
+        # values larger than the cache are not cached at all
+        cache['d'] = 'd' * 11
+        self.assertFalse(cache.has_key('d'))
+        self.assertEqual(2, len(cache))
+
+    def test_xml_cache_invalidation(self):
+        resource = resourceInfoType_model.objects.get(pk=self.resource_id)
+        _xml = resource.get_canonical_xml()
+        self.assertEqual(_xml, resource.get_canonical_xml())
+        self.assertTrue(OBJECT_XML_CACHE.has_key(
+            'resourceinfotype_model_{}'.format(resource.id)))
+        resource.save()
+        self.assertFalse(OBJECT_XML_CACHE.has_key(
+            'resourceinfotype_model_{}'.format(resource.id)))
+
     def testImportExportRoundtrip1(self):
         """
         Checks that there is no data lost when exporting an imported XML.
@@ -225,3 +260,90 @@ class ModelUtilsTest(TestCase):
                 + list(self.test_res_2.contactPerson.all())
                 + [self.test_res_1.identificationInfo,
                    self.test_res_2.identificationInfo])))
+
+    def test_get_root_resources_cache(self):
+        """
+        Tests that the resources containing a model instance are cached until
+        the model graph changes on the way to the resources.
+        """
+        _person = personInfoType_model.objects.create(
+            surname={'en': u'Smith'})
+        self.assertSetEqual(set(), get_root_resources(_person))
+        self.assertEqual(0,
+            test_utils.count_queries(get_root_resources, _person))
+        # adding the person to a resource changes the model graph
+        self.test_res_2.contactPerson.add(_person)
+        self.assertSetEqual(set((self.test_res_2,)),
+            get_root_resources(_person))
+        # the cached answer only requires loading the resources
+        self.assertEqual(1,
+            test_utils.count_queries(get_root_resources, _person))
+        # changes of model instances which cannot be on the way from the person
+        # to its resources keep the cached answer
+        self.test_res_1.identificationInfo.save()
+        self.assertEqual(1,
+            test_utils.count_queries(get_root_resources, _person))
+
+    def test_find_root_resources_without_cache(self):
+        """
+        Tests that the resources containing a model instance are found even if
+        the cached answer is stale because another process changed the model
+        graph.
+        """
+        _person = personInfoType_model.objects.create(
+            surname={'en': u'Smith'})
+        self.assertSetEqual(set(), get_root_resources(_person))
+        # link the person without notifying this process
+        _field = resourceInfoType_model.contactPerson.field
+        resourceInfoType_model.contactPerson.through.objects.create(**{
+            _field.m2m_field_name(): self.test_res_2,
+            _field.m2m_reverse_field_name(): _person})
+        self.assertSetEqual(set(), get_root_resources(_person))
+        self.assertSetEqual(set((self.test_res_2,)),
+            find_root_resources(_person))
+
+    def test_resource_facets_of_internal_resources(self):
+        """
+        Tests that the facet summary of a resource which has been internal is
+        recomputed when the resource is published again.
+        """
+        _storage_object = self.test_res_1.storage_object
+        _storage_object.publication_status = INTERNAL
+        _storage_object.save()
+        _storage_object.update_storage()
+        self.assertFalse(
+            ResourceFacets.objects.filter(resource=self.test_res_1).exists(),
+            "The facet summary of an internal resource may become stale.")
+        _storage_object.publication_status = PUBLISHED
+        _storage_object.save()
+        _storage_object.update_storage()
+        self.assertTrue(
+            ResourceFacets.objects.filter(resource=self.test_res_1).exists(),
+            "The facet summary must be recomputed when publishing a resource.")
+
+    def test_resource_facets(self):
+        """
+        Tests that the facet summary of a resource is created on import and
+        matches the facet values computed from the resource model graph.
+        """
+        for res in (self.test_res_1, self.test_res_2):
+            self.assertTrue(
+                ResourceFacets.objects.filter(resource=res).exists(),
+                "The facet summary must be created when importing a resource.")
+            facets = get_resource_facets(res)
+            self.assertEqual(res.resourceComponentType.as_subclass() \
+                .resourceType, facets.resource_type)
+            self.assertListEqual(_get_resource_language_names(res),
+                                 facets.languages)
+            self.assertListEqual(_get_resource_media_types(res),
+                                 facets.media_types)
+            self.assertListEqual(_get_resource_linguality_infos(res),
+                                 facets.linguality_types)
+            self.assertListEqual(_get_resource_license_types(res),
+                                 facets.licences)
+        # a missing facet summary must be recreated on demand
+        ResourceFacets.objects.all().delete()
+        res = resourceInfoType_model.objects.get(pk=self.test_res_1.pk)
+        self.assertListEqual(_get_resource_language_names(res),
+                             get_resource_language_names(res))
+        self.assertTrue(ResourceFacets.objects.filter(resource=res).exists())
@@ -4,13 +4,15 @@ from metashare import settings, test_utils
 from metashare.repository.models import resourceInfoType_model
 from metashare.settings import ROOT_PATH, LOG_HANDLER
 from metashare.storage.models import StorageObject, restore_from_folder, \
-MASTER, INGESTED, INTERNAL, update_digests, compute_digest_checksum
+MASTER, INGESTED, INTERNAL, update_digests, compute_digest_checksum, \
+restore_storage_folders
 # pylint: disable-msg=E0611
 from hashlib import md5
 import os.path
 import zipfile
 from xml.etree.ElementTree import ParseError
 import shutil
+import tempfile
 import time
 import logging
 from zipfile import ZipFile
@@ -249,6 +251,35 @@ class RestoreTest(TestCase):
         resource.storage_object.delete()
         self.assertEqual(len(StorageObject.objects.all()), 0)
         self.assertEqual(len(resourceInfoType_model.objects.all()), 0)
+
+    def test_restore_storage_folders(self):
+        """
+        Tests restoring all storage folders with a checkpoint file.
+        """
+        _valid = '2e6ed4b0af2d11e192dc005056c00008ce474a763e0e4b618e01d15170593630'
+        _invalid = ['3b305b40af4311e18673005056c0000826bc07611017478d87046dca78d3c603',
+                    '4e1da1deaf4311e19ca7005056c00008cf98a6721df14cd5b52a307e57ec2b7a']
+        _checkpoint_dir = tempfile.mkdtemp()
+        _checkpoint = os.path.join(_checkpoint_dir, 'restore.checkpoint')
+        try:
+            restored, failed = restore_storage_folders(checkpoint=_checkpoint)
+            self.assertEqual([_valid], restored)
+            self.assertEqual(_invalid, sorted([_f for _f, _e in failed]))
+            self.assertEqual(len(resourceInfoType_model.objects.all()), 1)
+            # the restored folder is checkpointed, the failed ones are not
+            with open(_checkpoint, 'rb') as _in:
+                _done = [_line.strip() for _line in _in]
+            self.assertTrue(_valid in _done)
+            for _folder in _invalid:
+                self.assertFalse(_folder in _done)
+
+            # resuming only retries the failed folders
+            restored, failed = restore_storage_folders(checkpoint=_checkpoint)
+            self.assertEqual([], restored)
+            self.assertEqual(_invalid, sorted([_f for _f, _e in failed]))
+            self.assertEqual(len(resourceInfoType_model.objects.all()), 1)
+        finally:
+            shutil.rmtree(_checkpoint_dir)
    
      
 class UpdateTest(TestCase):
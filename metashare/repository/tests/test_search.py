@@ -1,19 +1,29 @@
 import os
 import logging
+from datetime import datetime
 
 from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test.client import Client
 from django.test.testcases import TestCase
 
+from haystack import connections, connection_router as router
 from haystack.query import SearchQuerySet
 
 from metashare import test_utils, settings
 from metashare.repository import views
+from metashare.repository.editor import admin_site
+from metashare.repository.editor.resource_editor import ResourceModelAdmin, \
+    change_resource_status
+from metashare.repository.models import resourceInfoType_model
+from metashare.repository.search_indexes import update_lr_index_entries, \
+    rebuild_lr_index, enqueue_lr_index_update, process_lr_index_updates
+from metashare.repository.supermodel import prefetch_schema_trees
 from metashare.settings import DJANGO_BASE, ROOT_PATH, LOG_HANDLER
 from metashare.stats.models import LRStats
-from metashare.storage.models import INGESTED, PUBLISHED
-from metashare.test_utils import create_user
+from metashare.storage.models import INGESTED, PUBLISHED, StorageObject, \
+    IndexUpdate
+from metashare.test_utils import create_user, count_queries
 
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
@@ -30,6 +40,9 @@ class SearchIndexUpdateTests(test_utils.IndexAwareTestCase):
     # paths to XML files containing test resources
     RES_PATH_1 = "{0}/repository/fixtures/roundtrip.xml".format(ROOT_PATH)
     RES_PATH_2 = "{0}/repository/fixtures/testfixture.xml".format(ROOT_PATH)
+    # the maximum number of queries for preparing the index document of a
+    # resource whose metadata has been prefetched
+    MAX_PREPARE_QUERIES = 10
     
     @classmethod
     def setUpClass(cls):
@@ -108,6 +121,123 @@ class SearchIndexUpdateTests(test_utils.IndexAwareTestCase):
         self.assertEqual(SearchQuerySet().count(), 0,
             "After a resource is deleted, the index must automatically change.")
 
+    def test_batched_index_update(self):
+        """
+        Verifies that the batched index update adds all given resources to the
+        index.
+        """
+        self.assert_index_is_empty()
+        for _path in (SearchIndexUpdateTests.RES_PATH_1,
+                      SearchIndexUpdateTests.RES_PATH_2):
+            resource = test_utils.import_xml(_path)
+            # publish the resource without triggering a reindexing
+            StorageObject.objects.filter(pk=resource.storage_object.pk) \
+                .update(publication_status=PUBLISHED)
+        self.assert_index_is_empty()
+        update_lr_index_entries(resourceInfoType_model.objects.all(),
+                                batch_size=1)
+        self.assertEqual(SearchQuerySet().count(), 2,
+            "After a batched index update all resources must be indexed.")
+
+    def test_queued_index_updates_are_coalesced(self):
+        """
+        Verifies that queued index updates of the same resource are coalesced
+        and pushed to the index when processing the queue.
+        """
+        self.assert_index_is_empty()
+        resource = test_utils.import_xml(SearchIndexUpdateTests.RES_PATH_1)
+        # publish the resource without triggering a reindexing
+        StorageObject.objects.filter(pk=resource.storage_object.pk) \
+            .update(publication_status=PUBLISHED)
+        enqueue_lr_index_update(resource)
+        enqueue_lr_index_update(resource)
+        self.assertEqual(IndexUpdate.objects.count(), 1,
+            "Repeated index updates of a resource must be coalesced.")
+        self.assert_index_is_empty()
+        self.assertEqual(process_lr_index_updates(), 1)
+        self.assertEqual(IndexUpdate.objects.count(), 0)
+        self.assertEqual(SearchQuerySet().count(), 1,
+            "After processing the queued index updates the resource must be "
+            "indexed.")
+
+    def test_rebuild_lr_index(self):
+        """
+        Verifies that the search index can be rebuilt completely and for
+        recently modified resources only.
+        """
+        self.assert_index_is_empty()
+        resources = []
+        for _path in (SearchIndexUpdateTests.RES_PATH_1,
+                      SearchIndexUpdateTests.RES_PATH_2):
+            resource = test_utils.import_xml(_path)
+            # publish the resource without triggering a reindexing
+            StorageObject.objects.filter(pk=resource.storage_object.pk) \
+                .update(publication_status=PUBLISHED)
+            resources.append(resource)
+        self.assert_index_is_empty()
+        call_command('rebuild_lr_index', processes=1, batch_size=1)
+        self.assertEqual(SearchQuerySet().count(), 2,
+            "After rebuilding the index all resources must be indexed.")
+        # delete one resource and unpublish the other one like the editor does
+        # but without triggering a reindexing
+        resources = [resourceInfoType_model.objects.get(pk=res.pk)
+                     for res in resources]
+        _since = datetime.now()
+        test_utils.set_index_active(False)
+        try:
+            ResourceModelAdmin(resourceInfoType_model, admin_site) \
+                .delete_model(None, resources[0])
+            change_resource_status(resources[1], INGESTED, PUBLISHED)
+        finally:
+            test_utils.set_index_active(True)
+        self.assertEqual(SearchQuerySet().count(), 2)
+        self.assertEqual(rebuild_lr_index(since=_since), 0,
+            "Deleted and unpublished resources must not be reindexed.")
+        self.assertEqual(SearchQuerySet().count(), 0,
+            "Reindexing changed resources must remove deleted and unpublished "
+            "resources.")
+        # publish the resource again without triggering a reindexing
+        _since = datetime.now()
+        test_utils.set_index_active(False)
+        try:
+            change_resource_status(resources[1], PUBLISHED, INGESTED)
+        finally:
+            test_utils.set_index_active(True)
+        self.assertEqual(rebuild_lr_index(since=_since), 1,
+            "Republished resources must be reindexed.")
+        self.assertEqual(SearchQuerySet().count(), 1)
+
+    def test_prefetched_index_update_query_count(self):
+        """
+        Verifies that preparing the index documents of prefetched resources
+        only requires a bounded number of queries per resource.
+        """
+        for _path in (SearchIndexUpdateTests.RES_PATH_1,
+                      SearchIndexUpdateTests.RES_PATH_2):
+            resource = test_utils.import_xml(_path)
+            resource.storage_object.publication_status = PUBLISHED
+            resource.storage_object.save()
+        _index = connections[router.for_write()].get_unified_index() \
+            .get_index(resourceInfoType_model)
+        # the number of queries without prefetching
+        _unbatched_count = count_queries(lambda: [_index.full_prepare(res)
+            for res in resourceInfoType_model.objects.all()])
+        # the number of queries with prefetching
+        resources = list(resourceInfoType_model.objects.all())
+        _prefetch_count = count_queries(prefetch_schema_trees, resources)
+        for resource in resources:
+            self.assertTrue(count_queries(_index.full_prepare, resource)
+                    <= SearchIndexUpdateTests.MAX_PREPARE_QUERIES,
+                "Preparing the index document of a prefetched resource must "
+                "not require more than {0} queries." \
+                .format(SearchIndexUpdateTests.MAX_PREPARE_QUERIES))
+        self.assertTrue(_prefetch_count + len(resources)
+                * SearchIndexUpdateTests.MAX_PREPARE_QUERIES
+                    < _unbatched_count,
+            "Prefetching must reduce the number of queries required for "
+            "preparing index documents ({0} prefetch queries, {1} queries "
+            "without prefetching).".format(_prefetch_count, _unbatched_count))
+
     def assert_index_is_empty(self):
         """
         Asserts that the search index is empty.
@@ -186,6 +316,7 @@ class SearchTest(test_utils.IndexAwareTestCase):
         # view the resource, then go back to the browse page and assert that the
         # view count has changed:
         client.get(test_res.get_absolute_url())
+        call_command('process_lr_index_updates')
         response = client.get(_SEARCH_PAGE_PATH)
         self.assertContains(response, 'title="Number of downloads" />&nbsp;0')
         self.assertContains(response, 'title="Number of views" />&nbsp;1')
@@ -193,6 +324,7 @@ class SearchTest(test_utils.IndexAwareTestCase):
         # assert that the view count has changed again:
         client.login(username='normaluser', password='secret')
         client.get(test_res.get_absolute_url())
+        call_command('process_lr_index_updates')
         response = client.get(_SEARCH_PAGE_PATH)
         self.assertContains(response, 'title="Number of downloads" />&nbsp;0')
         self.assertContains(response, 'title="Number of views" />&nbsp;2')
@@ -221,6 +353,7 @@ class SearchTest(test_utils.IndexAwareTestCase):
             reverse(views.download, args=(test_res.storage_object.identifier,)),
             { 'in_licence_agree_form': 'True', 'licence_agree': 'True',
               'licence': 'CC-BY-NC-SA' })
+        call_command('process_lr_index_updates')
         response = client.get(_SEARCH_PAGE_PATH)
         self.assertContains(response, 'title="Number of downloads" />&nbsp;1')
         self.assertContains(response, 'title="Number of views" />&nbsp;1')
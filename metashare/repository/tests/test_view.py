@@ -15,12 +15,13 @@ from django.utils.formats import date_format
 from metashare import test_utils, settings, xml_utils
 from metashare.accounts.models import UserProfile, EditorGroup, \
     EditorGroupManagers, Organization
-from metashare.repository import views
+from metashare.repository import model_utils, views
 from metashare.repository.models import resourceInfoType_model
-from metashare.repository.supermodel import OBJECT_XML_CACHE
+from metashare.repository.supermodel import OBJECT_XML_CACHE, \
+    prefetch_schema_trees
 from metashare.settings import DJANGO_BASE, ROOT_PATH, LOG_HANDLER, \
     TEST_MODE_NAME
-from metashare.test_utils import create_user
+from metashare.test_utils import create_user, count_queries
 from metashare.utils import prettify_camel_case_string
 
 
@@ -162,6 +163,9 @@ class ViewTest(TestCase):
     Test the single resource view
     """
     test_editor = None
+    # maximum number of database queries for rendering the single resource view
+    # in addition to the fixed number of queries for prefetching the metadata
+    MAX_VIEW_QUERIES = 40
     
     @classmethod
     def setUpClass(cls):
@@ -280,6 +284,61 @@ class ViewTest(TestCase):
         self.assertNotContains(response,
             "repository/resourceinfotype_model/{0}/".format(self.resource.id))
 
+    def test_prefetched_resource_export_needs_no_queries(self):
+        """
+        Tests that exporting a resource whose metadata tree has been loaded
+        with `prefetch_schema_trees()` does not hit the database anymore.
+        """
+        resource = resourceInfoType_model.objects.get(pk=self.resource.pk)
+        prefetch_schema_trees([resource])
+        self.assertEqual(0,
+            count_queries(resource.export_to_elementtree, True))
+
+    def test_resource_view_query_count(self):
+        """
+        Tests that the number of database queries for rendering the single
+        resource view is bounded.
+        """
+        client = Client()
+        url = self.resource.get_absolute_url()
+        # the first request sets up the session and the facet summary
+        client.get(url)
+        # the metadata sections have to be rendered from scratch again
+        resource = resourceInfoType_model.objects.get(pk=self.resource.pk)
+        model_utils.invalidate_resource_view_cache(resource.storage_object)
+        _view_queries = count_queries(client.get, url)
+        _prefetch_queries = count_queries(prefetch_schema_trees,
+            [resourceInfoType_model.objects.get(pk=self.resource.pk)])
+        self.assertTrue(
+            _view_queries <= _prefetch_queries + ViewTest.MAX_VIEW_QUERIES,
+            "The single resource view must not require more than {0} queries "
+            "besides the {1} prefetch queries (required {2}).".format(
+                ViewTest.MAX_VIEW_QUERIES, _prefetch_queries, _view_queries))
+        # the complete page must be cheaper than a non-prefetched export alone
+        self.assertTrue(_view_queries
+            < count_queries(resource.export_to_elementtree, True))
+
+    def test_resource_view_is_cached_per_revision(self):
+        """
+        Tests that the metadata sections of the single resource view are
+        cached until the storage object finds changed metadata.
+        """
+        client = Client()
+        url = self.resource.get_absolute_url()
+        response = client.get(url)
+        self.assertContains(response, 'Italian TTS Speech Corpus (Appen)')
+        # change the description without updating the storage object
+        identification_info = self.resource.identificationInfo
+        identification_info.description = {'en': 'A changed description'}
+        identification_info.save()
+        response = client.get(url)
+        self.assertNotContains(response, 'A changed description')
+        # updating the storage object invalidates the cached view
+        resource = resourceInfoType_model.objects.get(pk=self.resource.pk)
+        resource.storage_object.update_storage()
+        response = client.get(url)
+        self.assertContains(response, 'A changed description')
+
 
 class DownloadViewTest(TestCase):
     """
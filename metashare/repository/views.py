@@ -6,6 +6,7 @@ from urllib import urlopen
 from mimetypes import guess_type
 
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse
 from django.shortcuts import render_to_response, get_object_or_404, redirect
@@ -13,6 +14,7 @@ from django.template import RequestContext
 from django.contrib import messages
 from django.template.loader import render_to_string
 from django.core.mail import send_mail
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
 
 from haystack.views import FacetedSearchView
@@ -24,19 +26,25 @@ from metashare.repository.forms import LicenseSelectionForm, \
 from metashare.repository import model_utils
 from metashare.repository.models import licenceInfoType_model, \
     resourceInfoType_model
-from metashare.repository.search_indexes import resourceInfoType_modelIndex, \
-    update_lr_index_entry
-from metashare.settings import LOG_HANDLER, STATIC_URL, DJANGO_URL
+from metashare.repository.search_indexes import resourceInfoType_modelIndex
+from metashare.repository.supermodel import prefetch_schema_trees
+from metashare.settings import LOG_HANDLER, STATIC_URL, DJANGO_URL, \
+    RESOURCE_VIEW_CACHE_TIMEOUT
 from metashare.stats.model_utils import getLRStats, saveLRStats, \
     saveQueryStats, VIEW_STAT, DOWNLOAD_STAT
 from metashare.storage.models import PUBLISHED
 from metashare.recommendations.recommendations import SessionResourcesTracker, \
     get_download_recommendations, get_view_recommendations, \
-    get_more_from_same_creators_qs, get_more_from_same_projects_qs
+    get_more_from_same_creators_qs, get_more_from_same_projects_qs, \
+    get_precomputed_recommendations
 
 
 MAXIMUM_READ_BLOCK_SIZE = 4096
 
+# maximum number of 'also viewed'/'also downloaded' recommendations shown in the
+# single resource view
+MAX_RECOMMENDATIONS = 4
+
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(LOG_HANDLER)
@@ -317,14 +325,13 @@ def _update_download_stats(resource, request):
     Updates all relevant statistics counters for a the given successful resource
     download request.
     """
-    # maintain general download statistics
-    if saveLRStats(resource, DOWNLOAD_STAT, request):
-        # update download count in the search index, too
-        update_lr_index_entry(resource)
+    # maintain general download statistics; the update of the download count
+    # in the search index is scheduled when the buffered event is written
+    saveLRStats(resource, DOWNLOAD_STAT, request)
     # update download tracker
     tracker = SessionResourcesTracker.getTracker(request)
     tracker.add_download(resource, datetime.now())
-    request.session['tracker'] = tracker
+    tracker.save(request)
 
 
 @login_required
@@ -405,16 +412,25 @@ def download_contact(request, object_id):
                         dictionary, context_instance=RequestContext(request))
 
 
-def view(request, resource_name=None, object_id=None):
+def _get_resource_view_fragment(resource):
     """
-    Render browse or detail view for the repository application.
+    Returns the part of the single resource view context which only depends on
+    the metadata of the given resource, including the rendered metadata
+    sections of the page.
+
+    The result is cached per revision of the resource; the cache entry is
+    removed whenever `StorageObject.update_storage()` finds that the metadata
+    has changed.
     """
-    # only published resources may be viewed
-    resource = get_object_or_404(resourceInfoType_model,
-                                 storage_object__identifier=object_id,
-                                 storage_object__publication_status=PUBLISHED)
-    if request.path_info != resource.get_absolute_url():
-        return redirect(resource.get_absolute_url())
+    _cache_key = model_utils.get_resource_view_cache_key(
+        resource.storage_object)
+    fragment = cache.get(_cache_key)
+    if fragment is not None:
+        return fragment
+
+    # Load the complete metadata tree of the resource with a fixed number of
+    # queries; all following traversals of the tree use the cached objects.
+    prefetch_schema_trees([resource])
 
     # Convert resource to ElementTree and then to template tuples.
     lr_content = _convert_to_template_tuples(
@@ -433,10 +449,11 @@ def view(request, resource_name=None, object_id=None):
     url = resource.identificationInfo.url
     metashare_id = resource.identificationInfo.metaShareId
     identifier = resource.identificationInfo.identifier
-    resource_type = resource.resourceComponentType.as_subclass().resourceType
-    media_types = set(model_utils.get_resource_media_types(resource))
-    linguality_infos = set(model_utils.get_resource_linguality_infos(resource))
-    license_types = set(model_utils.get_resource_license_types(resource))
+    facets = model_utils.get_resource_facets(resource)
+    resource_type = facets.resource_type
+    media_types = set(media_type.lower() for media_type in facets.media_types)
+    linguality_infos = set(facets.linguality_types)
+    license_types = set(facets.licences)
 
     
     distribution_info_tuple = None
@@ -574,7 +591,7 @@ def view(request, resource_name=None, object_id=None):
         resource_component_dicts['toolService'] = \
           resource_component_dict['Resource_component']
    
-    # Define context for template rendering.
+    # Define context for rendering the metadata sections.
     context = {
                 'contact_person_dicts': contact_person_dicts,
                 'description': description,
@@ -590,7 +607,6 @@ def view(request, resource_name=None, object_id=None):
                 'other_descriptions': other_descriptions,
                 'relation_dicts': relation_dicts,
                 'res_short_names': res_short_names,
-                'resource': resource,
                 'resource_component_dicts': resource_component_dicts,
                 'resource_component_dict': resource_component_dict,
                 'resourceName': resource_name,
@@ -603,6 +619,36 @@ def view(request, resource_name=None, object_id=None):
                 'text_counts': text_counts,
                 'video_counts': video_counts,
               }
+
+    # Only keep what is needed around the rendered metadata sections.
+    fragment = dict((key, context[key]) for key in ('description',
+        'identifier', 'license_types', 'linguality_infos', 'mediaTypes',
+        'metaShareId', 'other_descriptions', 'other_res_names',
+        'res_short_names', 'resourceName', 'resourceType', 'url'))
+    fragment['availability'] = \
+        resource.distributionInfo.get_availability_display()
+    fragment['metadata_html'] = render_to_string(
+        'repository/resource_view/lr_view_metadata.html', context)
+    cache.set(_cache_key, fragment, RESOURCE_VIEW_CACHE_TIMEOUT)
+    return fragment
+
+
+
+def view(request, resource_name=None, object_id=None):
+    """
+    Render browse or detail view for the repository application.
+    """
+    # only published resources may be viewed
+    resource = get_object_or_404(
+        resourceInfoType_model.objects.select_related('storage_object'),
+        storage_object__identifier=object_id,
+        storage_object__publication_status=PUBLISHED)
+    if request.path_info != resource.get_absolute_url():
+        return redirect(resource.get_absolute_url())
+
+    context = dict(_get_resource_view_fragment(resource))
+    context['metadata_html'] = mark_safe(context['metadata_html'])
+    context['resource'] = resource
     template = 'repository/resource_view/lr_view.html'
 
     # For users who have edit permission for this resource, we have to add 
@@ -613,30 +659,37 @@ def view(request, resource_name=None, object_id=None):
             'admin:repository_resourceinfotype_model_change', \
               args=(resource.id,))
 
-    # Update statistics:
-    if saveLRStats(resource, VIEW_STAT, request):
-        # update view count in the search index, too
-        update_lr_index_entry(resource)
+    # Update statistics; the update of the view count in the search index is
+    # scheduled when the buffered event is written
+    saveLRStats(resource, VIEW_STAT, request)
     # update view tracker
     tracker = SessionResourcesTracker.getTracker(request)
     tracker.add_view(resource, datetime.now())
-    request.session['tracker'] = tracker
+    tracker.save(request)
 
     # Add download/view/last updated statistics to the template context.
     context['LR_STATS'] = getLRStats(resource.storage_object.identifier)
             
-    # Add recommendations for 'also viewed' resources
-    context['also_viewed'] = \
-        _format_recommendations(get_view_recommendations(resource))
-    # Add recommendations for 'also downloaded' resources
-    context['also_downloaded'] = \
-        _format_recommendations(get_download_recommendations(resource))
+    # Add recommendations for 'also viewed' and 'also downloaded' resources;
+    # the precomputed recommendations are used if available
+    recommendations = get_precomputed_recommendations(resource,
+                                                      MAX_RECOMMENDATIONS)
+    if recommendations is None:
+        recommendations = (
+            get_view_recommendations(resource, MAX_RECOMMENDATIONS),
+            get_download_recommendations(resource, MAX_RECOMMENDATIONS),
+            get_more_from_same_projects_qs(resource).exists(),
+            get_more_from_same_creators_qs(resource).exists())
+    also_viewed, also_downloaded, same_projects, same_creators = \
+        recommendations
+    context['also_viewed'] = _format_recommendations(also_viewed)
+    context['also_downloaded'] = _format_recommendations(also_downloaded)
     # Add 'more from same' links
-    if get_more_from_same_projects_qs(resource).count():
+    if same_projects:
         context['search_rel_projects'] = '{}/repository/search?q={}:{}'.format(
             DJANGO_URL, MORE_FROM_SAME_PROJECTS,
             resource.storage_object.identifier)
-    if get_more_from_same_creators_qs(resource).count():
+    if same_creators:
         context['search_rel_creators'] = '{}/repository/search?q={}:{}'.format(
             DJANGO_URL, MORE_FROM_SAME_CREATORS,
             resource.storage_object.identifier)
@@ -701,10 +754,11 @@ def _format_recommendations(recommended_resources):
     dictionaries with the two keys "name" and "url" (for use in the single
     resource view).
     
-    The number of returned recommendations is restricted to at most 4.
+    The number of returned recommendations is restricted to at most
+    `MAX_RECOMMENDATIONS`.
     '''
     result = []
-    for res in recommended_resources[:4]:
+    for res in recommended_resources[:MAX_RECOMMENDATIONS]:
         res_item = {}
         res_item['name'] = res.__unicode__()
         res_item['url'] = res.get_absolute_url()
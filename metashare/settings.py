@@ -4,6 +4,7 @@ ROOT_PATH = abspath(dirname(__file__))
 import os
 import logging
 from logging.handlers import RotatingFileHandler
+from multiprocessing import cpu_count
 
 # Import local settings, i.e., DEBUG, TEMPLATE_DEBUG, TIME_ZONE,
 # DATABASE_* settings, ADMINS, etc.
@@ -53,6 +54,52 @@ MAXIMUM_UPLOAD_SIZE = 10 * 1024 * 1024
 # Synchronization info:
 SYNC_NEEDS_AUTHENTICATION = True
 
+# Maximum number of resources which are downloaded concurrently from other
+# META-SHARE nodes during synchronization; changes to the local storage are
+# always serialized.
+SYNC_WORKERS = 4
+
+# Number of worker processes which re-create outdated resource digests in the
+# `update_digests` command.
+DIGEST_WORKERS = cpu_count()
+
+# Number of resources whose metadata is requested at once from other META-SHARE
+# nodes which support sync protocol 2.0.
+SYNC_BATCH_SIZE = 50
+
+# Number of resources whose metadata is loaded and sent to the search index at
+# once when (re-)building the search index.
+INDEX_BATCH_SIZE = 100
+
+# Number of worker processes which build search index documents in the
+# `rebuild_lr_index` command.
+INDEX_WORKERS = cpu_count()
+
+# Maximum number of bytes of serialised metadata XML which is kept in memory
+# for finding duplicates when importing resources.
+OBJECT_XML_CACHE_SIZE = 32 * 1024 * 1024
+
+# Number of seconds for which the metadata dependent parts of the single
+# resource view of a resource revision are cached.
+RESOURCE_VIEW_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Maximum number of seconds for which the resources containing a model instance
+# (e.g., a person or an organization) are cached. The cached information is
+# dropped whenever an instance of a model class on the way to the resources
+# changes. This requires a cache backend which is shared between all processes
+# (e.g., memcached); with a process local cache like the default LocMemCache,
+# other processes only notice such changes after this timeout. Access decisions
+# never rely on the cached information.
+ROOT_RESOURCES_CACHE_TIMEOUT = 10 * 60
+
+# Maximum number of resource view/download statistics events which are
+# collected in memory before they are written to the database at once.
+LR_STATS_BUFFER_SIZE = 200
+
+# Maximum number of seconds for which resource view/download statistics events
+# are kept in memory before they are written to the database.
+LR_STATS_FLUSH_INTERVAL = 60
+
 
 # URL for the Metashare Knowledge Base
 KNOWLEDGE_BASE_URL = 'http://www.meta-share.org/portal/knowledgebase/'
@@ -251,8 +298,29 @@ MAX_VIEW_INTERVAL = 60 * 5
 # used in recommendations
 MAX_DOWNLOAD_INTERVAL = 60 * 10
 
-# list of synchronization protocols supported by this node
+# maximum number of 'together' counter increments which are collected in memory
+# before they are written to the database; used in recommendations
+RECOMMENDATION_BUFFER_SIZE = 100
+
+# maximum time interval in seconds for which 'together' counter increments are
+# kept in memory before they are written to the database; used in
+# recommendations
+RECOMMENDATION_FLUSH_INTERVAL = 60
+
+# time interval in seconds after which the in-memory 'together' counts are
+# reloaded from the database to include the increments of other processes;
+# used in recommendations
+RECOMMENDATION_REFRESH_INTERVAL = 60 * 5
+
+# number of 'also viewed', 'also downloaded', 'same creators' and 'same
+# projects' recommendations which are precomputed per resource by the
+# `build_recommendations` command; used in recommendations
+RECOMMENDATION_TOP_K = 10
+
+# list of synchronization protocols supported by this node, in the order of
+# preference; protocol 2.0 adds incremental inventories
 SYNC_PROTOCOLS = (
+    '2.0',
     '1.0',
 )
 
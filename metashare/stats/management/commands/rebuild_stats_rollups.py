@@ -0,0 +1,20 @@
+"""
+Management utility to rebuild the daily rollups of the resource and query
+statistics from the raw statistics records.
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from metashare.stats.model_utils import rebuild_stats_rollups
+
+
+class Command(BaseCommand):
+
+    help = 'Rebuilds the daily rollups of the resource and query statistics'
+
+    def handle(self, *args, **options):
+        """
+        Rebuild the statistics rollups.
+        """
+        with transaction.commit_on_success():
+            rebuild_stats_rollups()
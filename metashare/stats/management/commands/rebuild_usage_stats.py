@@ -0,0 +1,62 @@
+"""
+Management utility to rebuild the metadata usage statistics of all published
+resources.
+"""
+import logging
+from xml.etree.ElementTree import fromstring
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from metashare import settings
+from metashare.repository.models import resourceInfoType_model
+from metashare.stats.model_utils import update_usage_stats
+from metashare.stats.models import UsageStats
+from metashare.storage.models import PUBLISHED
+from metashare.xml_utils import get_resource_xml
+
+# Setup logging support.
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(settings.LOG_HANDLER)
+
+# number of resources after which the progress is reported
+_PROGRESS_INTERVAL = 100
+
+
+class Command(BaseCommand):
+
+    help = 'Rebuilds the metadata usage statistics of all published resources'
+
+    def handle(self, *args, **options):
+        """
+        Rebuild the usage statistics.
+        """
+        _resources = resourceInfoType_model.objects.filter(
+                storage_object__publication_status=PUBLISHED,
+                storage_object__deleted=False) \
+            .select_related('storage_object')
+        _total = _resources.count()
+        self.stdout.write('Rebuilding the usage statistics of {} resources.\n'
+                          .format(_total))
+        with transaction.commit_on_success():
+            UsageStats.objects.all().delete()
+        _done = 0
+        _failed = 0
+        for _resource in _resources.iterator():
+            try:
+                # the stored metadata XML is parsed instead of exporting the
+                # resource from the database again
+                with transaction.commit_on_success():
+                    update_usage_stats(_resource.storage_object.identifier,
+                        fromstring(get_resource_xml(_resource)))
+            # pylint: disable-msg=W0703
+            except Exception:
+                _failed += 1
+                LOGGER.error('Failed to rebuild the usage statistics of '
+                    'resource {}.'.format(_resource.id), exc_info=True)
+            _done += 1
+            if _done % _PROGRESS_INTERVAL == 0:
+                self.stdout.write('{}/{} resources done.\n'
+                                  .format(_done, _total))
+        self.stdout.write('Rebuilt the usage statistics of {}/{} resources.\n'
+                          .format(_done - _failed, _total))
@@ -1,15 +1,22 @@
+import atexit
 import logging
 import json
 import itertools 
 import threading
 import re
-from django.db.models import Count, Sum
+from collections import Counter
+from datetime import datetime, timedelta
+from django import db
+from django.db import transaction, IntegrityError
+from django.db.models import Count, Sum, Max, F
 from django.contrib.auth.models import User
 from math import trunc
-from metashare.stats.models import LRStats, QueryStats, UsageStats
+from metashare.stats.models import LRStats, QueryStats, UsageStats, \
+    LRStatsDaily, QueryStatsDaily
 from metashare.stats.geoip import getcountry_code, getcountry_name
-from metashare.storage.models import PUBLISHED
-from metashare.settings import LOG_HANDLER
+from metashare.storage.models import PUBLISHED, IndexUpdate
+from metashare.settings import LOG_HANDLER, LR_STATS_BUFFER_SIZE, \
+    LR_STATS_FLUSH_INTERVAL
 
 USAGETHREADNAME = "usagethread"
 BOT_AGENT_RE = re.compile(r".*(bot|spider|spyder|crawler|archiver|seek|\
@@ -29,11 +36,30 @@ DELETE_STAT = "e"
 STAT_LABELS = {UPDATE_STAT: "update", VIEW_STAT: "view", RETRIEVE_STAT: "retrieve", \
     DOWNLOAD_STAT: "download", PUBLISH_STAT: "publish", INGEST_STAT: "ingest", DELETE_STAT: "delete"}
 VISIBLE_STATS = [UPDATE_STAT, VIEW_STAT, RETRIEVE_STAT, DOWNLOAD_STAT]
+# actions which are not written immediately but collected by the write-behind
+# buffer below
+BUFFERED_STATS = (VIEW_STAT, DOWNLOAD_STAT)
     
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(LOG_HANDLER)
 
+# maximum number of records per bulk insert; keeps the number of query
+# parameters below the limit of SQLite
+BULK_INSERT_SIZE = 100
+
+# pending view/download events of this process; maps (userid, lrid, sessid,
+# action) keys to dictionaries with the event details
+_PENDING_LR_STATS = {}
+_PENDING_LR_STATS_LOCK = threading.RLock()
+# the time of the oldest pending event
+_PENDING_LR_STATS_SINCE = None
+# the name of the timer threads which flush the buffer of this process at the
+# latest `LR_STATS_FLUSH_INTERVAL` seconds after an event has been added to the
+# empty buffer, even if no further events arrive; events of a process which is
+# killed before the next flush are lost
+FLUSHTHREADNAME = "lrstatsflushthread"
+
 
 def saveLRStats(resource, action, request=None): 
     """
@@ -51,24 +77,38 @@ def saveLRStats(resource, action, request=None):
     # Manage statistics according with the resource status
     lrid = resource.storage_object.identifier
     ignored = False
+    if action in (INGEST_STAT, DELETE_STAT):
+        # pending events must not be written after the changes below; they are
+        # handled within the transaction of the caller which must not be
+        # committed early by a flush
+        _events = _take_pending_lr_stats(lrid)
+        if action == INGEST_STAT and _events:
+            _write_lr_stats(_events)
     if action == INGEST_STAT:
         ignored = True
         LRStats.objects.filter(lrid=lrid).update(ignored=ignored)
+        _rebuild_lr_rollups(lrid)
         UsageStats.objects.filter(lrid=lrid).delete()
     if action == DELETE_STAT:
         UsageStats.objects.filter(lrid=lrid).delete()
         LRStats.objects.filter(lrid=lrid).delete()
+        LRStatsDaily.objects.filter(lrid=lrid).delete()
         return result
     if (resource.storage_object.publication_status != PUBLISHED):
         return result
         
     userid = _get_userid(request)
     sessid = _get_sessionid(request)
+    if action in BUFFERED_STATS:
+        return _buffer_lr_stat(userid, lrid, sessid, action, request)
     lrset = LRStats.objects.filter(userid=userid, lrid=lrid, sessid=sessid, action=action)
     if (lrset.count() > 0):
         record = lrset[0]
+        rollup_changed = record.ignored != ignored
         record.ignored = ignored
         record.save(force_update=True)
+        if rollup_changed:
+            _rebuild_lr_rollups(lrid)
         #LOGGER.debug('UPDATESTATS: Saved LR {0}, {1} action={2} ({3}).'.format(lrid, sessid, action, record.lasttime))
     else:       
         record = LRStats()
@@ -79,15 +119,185 @@ def saveLRStats(resource, action, request=None):
         record.geoinfo = getcountry_code(_get_ipaddress(request))
         record.ignored = ignored
         record.save(force_insert=True)
+        _add_to_lr_rollups([record])
         #LOGGER.debug('SAVESTATS: Saved LR {0}, {1} action={2}.'.format(lrid, sessid, action))
         result = True
     if action == UPDATE_STAT:
         if (resource.storage_object.published):
-            UsageStats.objects.filter(lrid=lrid).delete()
             update_usage_stats(lrid, resource.export_to_elementtree())
             #LOGGER.debug('STATS: Updating usage statistics: resource {0} updated'.format(lrid))
     return result
 
+def _buffer_lr_stat(userid, lrid, sessid, action, request):
+    """
+    Adds a view/download event to the write-behind buffer of this process.
+
+    Just like a direct write, only the first event per user, resource, session
+    and action is counted. Returns whether the event will increment the stats
+    counter or not. The buffer is flushed when it is full, at the latest
+    `LR_STATS_FLUSH_INTERVAL` seconds after its oldest event by a timer thread
+    and when the process terminates regularly.
+    """
+    global _PENDING_LR_STATS_SINCE
+    key = (userid, lrid, sessid, action)
+    with _PENDING_LR_STATS_LOCK:
+        pending = key in _PENDING_LR_STATS
+    if pending:
+        return False
+    # the GeoIP lookup is deferred until the event is actually written
+    event = {'ipaddress': _get_ipaddress(request), 'lasttime': datetime.now(),
+             'new': True}
+    existing = LRStats.objects.filter(userid=userid, lrid=lrid, sessid=sessid,
+                    action=action).values_list('ignored', flat=True)[:1]
+    if existing:
+        if not existing[0]:
+            # nothing to write: the event has been counted before
+            return False
+        # a counted event of an ingested resource has to be re-activated
+        event['new'] = False
+    with _PENDING_LR_STATS_LOCK:
+        if key in _PENDING_LR_STATS:
+            return False
+        _PENDING_LR_STATS[key] = event
+        if _PENDING_LR_STATS_SINCE is None:
+            _PENDING_LR_STATS_SINCE = event['lasttime']
+            _start_flush_timer()
+        flush = len(_PENDING_LR_STATS) >= LR_STATS_BUFFER_SIZE \
+            or event['lasttime'] - _PENDING_LR_STATS_SINCE \
+                >= timedelta(seconds=LR_STATS_FLUSH_INTERVAL)
+    if flush:
+        flush_lr_stats()
+    return event['new']
+
+
+def flush_lr_stats():
+    """
+    Writes all view/download events of the write-behind buffer of this process
+    to the database.
+
+    New events are inserted in bulk and the search index entries of their
+    resources are scheduled for an update. Must not be called within another
+    transaction as the events are committed in a transaction of their own. If
+    the events cannot be written, then they are put back into the buffer.
+    Returns the number of written events.
+    """
+    events = _take_pending_lr_stats()
+    if not events:
+        return 0
+    try:
+        with transaction.commit_on_success():
+            _write_lr_stats(events)
+    except db.DatabaseError:
+        LOGGER.error('Failed to write {0} statistics events; they will be '
+                     'retried with the next flush.'.format(len(events)),
+                     exc_info=True)
+        _put_back_pending_lr_stats(events)
+        return 0
+    LOGGER.debug('Wrote {0} buffered statistics events.'.format(len(events)))
+    return len(events)
+
+
+def _take_pending_lr_stats(lrid=None):
+    """
+    Removes the pending view/download events of the resource with the given
+    storage object identifier (or of all resources if no identifier is given)
+    from the write-behind buffer of this process and returns them.
+    """
+    global _PENDING_LR_STATS_SINCE
+    with _PENDING_LR_STATS_LOCK:
+        if lrid is None:
+            events = _PENDING_LR_STATS.copy()
+        else:
+            events = dict((key, event) for key, event
+                          in _PENDING_LR_STATS.iteritems() if key[1] == lrid)
+        for key in events:
+            del _PENDING_LR_STATS[key]
+        if not _PENDING_LR_STATS:
+            _PENDING_LR_STATS_SINCE = None
+    return events
+
+
+def _put_back_pending_lr_stats(events):
+    """
+    Puts the given view/download events which could not be written back into
+    the write-behind buffer of this process.
+    """
+    global _PENDING_LR_STATS_SINCE
+    with _PENDING_LR_STATS_LOCK:
+        for key, event in events.iteritems():
+            _PENDING_LR_STATS.setdefault(key, event)
+        if _PENDING_LR_STATS_SINCE is None:
+            _PENDING_LR_STATS_SINCE = datetime.now()
+            _start_flush_timer()
+
+
+def _write_lr_stats(events):
+    """
+    Writes the given view/download events to the database within the current
+    transaction.
+    """
+    new_keys = set(key for key, event in events.iteritems() if event['new'])
+    if new_keys:
+        # another process may have written some of the events in the meantime
+        new_keys.difference_update(LRStats.objects.filter(
+                lrid__in=set(key[1] for key in new_keys),
+                sessid__in=set(key[2] for key in new_keys),
+                action__in=BUFFERED_STATS) \
+            .values_list('userid', 'lrid', 'sessid', 'action'))
+    records = [LRStats(userid=key[0], lrid=key[1], sessid=key[2],
+            action=key[3], lasttime=events[key]['lasttime'],
+            geoinfo=getcountry_code(events[key]['ipaddress']))
+        for key in new_keys]
+    _bulk_insert(LRStats, records)
+    _add_to_lr_rollups(records)
+    reactivated_lrids = set()
+    for key, event in events.iteritems():
+        if not event['new']:
+            LRStats.objects.filter(userid=key[0], lrid=key[1],
+                sessid=key[2], action=key[3]).update(ignored=False)
+            reactivated_lrids.add(key[1])
+    for lrid in reactivated_lrids:
+        _rebuild_lr_rollups(lrid)
+    for lrid in set(key[1] for key in new_keys):
+        # the view/download counts are part of the search index
+        IndexUpdate.objects.get_or_create(identifier=lrid)
+
+
+def _start_flush_timer():
+    """
+    Starts a timer thread which flushes the write-behind buffer of this process
+    after `LR_STATS_FLUSH_INTERVAL` seconds.
+    """
+    timer = threading.Timer(LR_STATS_FLUSH_INTERVAL, _timed_flush_lr_stats)
+    timer.setName(FLUSHTHREADNAME)
+    # the timer must not keep the process alive; the remaining events are
+    # flushed on exit, see below
+    timer.daemon = True
+    timer.start()
+
+
+def _timed_flush_lr_stats():
+    """
+    Flushes the write-behind buffer of this process from a timer thread.
+    """
+    try:
+        flush_lr_stats()
+    finally:
+        # the database connection of the timer thread is not needed anymore
+        db.close_connection()
+
+def _bulk_insert(model, records):
+    """
+    Inserts the given records of the given model with as few queries as
+    possible.
+    """
+    for i in xrange(0, len(records), BULK_INSERT_SIZE):
+        model.objects.bulk_create(records[i:i + BULK_INSERT_SIZE])
+
+# make sure that no events are lost when the process terminates regularly
+atexit.register(flush_lr_stats)
+
+
 def saveQueryStats(query, facets, found, exectime=0, request=None): 
     stat = QueryStats()
     stat.userid = _get_userid(request)
@@ -97,23 +307,110 @@ def saveQueryStats(query, facets, found, exectime=0, request=None):
     stat.found = found
     stat.exectime = exectime    
     stat.save()
+    _add_to_query_rollups([stat])
     LOGGER.debug(u'saveQueryStats q={0}.'.format(query))
 
-def getLRStats(lrid):
-    data = ""
-    action_list = LRStats.objects.values('lrid', 'action').filter(lrid=lrid, ignored=False).annotate(Count('action'), Sum('count')).order_by('-action')
-    if (action_list.count() > 0):
-        for key in action_list:
-            sets = LRStats.objects.values('lasttime').filter(lrid=lrid, action=str(key['action'])).order_by('-lasttime')[:1]
-            for key2 in sets:
-                if str(key['action']) in VISIBLE_STATS:
-                    if (len(data) > 0):
-                        data += ", "
-                    data += "{\"action\":\""+ STAT_LABELS[str(key['action'])] +"\",\"count\":\""+ \
-                        str(key['count__sum']) +"\",\"last\":\""+str(key2['lasttime'])[:10]+"\"}"
-                    break    
-    return json.loads("["+data+"]")
 
+def _add_to_lr_rollups(records):
+    """
+    Adds the given newly saved `LRStats` records to the daily rollup.
+    """
+    totals = {}
+    for record in records:
+        key = (record.lasttime.date(), record.lrid, record.action,
+               record.geoinfo or u'', record.ignored)
+        _records, _count = totals.get(key, (0, 0))
+        totals[key] = (_records + 1, _count + record.count)
+    for (day, lrid, action, geoinfo, ignored), (_records, _count) \
+            in totals.iteritems():
+        _add_to_rollup(LRStatsDaily, {'day': day, 'lrid': lrid,
+                'action': action, 'geoinfo': geoinfo, 'ignored': ignored},
+            {'records': _records, 'count': _count})
+
+
+def _add_to_rollup(model, key, increments):
+    """
+    Adds the given increments to the fields of the daily rollup row of the
+    given model with the given key field values; the row is created if it does
+    not exist, yet.
+    """
+    updates = dict((name, F(name) + value)
+                   for name, value in increments.iteritems())
+    if model.objects.filter(**key).update(**updates):
+        return
+    values = dict(key)
+    values.update(increments)
+    _sid = transaction.savepoint()
+    try:
+        model.objects.create(**values)
+        transaction.savepoint_commit(_sid)
+    except IntegrityError:
+        # another request has created the row in the meantime
+        transaction.savepoint_rollback(_sid)
+        model.objects.filter(**key).update(**updates)
+
+
+def _rebuild_lr_rollups(lrid=None):
+    """
+    Rebuilds the daily rollup of the `LRStats` records of the resource with the
+    given storage object identifier or of all resources if no identifier is
+    given.
+    """
+    if lrid is None:
+        LRStatsDaily.objects.all().delete()
+        records = LRStats.objects.all()
+    else:
+        LRStatsDaily.objects.filter(lrid=lrid).delete()
+        records = LRStats.objects.filter(lrid=lrid)
+    totals = {}
+    for lasttime, _lrid, action, geoinfo, ignored, _count in records \
+            .values_list('lasttime', 'lrid', 'action', 'geoinfo', 'ignored',
+                         'count').iterator():
+        key = (lasttime.date(), _lrid, action, geoinfo or u'', ignored)
+        _records, _total = totals.get(key, (0, 0))
+        totals[key] = (_records + 1, _total + _count)
+    _bulk_insert(LRStatsDaily, [LRStatsDaily(day=key[0], lrid=key[1],
+            action=key[2], geoinfo=key[3], ignored=key[4], records=_records,
+            count=_count)
+        for key, (_records, _count) in totals.iteritems()])
+
+
+def _add_to_query_rollups(stats):
+    """
+    Adds the given newly saved `QueryStats` records to the daily rollup.
+    """
+    for stat in stats:
+        day = stat.lasttime.date()
+        geoinfo = stat.geoinfo or u''
+        _add_to_rollup(QueryStatsDaily, {'day': day, 'geoinfo': geoinfo},
+                       {'records': 1, 'exectime': stat.exectime})
+
+
+def rebuild_stats_rollups():
+    """
+    Rebuilds the daily rollups of all `LRStats` and `QueryStats` records.
+    """
+    _rebuild_lr_rollups()
+    QueryStatsDaily.objects.all().delete()
+    totals = {}
+    for lasttime, geoinfo, exectime in QueryStats.objects \
+            .values_list('lasttime', 'geoinfo', 'exectime').iterator():
+        key = (lasttime.date(), geoinfo or u'')
+        _records, _exectime = totals.get(key, (0, 0))
+        totals[key] = (_records + 1, _exectime + exectime)
+    _bulk_insert(QueryStatsDaily, [QueryStatsDaily(day=key[0], geoinfo=key[1],
+            records=_records, exectime=_exectime)
+        for key, (_records, _exectime) in totals.iteritems()])
+
+def getLRStats(lrid):
+    data = []
+    action_list = LRStatsDaily.objects.values('action').filter(lrid=lrid, ignored=False) \
+        .annotate(Sum('count'), Max('day')).order_by('-action')
+    for key in action_list:
+        if str(key['action']) in VISIBLE_STATS:
+            data.append({"action": STAT_LABELS[str(key['action'])],
+                "count": str(key['count__sum']), "last": str(key['day__max'])[:10]})
+    return data
     
 def getUserCount(lrid, user = None):
     if user != None:
@@ -155,24 +452,13 @@ def getUserStats(lrid):
 def getLRTop(action, limit, geoinfo=None, since=None, offset=0):
     action_list = []
     if (action and not action == ""):
+        action_list = LRStatsDaily.objects.values('lrid').filter(ignored=False, action=action)
         if (geoinfo != None and geoinfo != ''):
-            if (since):
-                action_list = LRStats.objects.values('lrid') \
-                    .filter(ignored=False, action=action, geoinfo=geoinfo, lasttime__gte=since) \
-                    .annotate(sum_count=Sum('count')).order_by('-sum_count')[offset:offset+limit]
-            else:
-                action_list = LRStats.objects.values('lrid') \
-                    .filter(ignored=False, action=action, geoinfo=geoinfo) \
-                    .annotate(sum_count=Sum('count')).order_by('-sum_count')[offset:offset+limit]
-        else:
-            if (since):
-                action_list = LRStats.objects.values('lrid') \
-                    .filter(ignored=False, action=action, lasttime__gte=since) \
-                    .annotate(sum_count=Sum('count')).order_by('-sum_count')[offset:offset+limit]
-            else:
-                action_list = LRStats.objects.values('lrid') \
-                    .filter(ignored=False, action=action) \
-                    .annotate(sum_count=Sum('count')).order_by('-sum_count')[offset:offset+limit]
+            action_list = action_list.filter(geoinfo=geoinfo)
+        if (since):
+            action_list = action_list.filter(day__gte=since)
+        action_list = action_list.annotate(sum_count=Sum('count')) \
+            .order_by('-sum_count')[offset:offset+limit]
     return action_list
 
 def getLRLast(action, limit, geoinfo=None, offset=0):
@@ -238,23 +524,24 @@ def getLastQuery(limit, geoinfo=None, offset=0):
     return lastquery
 
 def statByDate(date):
-    return LRStats.objects.values("action").filter(lasttime__year=date[0:4], lasttime__month=date[4:6], \
-        lasttime__day=date[6:8]).annotate(Count('action'))
+    return LRStatsDaily.objects.values("action").filter(day=date[0:4]+"-"+date[4:6]+"-"+date[6:8]) \
+        .annotate(Sum('records'))
     
 def statDays():
-    days = itertools.chain(LRStats.objects.dates('lasttime', 'day'), QueryStats.objects.dates('lasttime', 'day'))
-    return reduce(lambda x, y: x if y in x else x + [y], days, [])
+    days = itertools.chain(LRStatsDaily.objects.dates('day', 'day'), QueryStatsDaily.objects.dates('day', 'day'))
+    return sorted(set(days))
 
 def getCountryActions(action):
     result = []
     sets = None
     if (action != None):
-        sets = LRStats.objects.values('geoinfo').exclude(geoinfo=u'').filter(action=action).annotate(Count('action')).order_by('-action__count')
+        sets = LRStatsDaily.objects.values('geoinfo').exclude(geoinfo=u'').filter(action=action) \
+            .annotate(Sum('records')).order_by('-records__sum')
     else:
-        sets = LRStats.objects.values('geoinfo').annotate(Count('action')).order_by('-action__count')
+        sets = LRStatsDaily.objects.values('geoinfo').annotate(Sum('records')).order_by('-records__sum')
     
     for key in sets:
-        result.append([key['geoinfo'], key['action__count'], getcountry_name(key['geoinfo'])])
+        result.append([key['geoinfo'], key['records__sum'], getcountry_name(key['geoinfo'])])
     return result
         
         
@@ -306,49 +593,50 @@ def _get_ipaddress(request):
 
 
 def update_usage_stats(lrid, element_tree):
-    element_children = list(element_tree)
-    if len(element_children):
-        for child in element_children:
-            item = update_usage_stats(lrid, child)
-            if (item == None or item[0] == None):
-                lrset = UsageStats.objects.filter(lrid=lrid, elparent=element_tree.tag, elname=child.tag)
-                if (lrset.count() > 1):
-                    LOGGER.debug('ERROR! Saving usage stats in {}, {}'.format(element_tree.tag, child.tag))
-                    continue
-                if (lrset.count() > 0):
-                    record = lrset[0]
-                    record.count = record.count+1
-                    record.save(force_update=True)
-                else:
-                    record = UsageStats()
-                    record.lrid = lrid
-                    record.elname = child.tag
-                    record.elparent = element_tree.tag
-                    record.save(force_insert=True)
-                continue
-            if not isinstance(item[0], basestring):
-                elname = item[0][0].encode("utf-8") if item[0][0] != None else ""
-                text = item[0][1].encode("utf-8") if item[0][1] != None else ""
-                lrset = UsageStats.objects.filter(lrid=lrid, elparent=element_tree.tag, elname=elname, text=text)
-                if (lrset.count() > 1):
-                    LOGGER.debug('ERROR! Saving usage stats in {}, {}'.format(element_tree.tag, elname))
-                    continue
-                if (lrset.count() > 0):
-                    record = lrset[0]
-                    record.count = record.count+1
-                    record.save(force_update=True)
-                else:
-                    record = UsageStats()
-                    record.lrid = lrid
-                    record.elname = elname
-                    record.elparent = element_tree.tag
-                    record.text = text
-                    record.save(force_insert=True)
-        return None
-    # Otherwise, we return a tuple containg (key, value), i.e., (tag, text).
-    else:
-        return ((element_tree.tag, element_tree.text),)
-    
+    """
+    Replaces the usage statistics of the resource with the given storage object
+    identifier with those of the given metadata element tree.
+
+    Every element with children is counted as (parent, element) pair and every
+    leaf element as (parent, element, text) tuple. The counts are collected in
+    one pass over the tree and written with a single bulk insert. Returns the
+    number of written records.
+    """
+    counts = Counter()
+    _count_usage_elements(element_tree, counts)
+    UsageStats.objects.filter(lrid=lrid).delete()
+    _bulk_insert(UsageStats, [UsageStats(lrid=lrid, elparent=elparent,
+            elname=elname, text=text, count=count)
+        for (elparent, elname, text), count in counts.iteritems()])
+    return len(counts)
+
+
+def _count_usage_elements(element, counts):
+    """
+    Adds the (parent, element, text) tuples of all descendants of the given
+    element to the given `Counter`.
+
+    Namespaces are removed from the tags so that parsed metadata XML yields the
+    same tuples as an exported element tree.
+    """
+    elparent = _strip_namespace(element.tag)
+    for child in element:
+        if len(child):
+            counts[(elparent, _strip_namespace(child.tag), u'')] += 1
+            _count_usage_elements(child, counts)
+        else:
+            counts[(elparent, _strip_namespace(child.tag),
+                    child.text or u'')] += 1
+
+
+def _strip_namespace(tag):
+    """
+    Returns the given element tag without its namespace, if any.
+    """
+    if tag and tag.startswith('{'):
+        return tag.partition('}')[2]
+    return tag or u''
+
 
 def updateUsageStats(resources):   
     #check if it is already running an UsageThread process
@@ -406,4 +694,5 @@ class UsageThread(threading.Thread):
                 if not lrid in available_lrids:
                     UsageStats.objects.filter(lrid=str(lrid)).delete()
                     LRStats.objects.filter(lrid=str(lrid)).delete()
+                    LRStatsDaily.objects.filter(lrid=str(lrid)).delete()
             
@@ -61,3 +61,42 @@ class UsageStats(models.Model):
     
     #def __unicode__(self):
     #    return "U>> " +str(self.lrid) + "," + str(self.elname) + "," + str(self.elparent) + "," +str(self.text)+ "," + str(self.count)
+
+
+class LRStatsDaily(models.Model):
+    """
+    Daily rollup of the `LRStats` records per resource, action and country.
+
+    The rollup is maintained whenever `LRStats` records are added or changed in
+    `metashare.stats.model_utils` so that the statistics pages do not need to
+    aggregate the raw records.
+    """
+    day = models.DateField(blank=False, db_index=True)
+    # the storage object identifier of the language resource,
+    # NOT the pk of the resource!
+    lrid = models.CharField(blank=False, max_length=64, db_index=True)
+    action = models.CharField(blank=False, max_length=1)
+    geoinfo = models.CharField(blank=True, max_length=2)
+    ignored = models.BooleanField(blank=False, default=False)
+    # the number of aggregated `LRStats` records
+    records = models.IntegerField(blank=False, default=0)
+    # the sum of the counts of the aggregated `LRStats` records
+    count = models.IntegerField(blank=False, default=0)
+
+    class Meta:
+        unique_together = ('day', 'lrid', 'action', 'geoinfo', 'ignored')
+
+
+class QueryStatsDaily(models.Model):
+    """
+    Daily rollup of the `QueryStats` records per country.
+    """
+    day = models.DateField(blank=False, db_index=True)
+    geoinfo = models.CharField(blank=True, max_length=2)
+    # the number of aggregated `QueryStats` records
+    records = models.IntegerField(blank=False, default=0)
+    # the sum of the execution times of the aggregated `QueryStats` records
+    exectime = models.IntegerField(blank=False, default=0)
+
+    class Meta:
+        unique_together = ('day', 'geoinfo')
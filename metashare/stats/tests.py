@@ -2,7 +2,9 @@ import logging
 import urllib2
 from urllib import urlencode
 import uuid
+from StringIO import StringIO
 from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.core.management import call_command
 from django.test.client import Client
 from django.test.testcases import TestCase
 from metashare import test_utils
@@ -11,7 +13,9 @@ from metashare.repository.models import resourceInfoType_model
 from metashare.settings import ROOT_PATH, STORAGE_PATH, LOG_HANDLER, DJANGO_BASE, STATS_SERVER_URL, DJANGO_URL
 from metashare.storage.models import INGESTED
 from metashare.stats.model_utils import update_usage_stats, UsageStats, saveLRStats, getLRLast, getLastQuery, \
-    UPDATE_STAT, VIEW_STAT, RETRIEVE_STAT, DOWNLOAD_STAT
+    flush_lr_stats, getLRTop, UPDATE_STAT, VIEW_STAT, RETRIEVE_STAT, DOWNLOAD_STAT, \
+    INGEST_STAT
+from metashare.stats.models import LRStats, LRStatsDaily
 from metashare.stats.views import callServerStats
 
 # Setup logging support.
@@ -95,7 +99,67 @@ class StatsTest(TestCase):
             resource = resourceInfoType_model.objects.get(pk=resources[i].pk)
             for action in (VIEW_STAT, RETRIEVE_STAT, DOWNLOAD_STAT):
                 saveLRStats(resource, action)
+                flush_lr_stats()
                 self.assertEqual(len(getLRLast(action, 10)), i+1)
+
+    def test_buffered_stats(self):
+        """
+        Verifies that view/download events are counted once per session and
+        only written to the database when the buffer is flushed.
+        """
+        client = Client()
+        client.login(username='manageruser', password='secret')
+        resource = resourceInfoType_model.objects.all()[0]
+        resource.storage_object.publication_status = INGESTED
+        resource.storage_object.save()
+        client.post(ADMINROOT,
+            {"action": "publish_action", ACTION_CHECKBOX_NAME: resource.id},
+            follow=True)
+        resource = resourceInfoType_model.objects.get(pk=resource.pk)
+        lrid = resource.storage_object.identifier
+        flush_lr_stats()
+        self.assertTrue(saveLRStats(resource, VIEW_STAT))
+        self.assertFalse(saveLRStats(resource, VIEW_STAT))
+        self.assertTrue(saveLRStats(resource, DOWNLOAD_STAT))
+        self.assertEqual(0, LRStats.objects.filter(lrid=lrid,
+            action__in=(VIEW_STAT, DOWNLOAD_STAT)).count())
+        self.assertEqual(2, flush_lr_stats())
+        self.assertEqual(0, flush_lr_stats())
+        self.assertEqual(1, LRStats.objects.filter(lrid=lrid,
+            action=VIEW_STAT).count())
+        self.assertEqual(1, LRStats.objects.filter(lrid=lrid,
+            action=DOWNLOAD_STAT).count())
+        # the same session is still not counted twice after the flush
+        self.assertFalse(saveLRStats(resource, VIEW_STAT))
+        self.assertEqual(0, flush_lr_stats())
+
+    def test_buffered_stats_of_ingested_resource(self):
+        """
+        Verifies that ingesting a resource only writes the pending events of
+        this resource, without flushing the whole buffer.
+        """
+        client = Client()
+        client.login(username='manageruser', password='secret')
+        resources = resourceInfoType_model.objects.all()
+        for resource in resources:
+            resource.storage_object.publication_status = INGESTED
+            resource.storage_object.save()
+            client.post(ADMINROOT,
+                {"action": "publish_action", ACTION_CHECKBOX_NAME: resource.id},
+                follow=True)
+        flush_lr_stats()
+        resources = [resourceInfoType_model.objects.get(pk=resource.pk)
+                     for resource in resources[:2]]
+        for resource in resources:
+            self.assertTrue(saveLRStats(resource, VIEW_STAT))
+        saveLRStats(resources[0], INGEST_STAT)
+        self.assertEqual(1, LRStats.objects.filter(
+            lrid=resources[0].storage_object.identifier, action=VIEW_STAT,
+            ignored=True).count())
+        self.assertEqual(0, LRStats.objects.filter(
+            lrid=resources[1].storage_object.identifier,
+            action=VIEW_STAT).count())
+        self.assertEqual(1, flush_lr_stats())
  
     def test_visiting_stats(self):
         """
@@ -212,7 +276,45 @@ class StatsTest(TestCase):
         response = client.get('/{0}stats/get/?statsid={1}'.format(DJANGO_BASE, str(uuid.uuid3(uuid.NAMESPACE_DNS, STORAGE_PATH))))
         self.assertEquals(200, response.status_code)
         self.assertContains(response, "usagestats")
+        self.assertContains(response, "xml_cache")
+        # a malformed date yields zero counts
+        response = client.get('/{0}stats/get/?date=2012-13-45'.format(DJANGO_BASE))
+        self.assertEquals(200, response.status_code)
+        self.assertContains(response, '"lrview": 0')
     
+    def test_stats_rollups(self):
+        """
+        Verifies that the daily rollups are kept up-to-date with the raw
+        statistics and can be rebuilt from them.
+        """
+        client = Client()
+        client.login(username='manageruser', password='secret')
+        resources = resourceInfoType_model.objects.all()
+        for resource in resources:
+            resource.storage_object.publication_status = INGESTED
+            resource.storage_object.save()
+            client.post(ADMINROOT,
+            {"action": "publish_action", ACTION_CHECKBOX_NAME: resource.id},
+            follow=True)
+            client.get(resource.get_absolute_url(), follow=True)
+        flush_lr_stats()
+        _fields = ('day', 'lrid', 'action', 'geoinfo', 'ignored', 'records',
+                   'count')
+        rollups = sorted(LRStatsDaily.objects.values_list(*_fields))
+        self.assertEqual(LRStats.objects.count(),
+                         sum(rollup[5] for rollup in rollups))
+        self.assertEqual(2, len(getLRTop(VIEW_STAT, 10)))
+        LRStatsDaily.objects.all().delete()
+        call_command('rebuild_stats_rollups')
+        self.assertEqual(rollups,
+                         sorted(LRStatsDaily.objects.values_list(*_fields)))
+        # ingesting a resource again hides its statistics
+        resource = resourceInfoType_model.objects.get(pk=resources[0].pk)
+        saveLRStats(resource, INGEST_STAT)
+        self.assertEqual(1, len(getLRTop(VIEW_STAT, 10)))
+        self.assertFalse(LRStatsDaily.objects.filter(
+            lrid=resource.storage_object.identifier, ignored=False).exists())
+
     def test_my_resources(self):
         client = Client()
         client.login(username='manageruser', password='secret')
@@ -228,6 +330,7 @@ class StatsTest(TestCase):
             self.assertTemplateUsed(response,
                 'repository/resource_view/lr_view.html')
         
+        flush_lr_stats()
         statsdata = getLRLast(VIEW_STAT, 10)
         self.assertEqual(2, len(statsdata))
 
@@ -298,3 +401,26 @@ class StatsTest(TestCase):
         response = client.get('/{0}stats/usage/'.format(DJANGO_BASE))
         self.assertContains(response, "Metadata usage in 2 resources")
 
+    def test_rebuild_usage_stats(self):
+        """
+        Verifies that rebuilding the usage statistics from the stored metadata
+        yields the same statistics as the export of the resources.
+        """
+        client = Client()
+        client.login(username='manageruser', password='secret')
+        for resource in resourceInfoType_model.objects.all():
+            resource.storage_object.publication_status = INGESTED
+            resource.storage_object.save()
+            client.post(ADMINROOT,
+            {"action": "publish_action", ACTION_CHECKBOX_NAME: resource.id},
+            follow=True)
+        _fields = ('lrid', 'elparent', 'elname', 'text', 'count')
+        expected = sorted(UsageStats.objects.values_list(*_fields))
+        self.assertTrue(len(expected) > 0)
+        UsageStats.objects.all().delete()
+        output = StringIO()
+        call_command('rebuild_usage_stats', stdout=output)
+        self.assertIn('Rebuilt the usage statistics of 2/2 resources.',
+                      output.getvalue())
+        self.assertEqual(expected,
+                         sorted(UsageStats.objects.values_list(*_fields)))
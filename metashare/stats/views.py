@@ -4,7 +4,9 @@ import uuid
 from metashare.settings import DJANGO_URL, STATS_SERVER_URL, METASHARE_VERSION, STORAGE_PATH
 from metashare.repository.models import resourceInfoType_model
 from metashare.storage.models import PUBLISHED
-from metashare.stats.models import LRStats, QueryStats, UsageStats
+from metashare.stats.models import LRStats, QueryStats, UsageStats, \
+    LRStatsDaily, QueryStatsDaily
+from metashare.repository.supermodel import OBJECT_XML_CACHE
 # pylint: disable-msg=W0611, W0401
 from metashare.stats.model_utils import *
 
@@ -14,7 +16,7 @@ from metashare.repository.models import *
 from django.utils.importlib import import_module
 import django.utils.encoding
 from django.shortcuts import render_to_response     
-from django.db.models import Count, Max, Min, Avg
+from django.db.models import Count, Sum
 from django.http import HttpResponse
 from django.template import RequestContext
 from django.core.paginator import Paginator
@@ -64,6 +66,8 @@ thread.start()
     
 def mystats (request):
     data = []
+    # include the pending view/download events of this process
+    flush_lr_stats()
     entry_list = getMyResources(request.user.username)
     for resource in entry_list:
         if not resource.storage_object.deleted:
@@ -259,6 +263,8 @@ def topstats (request):
     geovisits = []
     visitstitle = "Unknown"
     view = request.GET.get('view', 'topviewed')
+    # include the pending view/download events of this process
+    flush_lr_stats()
     last = request.GET.get('last', '')
     limit = int(request.GET.get('limit', '10'))
     offset = int(request.GET.get('offset', '0'))    
@@ -365,30 +371,51 @@ def getstats (request):
     """ get statistics for a date in terms of user action made, amount of resources, info about usage, ... """
     data = {}
     stats_uuid = request.GET.get('statsid',"")
+    # include the pending view/download events of this process
+    flush_lr_stats()
     currdate = request.GET.get('date', '')
+    valid_date = True
     if (not currdate):
         currdate = date.today()
+    else:
+        try:
+            currdate = datetime.strptime(currdate, "%Y-%m-%d").date()
+        except ValueError:
+            # just like for a day without any statistics, zero counts are
+            # returned for a malformed date
+            valid_date = False
     
     data['date'] = str(currdate)    
     data['metashare_version'] = METASHARE_VERSION  
-    data['user'] = LRStats.objects.filter(lasttime__startswith=currdate).values('sessid').annotate(Count('sessid')).count()
     data['lrcount'] = resourceInfoType_model.objects.filter(
         storage_object__publication_status=PUBLISHED,
         storage_object__deleted=False).count()
     data['lrmastercount'] = StorageObject.objects.filter(copy_status=MASTER, publication_status=PUBLISHED, deleted=False).count()
-    data['lrupdate'] = LRStats.objects.filter(lasttime__startswith=currdate, action=UPDATE_STAT).count()
-    data['lrview'] = LRStats.objects.filter(lasttime__startswith=currdate, action=VIEW_STAT).count()
-    data['lrdown'] = LRStats.objects.filter(lasttime__startswith=currdate, action=DOWNLOAD_STAT).count()
-    data['queries'] = QueryStats.objects.filter(lasttime__startswith=currdate).count()
-    extimes = QueryStats.objects.filter(lasttime__startswith=currdate).aggregate(Avg('exectime'), Max('exectime'), Min('exectime'))
+    if valid_date:
+        nextdate = currdate + relativedelta(days = 1)
+        data['user'] = LRStats.objects.filter(lasttime__gte=currdate, lasttime__lt=nextdate) \
+            .values('sessid').annotate(Count('sessid')).count()
+        # the action and query counts are read from the daily rollups
+        actions = dict(LRStatsDaily.objects.filter(day=currdate).values_list('action') \
+            .annotate(Sum('records')))
+        queries = QueryStatsDaily.objects.filter(day=currdate).aggregate(Sum('records'), Sum('exectime'))
+    else:
+        data['user'] = 0
+        actions = {}
+        queries = {"records__sum": None, "exectime__sum": None}
+    data['lrupdate'] = actions.get(UPDATE_STAT, 0)
+    data['lrview'] = actions.get(VIEW_STAT, 0)
+    data['lrdown'] = actions.get(DOWNLOAD_STAT, 0)
+    data['queries'] = queries["records__sum"] or 0
     
     qltavg = 0
-    if (extimes["exectime__avg"]):
-        qltavg = QueryStats.objects.filter(lasttime__startswith=currdate, exectime__lt = int(extimes["exectime__avg"])).count()
-    else:
-        extimes["exectime__avg"] = 0
+    exectime_avg = 0
+    if (data['queries'] and queries["exectime__sum"]):
+        exectime_avg = float(queries["exectime__sum"]) / data['queries']
+        qltavg = QueryStats.objects.filter(lasttime__gte=currdate, lasttime__lt=nextdate,
+            exectime__lt = int(exectime_avg)).count()
     
-    data['qexec_time_avg'] = extimes["exectime__avg"]
+    data['qexec_time_avg'] = exectime_avg
     data['qlt_avg'] = qltavg
     
     ###get usage statistics
@@ -429,6 +456,9 @@ def getstats (request):
         for resource in resources:
             lrstats[resource.storage_object.identifier] = getLRStats(resource.storage_object.identifier)
         data["lrstats"] = lrstats
+
+        # memory usage of the cache used for finding duplicates on import
+        data["xml_cache"] = OBJECT_XML_CACHE.get_stats()
         
     return HttpResponse("["+json.dumps(data)+"]", mimetype="application/json")
     
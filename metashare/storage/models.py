@@ -17,7 +17,10 @@ from django.core.serializers.json import DjangoJSONEncoder
 import zipfile
 from zipfile import ZIP_DEFLATED
 from django.db.models.query_utils import Q
+from django.db.models.signals import post_delete
 import glob
+from multiprocessing import Pool
+from traceback import format_exc
 
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
@@ -135,6 +138,11 @@ class StorageObject(models.Model):
       help_text="(Read-only) last update check date of digest zip " \
       "for this storage object instance.")
     
+    status_modified = models.DateTimeField(editable=False, null=True,
+      blank=True, help_text="(Read-only) last modification date of the " \
+      "publication status or the deletion status flag for this storage " \
+      "object instance.")
+    
     revision = models.PositiveIntegerField(default=1, help_text="Revision " \
       "or version information for this storage object instance.")
       
@@ -195,6 +203,14 @@ class StorageObject(models.Model):
       help_text="text containing the JSON serialization of local attributes " \
       "for this storage object instance.")
     
+    def __init__(self, *args, **kwargs):
+        """
+        Remembers the publication and deletion status as loaded from the
+        database so that `save()` can detect changes of them.
+        """
+        super(StorageObject, self).__init__(*args, **kwargs)
+        self._loaded_status = (self.publication_status, self.deleted)
+
     def get_digest_checksum(self):
         """
         Checks if the current digest is till up-to-date, recreates it if
@@ -254,8 +270,17 @@ class StorageObject(models.Model):
         # Perform a full validation for this storage object instance.
         self.full_clean()
         
+        # remember when the storage object has been (un)published or deleted
+        if self.pk is None or self.status_modified is None \
+          or self._loaded_status != (self.publication_status, self.deleted):
+            self.status_modified = datetime.now()
+
         # Call save() method from super class with all arguments.
         super(StorageObject, self).save(*args, **kwargs)
+        self._loaded_status = (self.publication_status, self.deleted)
+
+        # keep the change log of the synchronization inventory up-to-date
+        record_inventory_change(self)
     
     def update_storage(self, force_digest=False):
         """
@@ -279,6 +304,12 @@ class StorageObject(models.Model):
 
         # for internal resources, no serialization is done
         if self.publication_status == INTERNAL:
+            # the metadata of internal resources changes without being
+            # serialized, so their facet summary cannot be kept up-to-date in
+            # check_facets(); it is dropped and recomputed when it is needed
+            from metashare.repository.models import ResourceFacets
+            ResourceFacets.objects.filter(resource__storage_object=self) \
+                .delete()
             if source_url_updated:
                 self.save()
             return
@@ -287,6 +318,14 @@ class StorageObject(models.Model):
 
         # check metadata serialization
         metadata_updated = self.check_metadata()
+
+        # keep the denormalized facet summary of the resource up-to-date
+        self.check_facets(metadata_updated)
+        if metadata_updated:
+            # the single resource view has to be rendered anew
+            from metashare.repository.model_utils import \
+                invalidate_resource_view_cache
+            invalidate_resource_view_cache(self)
         
         # check global storage object serialization
         global_updated = self.check_global_storage_object()
@@ -361,6 +400,20 @@ class StorageObject(models.Model):
         return update_xml
         
     
+    def check_facets(self, force=False):
+        """
+        Recomputes the facet summary of the resource if it does not exist, yet,
+        or if `force` is True (i.e., if the metadata has changed).
+        """
+        from metashare.repository.model_utils import update_resource_facets
+        from metashare.repository.models import ResourceFacets
+        # pylint: disable-msg=E1101
+        _resource = self.resourceinfotype_model_set.all()[0]
+        if force or not ResourceFacets.objects.filter(resource=_resource) \
+                .exists():
+            update_resource_facets(_resource)
+
+
     def check_global_storage_object(self):
         """
         Checks if the global storage object serialization has changed. If yes,
@@ -433,6 +486,140 @@ class StorageObject(models.Model):
         return False
 
 
+class InventoryChange(models.Model):
+    """
+    Models the most recent change of the synchronization inventory entry of a
+    storage object.
+    
+    The primary key serves as a monotonically increasing change sequence
+    number: whenever an entry changes, it is recreated with a new primary key.
+    Entries of storage objects which were removed from the inventory are kept
+    as tombstones so that peers can detect deletions.
+    """
+    identifier = models.CharField(max_length=64, db_index=True, editable=False,
+      help_text="(Read-only) identifier of the changed storage object.")
+
+    object_id = models.IntegerField(null=True, db_index=True, editable=False,
+      help_text="(Read-only) primary key of the changed storage object.")
+
+    digest_checksum = models.CharField(blank=True, null=True, max_length=32,
+      editable=False, help_text="(Read-only) digest checksum of the storage " \
+      "object at the time of the change; empty for deletions.")
+
+    deleted = models.BooleanField(default=False, editable=False,
+      help_text="(Read-only) whether the storage object was removed from the " \
+      "inventory.")
+
+    def __unicode__(self):
+        """
+        Returns the Unicode representation for this inventory change instance.
+        """
+        return u'<InventoryChange #{0} "{1}">'.format(self.id, self.identifier)
+
+
+def _get_inventory_digest(storage_object):
+    """
+    Returns the digest checksum with which the given storage object is listed in
+    the synchronization inventory or None if it is not listed at all.
+    """
+    if storage_object.copy_status in (MASTER, PROXY) \
+      and storage_object.publication_status != INTERNAL:
+        return storage_object.digest_checksum
+    return None
+
+
+def _replace_inventory_change(identifier, object_id, digest):
+    """
+    Replaces the inventory change (if any) of the given storage object
+    identifier with a new one for the given storage object id and digest; a
+    `None` digest results in a tombstone.
+    """
+    # the new change is created before the old one is deleted so that the
+    # sequence number always increases, even with databases which reuse the
+    # highest primary key after it has been deleted
+    _change = InventoryChange.objects.create(identifier=identifier,
+      object_id=object_id, digest_checksum=digest, deleted=(digest is None))
+    InventoryChange.objects.filter(identifier=identifier, id__lt=_change.id) \
+        .delete()
+
+
+def record_inventory_change(storage_object, removed=False):
+    """
+    Updates the inventory change log for the given storage object if its entry
+    in the synchronization inventory has changed.
+    
+    removed (optional): if True, the storage object is being deleted
+    """
+    # a storage object may have been saved with a temporary identifier before,
+    # e.g., when restoring it from the storage folder; such entries are outdated
+    if storage_object.pk is not None:
+        for _change in InventoryChange.objects.filter(
+          object_id=storage_object.pk, deleted=False) \
+          .exclude(identifier=storage_object.identifier):
+            _replace_inventory_change(_change.identifier, None, None)
+
+    if removed:
+        _digest = None
+    else:
+        _digest = _get_inventory_digest(storage_object)
+    _changes = InventoryChange.objects.filter(
+      identifier=storage_object.identifier).order_by('-id')[:1]
+    _change = _changes[0] if _changes else None
+
+    if _change is None or _change.deleted:
+        # nothing to do if the storage object is still not listed; tombstones
+        # are only required for storage objects which have been listed before
+        if _digest is None:
+            return
+    elif _change.digest_checksum == _digest:
+        return
+    _replace_inventory_change(storage_object.identifier,
+      None if removed else storage_object.pk, _digest)
+
+
+def get_last_inventory_change():
+    """
+    Returns the sequence number of the latest inventory change or 0 if there
+    are no changes at all.
+    """
+    _last = InventoryChange.objects.aggregate(models.Max('id'))['id__max']
+    return _last or 0
+
+
+def _record_storage_object_removal(instance, **kwargs):
+    """
+    Records a tombstone in the inventory change log for the given deleted
+    `StorageObject`.
+    """
+    record_inventory_change(instance, removed=True)
+
+# make sure that peers can detect the deletion of storage objects
+post_delete.connect(_record_storage_object_removal, sender=StorageObject)
+
+
+class IndexUpdate(models.Model):
+    """
+    Models a pending update of the search index entry of the resource with the
+    given storage object identifier.
+
+    There is at most one pending update per storage object so that repeated
+    changes of the same resource are coalesced into a single index update.
+    """
+    identifier = models.CharField(max_length=64, unique=True, editable=False,
+      help_text="(Read-only) identifier of the storage object of the resource " \
+      "to reindex.")
+
+    queued = models.DateTimeField(auto_now_add=True, editable=False,
+      help_text="(Read-only) date of the first pending change.")
+
+    def __unicode__(self):
+        """
+        Returns the Unicode representation for this index update instance.
+        """
+        return u'<IndexUpdate #{0} "{1}">'.format(self.id, self.identifier)
+
+
+
 def restore_from_folder(storage_id, copy_status=MASTER, \
   storage_digest=None, source_node=None, force_digest=False):
     """
@@ -619,29 +806,171 @@ def _fill_storage_object(storage_obj, json_file_name):
         return json_string
 
 
-def update_digests():
+def _update_digest(identifier):
+    """
+    Re-creates the digest of the storage object with the given identifier if
+    required.
+    
+    Returns a pair of the identifier and an error message or None on success.
+    No exceptions are raised so that this function can be safely used in a
+    worker process.
+    """
+    try:
+        LOGGER.info('updating {}'.format(identifier))
+        StorageObject.objects.get(identifier=identifier).update_storage()
+        return identifier, None
+    except:
+        return identifier, format_exc()
+
+
+def _close_db_connection():
+    """
+    Closes the database connection of the current process; used as initializer
+    of worker processes so that they don't share the connection of the parent
+    process.
+    """
+    from django.db import connection
+    connection.close()
+
+
+def update_digests(processes=1):
     """
     Re-creates a digest if it is older than MAX_DIGEST_AGE / 2.
     This assumes that this method is called in MAX_DIGEST_AGE / 2 intervals to
     guarantee a maximum digest age of MAX_DIGEST_AGE.
+    
+    processes (optional): the number of worker processes for re-creating the
+        digests in parallel; if 1, all digests are re-created in the current
+        process
     """
     LOGGER.info('Starting to update digests.')
     _expiration_date = _get_expiration_date()
     
     # get all master copy storage object of ingested and published resources
-    for _so in StorageObject.objects.filter(
+    # which have not been updated or checked since the expiration date
+    _identifiers = list(StorageObject.objects.filter(
       Q(copy_status=MASTER),
-      Q(publication_status=INGESTED) | Q(publication_status=PUBLISHED)):
-        if _expiration_date > _so.digest_modified \
-          and _expiration_date > _so.digest_last_checked: 
-            LOGGER.info('updating {}'.format(_so.identifier))
-            _so.update_storage()
-        else:
-            LOGGER.info('{} is up to date'.format(_so.identifier))
+      Q(publication_status=INGESTED) | Q(publication_status=PUBLISHED),
+      Q(digest_modified__isnull=True) | Q(digest_modified__lt=_expiration_date),
+      Q(digest_last_checked__isnull=True)
+        | Q(digest_last_checked__lt=_expiration_date)) \
+      .values_list('identifier', flat=True))
+    LOGGER.info('{} digests have to be updated.'.format(len(_identifiers)))
+
+    if processes > 1 and len(_identifiers) > 1:
+        _close_db_connection()
+        _pool = Pool(processes, _close_db_connection)
+        try:
+            _results = list(_pool.imap_unordered(_update_digest, _identifiers))
+        finally:
+            _pool.close()
+            _pool.join()
+    else:
+        _results = [_update_digest(_id) for _id in _identifiers]
+
+    for _identifier, _error in _results:
+        if _error is not None:
+            LOGGER.error('Error while updating digest of {}: {}'.format(
+              _identifier, _error))
 
     LOGGER.info('Finished updating digests.')
 
 
+def _restore_storage_folder(folder_name):
+    """
+    Restores the resource of the storage folder with the given name if the
+    folder contains a serialized global and local storage object.
+    
+    Returns a triple of the folder name, a flag whether a resource has been
+    restored and an error message or None on success. No exceptions are raised
+    so that this function can be safely used in a worker process.
+    """
+    folder_path = os.path.join(settings.STORAGE_PATH, folder_name)
+    try:
+        # only restore resources with global- and local-storage.json
+        if not os.path.isfile(os.path.join(folder_path, 'storage-global.json')):
+            LOGGER.info('missing global json, skipping "{}"'.format(folder_name))
+            return folder_name, False, None
+        _storage_local_path = os.path.join(folder_path, 'storage-local.json')
+        if not os.path.isfile(_storage_local_path):
+            LOGGER.info('missing local json, skipping "{}"'.format(folder_name))
+            return folder_name, False, None
+        # get copy status from storage-local.json
+        _copy_status = MASTER
+        with open(_storage_local_path, 'rb') as _in:
+            _dict = loads(_in.read())
+            if _dict['copy_status']:
+                _copy_status = _dict['copy_status']
+        LOGGER.info('restoring from folder: "{}"'.format(folder_name))
+        restore_from_folder(folder_name, copy_status=_copy_status)
+        return folder_name, True, None
+    except:
+        return folder_name, False, format_exc()
+
+
+def restore_storage_folders(processes=1, checkpoint=None):
+    """
+    Restores the resources of all non-empty folders in the storage folder.
+    
+    processes (optional): the number of worker processes for restoring the
+        folders in parallel; if 1, all folders are restored in the current
+        process
+    
+    checkpoint (optional): the path of a file to which the names of all
+        processed folders are appended; folders which are already listed in
+        this file are skipped so that an interrupted restore can be resumed
+    
+    Returns a pair of the list of the names of all restored folders and the
+    list of (folder name, error message) pairs of all failed folders.
+    """
+    _done = set()
+    if checkpoint and os.path.isfile(checkpoint):
+        with open(checkpoint, 'rb') as _in:
+            _done = set(_line.strip() for _line in _in)
+        LOGGER.info('Skipping {} folders listed in checkpoint file {}.'
+          .format(len(_done), checkpoint))
+
+    # skip empty folders; it is assumed that this is not an error
+    _folders = []
+    for _folder_name in sorted(os.listdir(settings.STORAGE_PATH)):
+        _folder_path = os.path.join(settings.STORAGE_PATH, _folder_name)
+        if _folder_name not in _done and os.path.isdir(_folder_path) \
+            and os.listdir(_folder_path):
+            _folders.append(_folder_name)
+
+    _restored = []
+    _failed = []
+    _pool = None
+    _checkpoint = checkpoint and open(checkpoint, 'ab')
+    try:
+        if processes > 1 and len(_folders) > 1:
+            _close_db_connection()
+            _pool = Pool(processes, _close_db_connection)
+            _results = _pool.imap_unordered(_restore_storage_folder, _folders)
+        else:
+            _results = (_restore_storage_folder(_f) for _f in _folders)
+        for _folder_name, _was_restored, _error in _results:
+            if _error is not None:
+                LOGGER.error('Error while restoring {}: {}'.format(
+                  _folder_name, _error))
+                _failed.append((_folder_name, _error))
+                continue
+            if _was_restored:
+                _restored.append(_folder_name)
+            # failed folders are not checkpointed so that they are retried
+            if _checkpoint:
+                _checkpoint.write('{}\n'.format(_folder_name))
+                _checkpoint.flush()
+    finally:
+        if _pool:
+            _pool.close()
+            _pool.join()
+        if _checkpoint:
+            _checkpoint.close()
+
+    return _restored, _failed
+
+
 def repair_storage_folder():
     """
     Repairs the storage folder by forcing the recreation of all files.
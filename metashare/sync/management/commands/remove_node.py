@@ -4,6 +4,7 @@ Management utility to handle removed nodes.
 from django.core.management.base import BaseCommand
 from metashare import settings
 from metashare.storage.models import StorageObject
+from metashare.sync.models import set_inventory_cursor
 from metashare.sync.sync_utils import remove_resource
 import logging
 from metashare.utils import Lock
@@ -35,5 +36,8 @@ class Command(BaseCommand):
                     remove_resource(res)
                 LOGGER.info("removed {} resources of node {}" \
                         .format(remove_count, node_name))
+                # make sure that the full inventory is requested again in case
+                # of a later synchronization with the node
+                set_inventory_cursor(node_name, None)
         finally:
             lock.release()
@@ -3,11 +3,19 @@ Management utility to trigger synchronization.
 """
 import logging
 import socket
+import threading
+import time
+from itertools import imap, chain
+from traceback import format_exc
+from multiprocessing.pool import ThreadPool
 
 from metashare import settings
-from metashare.sync.sync_utils import login, get_inventory, get_full_metadata, \
-    remove_resource
+from metashare.sync.models import get_inventory_cursor, set_inventory_cursor
+from metashare.sync.sync_utils import login, get_inventory_with_protocol, \
+    get_full_metadata, get_full_metadata_batch, remove_resource, \
+    INCREMENTAL_SYNC_PROTOCOL
 from django.core.management.base import BaseCommand
+from django.db import connection
 from optparse import make_option
 from metashare.storage.models import StorageObject, PROXY, REMOTE, add_or_update_resource
 from django.core.exceptions import ObjectDoesNotExist
@@ -18,6 +26,10 @@ from metashare.utils import Lock
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(settings.LOG_HANDLER)
 
+# all changes to the local storage layer and the ID file are serialized through
+# this lock, no matter how many nodes and resources are processed concurrently
+WRITE_LOCK = threading.Lock()
+
 
 class Command(BaseCommand):
     
@@ -26,6 +38,9 @@ class Command(BaseCommand):
                     default=None, help='file for IDs of new/modified resource'),
         make_option('-n', '--node', action='store', dest='node',
                     default=None, help='sync only with specified node'),
+        make_option('-w', '--workers', action='store', type='int',
+                    dest='workers', default=settings.SYNC_WORKERS,
+                    help='maximum number of concurrent downloads'),
     )
 
     help = 'Synchronizes with a predefined list of META-SHARE nodes'
@@ -50,30 +65,84 @@ class Command(BaseCommand):
         # our connections blocks forever
         socket.setdefaulttimeout(30.0)
 
+        workers = options.get('workers', None) or settings.SYNC_WORKERS
+
+        # collect the nodes to synchronize with as triples of node id, node
+        # settings and proxy flag
         node_name = options.get('node', None)
-        if node_name is None:
-            Command.sync_with_nodes(getattr(settings, 'CORE_NODES', {}), False, id_file)
-            Command.sync_with_nodes(getattr(settings, 'PROXIED_NODES', {}), True, id_file)
-        else:
-            # Synchronize only with the given node
-            core_nodes = getattr(settings, 'CORE_NODES', {})
-            for key, value in core_nodes.items():
-                if value['NAME'] == node_name:
-                    Command.sync_with_nodes({key: value}, False, id_file)
-                    break
+        nodes = []
+        for node_dict, is_proxy in (
+                (getattr(settings, 'CORE_NODES', {}), False),
+                (getattr(settings, 'PROXIED_NODES', {}), True)):
+            for key, value in node_dict.items():
+                if node_name is None or value['NAME'] == node_name:
+                    nodes.append((key, value, is_proxy))
+                    if node_name is not None:
+                        # synchronize only with the given node
+                        break
 
-            proxied_nodes = getattr(settings, 'PROXIED_NODES', {})
-            for key, value in proxied_nodes.items():
-                if value['NAME'] == node_name:
-                    Command.sync_with_nodes({key: value}, True, id_file)
-                    break
+        Command.sync_with_all_nodes(nodes, workers, id_file)
 
         # Close id file if used
         if not id_file is None:
             id_file.close()
 
     @staticmethod
-    def sync_with_nodes(nodes, is_proxy, id_file=None):
+    def sync_with_all_nodes(nodes, workers=1, id_file=None):
+        """
+        Synchronizes this META-SHARE node concurrently with all given other
+        META-SHARE nodes.
+        
+        `nodes` is a list of triples of node id, node settings dict and a flag
+            which is True if this node is a proxy for the node
+        `workers` is the maximum number of resources that are downloaded
+            concurrently; if it is 1, all nodes are synchronized one after the
+            other in the current thread
+        """
+        start = time.time()
+        # before starting the actual synchronization, make sure to lock the
+        # storage so that any other processes with heavy/frequent operations on
+        # the storage don't get in our way
+        lock = Lock('storage')
+        lock.acquire()
+        download_pool = None
+        node_pool = None
+        try:
+            if workers > 1 and len(nodes) > 0:
+                download_pool = ThreadPool(workers)
+                node_pool = ThreadPool(min(len(nodes), workers))
+                node_pool.map(lambda args: Command._sync_in_thread(
+                    *args, id_file=id_file, pool=download_pool), nodes)
+            else:
+                for node_id, node, is_proxy in nodes:
+                    Command.sync_with_nodes({node_id: node}, is_proxy, id_file,
+                                            lock_storage=False)
+        finally:
+            for _pool in (node_pool, download_pool):
+                if _pool is not None:
+                    _pool.close()
+                    _pool.join()
+            lock.release()
+        LOGGER.info("synchronization with {} nodes finished after {:.1f} "
+          "seconds".format(len(nodes), time.time() - start))
+
+    @staticmethod
+    def _sync_in_thread(node_id, node, is_proxy, id_file=None, pool=None):
+        """
+        Wraps `sync_with_nodes()` for a single node so that it can be run in a
+        worker thread with its own database connection.
+        """
+        try:
+            Command.sync_with_nodes({node_id: node}, is_proxy, id_file,
+                                    pool=pool, lock_storage=False)
+        finally:
+            # every thread gets its own database connection from Django which
+            # has to be closed explicitly
+            connection.close()
+
+    @staticmethod
+    def sync_with_nodes(nodes, is_proxy, id_file=None, pool=None,
+                        lock_storage=True):
         """
         Synchronizes this META-SHARE node with the given other META-SHARE nodes.
         
@@ -81,26 +150,33 @@ class Command(BaseCommand):
             to synchronize with
         `is_proxy` must be True if this node is a proxy for the given nodes;
             it must be False if the given nodes are not proxied by this node
+        `pool` is an optional thread pool used for downloading resources
+            concurrently
+        `lock_storage` must be False if the caller already holds the storage
+            lock
         """
         for node_id, node in nodes.items():
             LOGGER.info("syncing with node {} at {} ...".format(
               node_id, node['URL']))
+            lock = None
             try:
                 # before starting the actual synchronization, make sure to lock
                 # the storage so that any other processes with heavy/frequent
                 # operations on the storage don't get in our way
-                lock = Lock('storage')
-                lock.acquire()
+                if lock_storage:
+                    lock = Lock('storage')
+                    lock.acquire()
                 Command.sync_with_single_node(
-                  node_id, node, is_proxy, id_file=id_file)
+                  node_id, node, is_proxy, id_file=id_file, pool=pool)
             except:
                 LOGGER.error('There was an error while trying to sync with '
                     'node "%s":', node_id, exc_info=True)
             finally:
-                lock.release()
+                if lock is not None:
+                    lock.release()
 
     @staticmethod
-    def sync_with_single_node(node_id, node, is_proxy, id_file=None):
+    def sync_with_single_node(node_id, node, is_proxy, id_file=None, pool=None):
         """
         Synchronizes this META-SHARE node with another META-SHARE node using
         the given node description.
@@ -111,14 +187,36 @@ class Command(BaseCommand):
             synchronize with
         `is_proxy` must be True if this node is a proxy for the given nodes;
             it must be False if the given nodes are not proxied by this node
+        `pool` is an optional thread pool used for downloading the added and
+            updated resources concurrently; changes to the local storage are
+            always serialized
         """
+        start = time.time()
 
         # login
         url = node['URL']
         user_name = node['USERNAME']
         password = node['PASSWORD']
         opener = login("{0}/login/".format(url), user_name, password)
+        try:
+            Command._sync_with_logged_in_node(node_id, node, is_proxy,
+              opener, start, id_file=id_file, pool=pool)
+        finally:
+            # close all persistent connections to the node
+            opener.close()
+
+    @staticmethod
+    def _sync_with_logged_in_node(node_id, node, is_proxy, opener, start,
+                                  id_file=None, pool=None):
+        """
+        Synchronizes this META-SHARE node with another META-SHARE node using
+        the given node description and logged-in `SyncSession`.
         
+        `start` is the time at which the synchronization with the node started;
+        see `sync_with_single_node()` for the other arguments.
+        """
+        url = node['URL']
+
         # create inventory url
         inv_url = "{0}/sync/?".format(url)
         # add sync protocols to url
@@ -127,11 +225,32 @@ class Command(BaseCommand):
             if (index < len(settings.SYNC_PROTOCOLS) - 1):
                 inv_url = inv_url + "&"
         
+        # ask for the inventory changes since the last successful
+        # synchronization if there was one
+        cursor = get_inventory_cursor(node_id)
+        if cursor is not None:
+            inv_url = inv_url + "&cursor={}".format(cursor)
+
         # get the inventory list 
-        remote_inventory = get_inventory(opener, inv_url)
+        sync_protocol, remote_inventory = \
+          get_inventory_with_protocol(opener, inv_url)
+        if sync_protocol == INCREMENTAL_SYNC_PROTOCOL:
+            next_cursor = remote_inventory['cursor']
+            is_full_inventory = remote_inventory['full']
+            remote_deleted = remote_inventory['deleted']
+            remote_inventory = remote_inventory['inventory']
+        else:
+            next_cursor = None
+            is_full_inventory = True
+            remote_deleted = []
         remote_inventory_count = len(remote_inventory)
-        LOGGER.info("Remote node {} contains {} resources".format(
-          node_id, remote_inventory_count))
+        if is_full_inventory:
+            LOGGER.info("Remote node {} contains {} resources".format(
+              node_id, remote_inventory_count))
+        else:
+            LOGGER.info("Remote node {} reports {} changed and {} deleted "
+              "resources since change {}".format(node_id,
+              remote_inventory_count, len(remote_deleted), cursor))
         
         # create a dictionary of uuid's and digests of resource from the local 
         # inventory that stem from the remote node
@@ -179,8 +298,13 @@ class Command(BaseCommand):
                       node_id, remote_res_id, source_node))
                 except ObjectDoesNotExist:
                     resources_to_add.append(remote_res_id)
-        # remaining local inventory resources are to delete
-        resources_to_delete = local_inventory.keys()
+        # remaining local inventory resources are to delete; an incremental
+        # inventory explicitly lists the deleted resources instead
+        if is_full_inventory:
+            resources_to_delete = local_inventory.keys()
+        else:
+            resources_to_delete = [res_id for res_id in remote_deleted
+                                   if res_id in local_inventory]
 
         # print informative messages to the user
         resources_to_add_count = len(resources_to_add)
@@ -195,49 +319,64 @@ class Command(BaseCommand):
         else:
             _copy_status = REMOTE
 
-        # add resources from remote inventory
+        # download added and updated resources from the remote inventory;
+        # the downloads may run concurrently, but each downloaded resource is
+        # written to the local storage one after the other
         num_added = 0
-        for res_id in resources_to_add:
-            try:
-                LOGGER.info("adding resource {0} from node {1}".format(res_id, node_id))
-                res_obj = Command._get_remote_resource(
-                  res_id, remote_inventory[res_id], node_id, node, opener, _copy_status)
-                if not id_file is None:
-                    id_file.write("--->RESOURCE_ID:{0};STORAGE_IDENTIFIER:{1}\n"\
-                        .format(res_obj.id, res_obj.storage_object.identifier))
-                num_added += 1
-            except:
-                LOGGER.error("Error while adding resource {}".format(res_id),
-                    exc_info=True)
-
-        # update resources from remote inventory
         num_updated = 0
-        for res_id in resources_to_update:
-            try:
-                LOGGER.info("updating resource {0} from node {1}".format(res_id, node_id))
-                res_obj = Command._get_remote_resource(
-                  res_id, remote_inventory[res_id], node_id, node, opener, _copy_status)
-                if not id_file is None:
-                    id_file.write("--->RESOURCE_ID:{0};STORAGE_IDENTIFIER:{1}\n"\
-                        .format(res_obj.id, res_obj.storage_object.identifier))
-                    if remote_inventory[res_id] != res_obj.storage_object.digest_checksum:
+        to_download = [(res_id, False) for res_id in resources_to_add] \
+          + [(res_id, True) for res_id in resources_to_update]
+        if sync_protocol == INCREMENTAL_SYNC_PROTOCOL:
+            # sync protocol 2.0 nodes provide many resources in one request
+            batches = [to_download[i:i + settings.SYNC_BATCH_SIZE]
+              for i in range(0, len(to_download), settings.SYNC_BATCH_SIZE)]
+            fetch = lambda batch: Command._fetch_remote_resources(batch,
+              remote_inventory, node_id, node, opener)
+        else:
+            batches = [[item] for item in to_download]
+            fetch = lambda batch: [Command._fetch_remote_resource(batch[0][0],
+              batch[0][1], remote_inventory[batch[0][0]], node_id, node,
+              opener)]
+        if pool is None:
+            results = imap(fetch, batches)
+        else:
+            results = pool.imap_unordered(fetch, batches)
+        for res_id, is_update, full_metadata, error in \
+                chain.from_iterable(results):
+            if error is not None:
+                LOGGER.error("Error while {} resource {}: {}".format(
+                  is_update and "updating" or "adding", res_id, error))
+                continue
+            with WRITE_LOCK:
+                try:
+                    res_obj = Command._store_remote_resource(
+                      remote_inventory[res_id], full_metadata, node_id,
+                      _copy_status, id_file)
+                except:
+                    LOGGER.error("Error while {} resource {}".format(
+                      is_update and "updating" or "adding", res_id),
+                      exc_info=True)
+                    continue
+                if is_update:
+                    if not id_file is None and remote_inventory[res_id] \
+                            != res_obj.storage_object.digest_checksum:
                         id_file.write("Different digests!\n")
-                num_updated += 1
-            except:
-                LOGGER.error("Error while updating resource {}".format(res_id),
-                    exc_info=True)
+                    num_updated += 1
+                else:
+                    num_added += 1
 
         # delete resources from remote inventory
         num_deleted = 0
         for res_id in resources_to_delete:
-            try:
-                LOGGER.info("removing resource {0} from node {1}".format(res_id, node_id))
-                _so_to_remove = StorageObject.objects.get(identifier=res_id)
-                remove_resource(_so_to_remove)
-                num_deleted += 1
-            except:
-                LOGGER.error("Error while removing resource {}".format(res_id),
-                    exc_info=True)
+            with WRITE_LOCK:
+                try:
+                    LOGGER.info("removing resource {0} from node {1}".format(res_id, node_id))
+                    _so_to_remove = StorageObject.objects.get(identifier=res_id)
+                    remove_resource(_so_to_remove)
+                    num_deleted += 1
+                except:
+                    LOGGER.error("Error while removing resource {}".format(res_id),
+                        exc_info=True)
 
         LOGGER.info("{} of {} resources successfully added." \
             .format(num_added, resources_to_add_count))
@@ -246,18 +385,79 @@ class Command(BaseCommand):
         LOGGER.info("{} of {} resources successfully removed." \
             .format(num_deleted, resources_to_delete_count))
 
+        # only continue with the next inventory changes next time if all
+        # changes have been applied; otherwise the changes are requested again
+        if num_added == resources_to_add_count \
+                and num_updated == resources_to_update_count \
+                and num_deleted == resources_to_delete_count:
+            with WRITE_LOCK:
+                set_inventory_cursor(node_id, next_cursor)
+        _duration = max(time.time() - start, 0.001)
+        LOGGER.info("synchronized {} resources with node {} in {:.1f} seconds "
+          "({:.2f} resources/second)".format(
+          num_added + num_updated + num_deleted, node_id, _duration,
+          (num_added + num_updated + num_deleted) / _duration))
+
 
     @staticmethod
-    def _get_remote_resource(resource_id, resource_digest, node_id, node, opener, copy_status):
+    def _fetch_remote_resource(resource_id, is_update, resource_digest,
+                               node_id, node, opener):
         """
-        Retrieves from the given node the resource for the given id and
-        adds/updates it at the current node with the given copy status using the
-        given opener 
+        Retrieves from the given node the full metadata of the resource with the
+        given id using the given opener.
+        
+        Returns a quadruple of the resource id, the given update flag, a pair of
+        storage JSON and metadata XML string and an error message; either the
+        pair or the error message are None. No exceptions are raised so that
+        this method can be safely used in a thread pool.
         """
-        # Get the json storage object and the actual metadata xml
-        storage_json, resource_xml_string = \
-          get_full_metadata(opener, "{0}/sync/{1}/metadata/" \
-                .format(node['URL'], resource_id), resource_digest)
+        LOGGER.info("{0} resource {1} from node {2}".format(
+          is_update and "updating" or "adding", resource_id, node_id))
+        try:
+            full_metadata = get_full_metadata(opener, "{0}/sync/{1}/metadata/" \
+                    .format(node['URL'], resource_id), resource_digest)
+            return resource_id, is_update, full_metadata, None
+        except:
+            return resource_id, is_update, None, format_exc()
+
+    @staticmethod
+    def _fetch_remote_resources(items, remote_inventory, node_id, node, opener):
+        """
+        Retrieves from the given node the full metadata of several resources
+        with a single request using the given opener.
+        
+        `items` is a list of pairs of resource id and update flag;
+        `remote_inventory` is the dict of remote resource ids and digests.
+        
+        Returns a list of quadruples as described in `_fetch_remote_resource()`.
+        No exceptions are raised so that this method can be safely used in a
+        thread pool.
+        """
+        is_update = dict(items)
+        LOGGER.info("downloading {0} resources from node {1}".format(
+          len(items), node_id))
+        try:
+            return [(res_id, is_update[res_id], full_metadata, error)
+              for res_id, full_metadata, error in get_full_metadata_batch(
+                opener, "{0}/sync/metadata/".format(node['URL']),
+                dict((res_id, remote_inventory[res_id]) for res_id, _ in items))]
+        except:
+            error = format_exc()
+            return [(res_id, _is_update, None, error)
+                    for res_id, _is_update in items]
+
+    @staticmethod
+    def _store_remote_resource(resource_digest, full_metadata, node_id,
+                               copy_status, id_file=None):
+        """
+        Adds/updates at the current node the given downloaded full metadata of
+        a resource with the given copy status. The caller is responsible for
+        serializing calls to this method.
+        """
+        storage_json, resource_xml_string = full_metadata
         res_obj = add_or_update_resource(storage_json, resource_xml_string,
                         resource_digest, copy_status, source_node=node_id)
+        if not id_file is None:
+            id_file.write("--->RESOURCE_ID:{0};STORAGE_IDENTIFIER:{1}\n"\
+                .format(res_obj.id, res_obj.storage_object.identifier))
         return res_obj
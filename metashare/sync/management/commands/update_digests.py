@@ -2,12 +2,20 @@
 Management utility to trigger digest updating.
 """
 from django.core.management.base import BaseCommand
+from optparse import make_option
+from metashare import settings
 from metashare.storage.models import update_digests
 from metashare.utils import Lock
 
 
 class Command(BaseCommand):
     
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--processes', action='store', type='int',
+                    dest='processes', default=settings.DIGEST_WORKERS,
+                    help='number of worker processes for updating digests'),
+    )
+
     help = 'Updates the resource digests if they are older than MAX_DIGEST_AGE / 2 seconds'
     
     def handle(self, *args, **options):
@@ -20,6 +28,7 @@ class Command(BaseCommand):
             # storage don't get in our way
             lock = Lock('storage')
             lock.acquire()
-            update_digests()
+            update_digests(
+              processes=options.get('processes') or settings.DIGEST_WORKERS)
         finally:
             lock.release()
@@ -0,0 +1,46 @@
+from django.db import models
+
+
+class InventoryCursor(models.Model):
+    """
+    Models the position in the inventory change log of another META-SHARE node
+    up to which this node has successfully synchronized.
+    """
+    node_id = models.CharField(max_length=32, unique=True, editable=False,
+      help_text="(Read-only) id of the node as set in local_settings.py in " \
+      "CORE_NODES and PROXIED_NODES.")
+
+    cursor = models.PositiveIntegerField(default=0, editable=False,
+      help_text="(Read-only) latest inventory change sequence number of the " \
+      "node which has been synchronized.")
+
+    def __unicode__(self):
+        """
+        Returns the Unicode representation for this inventory cursor instance.
+        """
+        return u'<InventoryCursor "{0}": {1}>'.format(self.node_id, self.cursor)
+
+
+def get_inventory_cursor(node_id):
+    """
+    Returns the latest synchronized inventory change sequence number for the
+    node with the given id or None if there is none.
+    """
+    try:
+        return InventoryCursor.objects.get(node_id=node_id).cursor
+    except InventoryCursor.DoesNotExist:
+        return None
+
+
+def set_inventory_cursor(node_id, cursor):
+    """
+    Sets the latest synchronized inventory change sequence number for the node
+    with the given id; a `None` cursor resets the synchronization state so that
+    the full inventory will be requested next time.
+    """
+    if cursor is None:
+        InventoryCursor.objects.filter(node_id=node_id).delete()
+        return
+    _cursor, _ = InventoryCursor.objects.get_or_create(node_id=node_id)
+    _cursor.cursor = cursor
+    _cursor.save()
@@ -3,13 +3,15 @@ A command-line enabled tool implementing the client end of the META-SHARE
 client-server protocol for synchronizing metadata.  
 '''
 
-import urllib
-import urllib2
 import contextlib
 import json
 import os
 import shutil
 import logging
+import tempfile
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from zipfile import ZipFile
 from StringIO import StringIO
 from traceback import format_exc
@@ -21,43 +23,105 @@ from metashare.settings import LOG_HANDLER
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(LOG_HANDLER)
 
-# Idea taken from 
-# http://stackoverflow.com/questions/5082128/how-do-i-authenticate-a-urllib2-script-in-order-to-access-https-web-services-fro
+# the first sync protocol version which supports incremental inventories and
+# batched full metadata requests
+INCREMENTAL_SYNC_PROTOCOL = '2.0'
+
+# number of times a request to another node is retried on connection errors
+# and on transient server errors
+MAX_RETRIES = 3
+
+# the n-th retry of a request is delayed by RETRY_BACKOFF_FACTOR * 2^(n-1)
+# seconds
+RETRY_BACKOFF_FACTOR = 0.5
+
+# number of bytes which are read at once when a response is streamed to disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class SyncSession(object):
+    """
+    An HTTP session with another META-SHARE node.
+    
+    The session keeps a pool of persistent (keep-alive) connections to the node
+    so that consecutive requests don't require new TCP/TLS handshakes. Requests
+    are retried with an exponential backoff on connection errors and transient
+    server errors. Cookies (such as the session and CSRF cookies) are shared by
+    all requests of the session. The session can be used from several threads.
+    """
+    def __init__(self, pool_size=None):
+        """
+        Creates a new session which keeps at most `pool_size` persistent
+        connections; defaults to the number of concurrent sync downloads.
+        """
+        self.session = requests.Session()
+        _adapter = HTTPAdapter(pool_connections=1,
+          pool_maxsize=pool_size or settings.SYNC_WORKERS,
+          max_retries=Retry(total=MAX_RETRIES,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=(500, 502, 503, 504)))
+        self.session.mount('http://', _adapter)
+        self.session.mount('https://', _adapter)
+
+    def open(self, url, data=None, headers=None, stream=False):
+        """
+        Sends a GET request (or a POST request if `data` is given) to the given
+        URL and returns the response. If `stream` is True, then the response
+        body is only downloaded when it is read.
+        Raises HTTPError if HTTP response status is in the 400-599 range.
+        """
+        if data is None:
+            response = self.session.get(url, headers=headers, stream=stream)
+        else:
+            response = self.session.post(url, data=data, headers=headers,
+                                         stream=stream)
+        response.raise_for_status()
+        return response
+
+    def get_cookie(self, name):
+        """
+        Returns the value of the cookie with the given name or None if there is
+        no such cookie in this session.
+        """
+        return self.session.cookies.get(name)
+
+    def close(self):
+        """
+        Closes all pooled connections of this session.
+        """
+        self.session.close()
+
+
 def login(login_url, username, password):
     """
     Login to django site.
-    Returns an opener with which logged-in requests can be sent.
-    Raises URLError if HTTP response status is in the 400-599 range.
-    """
-    cookie_proc = urllib2.HTTPCookieProcessor()
-    opener = urllib2.build_opener(cookie_proc)
-    urllib2.install_opener(opener)
-    opener.open(login_url)
-
-    csrftoken = None
-    for cookie in cookie_proc.cookiejar:
-        if cookie.name == 'csrftoken':
-            csrftoken = cookie.value
-            break
-    if csrftoken is None:
-        raise Exception("Response does not contain a csrftoken, cannot continue")
-    
-    post_data = urllib.urlencode({
-        'username':username,
-        'password':password,
-        'this_is_the_login_form':1,
-        'csrfmiddlewaretoken':csrftoken,
-    })
-
-    response = None
+    Returns a `SyncSession` with which logged-in requests can be sent.
+    Raises HTTPError if HTTP response status is in the 400-599 range.
+    """
+    opener = SyncSession()
     try:
-        response = opener.open(login_url, post_data)
-        html = response.read()
-        if not 'Logout' in html:
-            raise Exception("Expected html page with a Logout button but got:\n{0}".format(html))
-    finally:
-        if response is not None:
-            response.close()
+        opener.open(login_url).close()
+
+        csrftoken = opener.get_cookie('csrftoken')
+        if csrftoken is None:
+            raise Exception("Response does not contain a csrftoken, cannot continue")
+
+        post_data = {
+            'username':username,
+            'password':password,
+            'this_is_the_login_form':1,
+            'csrfmiddlewaretoken':csrftoken,
+        }
+
+        # Django's CSRF protection requires a referer for HTTPS requests
+        with contextlib.closing(opener.open(login_url, post_data,
+                headers={'Referer': login_url})) as response:
+            html = response.content
+            if not 'Logout' in html:
+                raise Exception("Expected html page with a Logout button but got:\n{0}".format(html))
+    except:
+        opener.close()
+        raise
     return opener
 
 
@@ -66,6 +130,15 @@ def get_inventory(opener, inventory_url):
     Obtain the inventory from a logged-in opener and fill it into a JSON structure.
     Returns the JSON structure.
     """
+    return get_inventory_with_protocol(opener, inventory_url)[1]
+
+
+def get_inventory_with_protocol(opener, inventory_url):
+    """
+    Obtain the inventory from a logged-in opener and fill it into a JSON structure.
+    Returns a pair of the sync protocol version chosen by the server and the
+    JSON structure.
+    """
     try:
         with contextlib.closing(opener.open(inventory_url)) as response:
             if not 'sync-protocol' in response.headers:
@@ -73,11 +146,11 @@ def get_inventory(opener, inventory_url):
                     'send any sync protocol version along with its metadata '
                     'inventory. This indicates an incompatible pre-v3.0 node.'
                     .format(inventory_url))
-            data = response.read()
+            data = response.content
             with ZipFile(StringIO(data), 'r') as inzip:
                 json_inventory = json.load(inzip.open('inventory.json'))
                 # TODO: add error handling and verification of json structure
-                return json_inventory
+                return response.headers['sync-protocol'], json_inventory
     except ConnectionException:
         raise
     except:
@@ -94,7 +167,7 @@ def get_full_metadata(opener, full_metadata_url, expected_digest):
     does not have an md5 digest identical to expected_digest.
     """
     with contextlib.closing(opener.open(full_metadata_url)) as response:
-        data = response.read()
+        data = response.content
         with ZipFile(StringIO(data), 'r') as inzip:
             with inzip.open('metadata.xml') as resource_xml:
                 resource_xml_string = resource_xml.read()
@@ -110,6 +183,64 @@ def get_full_metadata(opener, full_metadata_url, expected_digest):
             return storage_json, resource_xml_string
 
 
+def get_full_metadata_batch(opener, batch_metadata_url, expected_digests):
+    """
+    Obtain the full metadata records for several resources at once (sync
+    protocol 2.0).
+    
+    `expected_digests` is a dict of resource identifiers and the expected
+    digest checksums of the resources.
+    
+    Returns a generator of triples of resource identifier, pair of
+    storage_json_string and resource_xml_string, and an error message; either
+    the pair or the error message are None. The digest of each record is
+    verified while iterating over the records; records for which the digest
+    does not match expected_digests are reported with a CorruptDataException
+    error message.
+    """
+    # the zip file of a batch may be large, so it is not kept in memory
+    with tempfile.TemporaryFile() as batch_file:
+        with contextlib.closing(opener.open(batch_metadata_url,
+                {'identifier': expected_digests.keys()}, stream=True)) \
+                as response:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                batch_file.write(chunk)
+        batch_file.seek(0)
+        for record in _read_full_metadata_batch(batch_file,
+                batch_metadata_url, expected_digests):
+            yield record
+
+
+def _read_full_metadata_batch(batch_file, batch_metadata_url,
+                              expected_digests):
+    """
+    Reads the full metadata records from the given zip file of a batch; see
+    `get_full_metadata_batch()`.
+    """
+    with ZipFile(batch_file, 'r') as inzip:
+        missing = set(json.loads(inzip.read('missing.json')))
+        for res_id, expected_digest in expected_digests.iteritems():
+            if res_id in missing:
+                yield res_id, None, "Resource '{0}' is not available at " \
+                    "'{1}'.".format(res_id, batch_metadata_url)
+                continue
+            try:
+                resource_xml_string = \
+                    inzip.read('{0}/metadata.xml'.format(res_id))
+                storage_json_string = \
+                    inzip.read('{0}/storage-global.json'.format(res_id))
+                if not expected_digest == compute_digest_checksum(
+                        resource_xml_string, storage_json_string):
+                    raise CorruptDataException("Checksum error for resource "
+                        "'{0}' from '{1}'.".format(res_id, batch_metadata_url))
+                record = (res_id, (json.loads(storage_json_string),
+                                   resource_xml_string), None)
+            # pylint: disable-msg=W0703
+            except Exception:
+                record = (res_id, None, format_exc())
+            yield record
+
+
 def remove_resource(storage_object, keep_stats=False):
     """
     Completely removes the given storage object and its associated language 
@@ -16,8 +16,12 @@ from django.core.management import call_command
 from metashare import settings, test_utils
 from metashare.repository.models import resourceInfoType_model
 from metashare.storage.models import INGESTED, INTERNAL, StorageObject, \
-    PUBLISHED, compute_digest_checksum, MASTER, PROXY
+    PUBLISHED, compute_digest_checksum, MASTER, PROXY, \
+    get_last_inventory_change
 from metashare.settings import DJANGO_BASE, LOGIN_URL, LOG_HANDLER
+from metashare.sync.sync_utils import SyncSession, MAX_RETRIES, \
+    RETRY_BACKOFF_FACTOR
+from metashare.sync.views import INVENTORY_SNAPSHOT_NAME
 from metashare.test_utils import set_index_active
 
 # Setup logging support.
@@ -152,6 +156,13 @@ class MetadataSyncTest (TestCase):
         LOGGER.info("finished '{}' tests".format(cls.__name__))
     
 
+    def setUp(self):
+        # the inventory snapshot is not reset by the per-test database
+        # transaction rollback
+        _snapshot = os.path.join(settings.STORAGE_PATH, INVENTORY_SNAPSHOT_NAME)
+        if os.path.isfile(_snapshot):
+            os.remove(_snapshot)
+
     def test_unprotected_inventory(self):
         settings.SYNC_NEEDS_AUTHENTICATION = False
         client = Client()
@@ -248,6 +259,21 @@ class MetadataSyncTest (TestCase):
         response = client.get('{0}{1}/metadata/'.format(self.SYNC_BASE, resource_uuid))
         self.assertIsForbidden(response)
 
+    def test_views_do_not_create_missing_digests(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        storage_object = StorageObject.objects \
+            .filter(publication_status=INGESTED)[0]
+        storage_object.digest_checksum = None
+        storage_object.save()
+        response = Client().get('{0}{1}/metadata/'.format(self.SYNC_BASE,
+                                storage_object.identifier))
+        self.assertEquals(404, response.status_code)
+        response = Client().get(self.INVENTORY_URL + "?sync_protocol=1.0")
+        self.assertFalse(
+          storage_object.identifier in self.extract_inventory(response))
+        self.assertIsNone(StorageObject.objects.get(
+          identifier=storage_object.identifier).digest_checksum)
+
     def test_metadata_digest(self):
         settings.SYNC_NEEDS_AUTHENTICATION = False
         client = Client()
@@ -265,6 +291,45 @@ class MetadataSyncTest (TestCase):
         self.assertEquals(expected_digest, compute_digest_checksum(
           resource_xml_string, storage_json_string))
 
+    def test_full_metadata_batch(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        internal_id = StorageObject.objects \
+            .filter(publication_status=INTERNAL)[0].identifier
+        unknown_id = '0' * 64
+        expected = {}
+        for storage_object in StorageObject.objects \
+                .exclude(publication_status=INTERNAL):
+            expected[storage_object.identifier] = \
+                storage_object.digest_checksum
+        response = Client().post('{0}metadata/'.format(self.SYNC_BASE),
+          {'identifier': expected.keys() + [internal_id, unknown_id]})
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('application/zip', response['Content-Type'])
+        with ZipFile(StringIO(response.content), 'r') as inzip:
+            for res_id, digest in expected.iteritems():
+                resource_xml_string = \
+                    inzip.read('{0}/metadata.xml'.format(res_id))
+                self.assertIsNotNone(fromstring(resource_xml_string))
+                storage_json_string = \
+                    inzip.read('{0}/storage-global.json'.format(res_id))
+                self.assertEquals(digest, compute_digest_checksum(
+                  resource_xml_string, storage_json_string))
+            self.assertEquals(sorted([internal_id, unknown_id]),
+                              json.loads(inzip.read('missing.json')))
+            self.assertEquals(2 * len(expected) + 1, len(inzip.namelist()))
+
+    def test_full_metadata_batch_requires_post(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        response = Client().get('{0}metadata/'.format(self.SYNC_BASE))
+        self.assertEquals(405, response.status_code)
+
+    def test_anonymous_cannot_reach_full_metadata_batch(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = True
+        resource = resourceInfoType_model.objects.all()[0]
+        response = Client().post('{0}metadata/'.format(self.SYNC_BASE),
+          {'identifier': [resource.storage_object.identifier]})
+        self.assertIsForbidden(response)
+
     def test_inventory_no_sync_protocol(self):
         settings.SYNC_NEEDS_AUTHENTICATION = False
         response = Client().get(self.INVENTORY_URL)
@@ -285,6 +350,109 @@ class MetadataSyncTest (TestCase):
         inventory = self.extract_inventory(response)
         self.assertNotEquals(0, len(inventory))
      
+    def test_incremental_inventory_without_cursor_is_full(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        response = Client().get(
+          self.INVENTORY_URL + "?sync_protocol=2.0&sync_protocol=1.0")
+        self.assertEquals(200, response.status_code)
+        self.assertEquals("2.0", response['Sync-Protocol'])
+        inventory = self.extract_inventory(response)
+        self.assertTrue(inventory['full'])
+        self.assertEquals(2, len(inventory['inventory']))
+        self.assertEquals([], inventory['deleted'])
+        self.assertTrue(inventory['cursor'] >= 0)
+
+    def test_incremental_inventory_reports_changes_since_cursor(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        response = Client().get(self.INVENTORY_URL + "?sync_protocol=2.0")
+        cursor = self.extract_inventory(response)['cursor']
+        full_inventory = self.extract_inventory(response)['inventory']
+        # nothing has changed in the meantime; only recent changes are served
+        # again
+        response = Client().get(self.INVENTORY_URL
+          + "?sync_protocol=2.0&cursor={}".format(cursor))
+        inventory = self.extract_inventory(response)
+        self.assertFalse(inventory['full'])
+        for res_id, digest in inventory['inventory'].iteritems():
+            self.assertEquals(full_inventory[res_id], digest)
+        self.assertEquals([], inventory['deleted'])
+        self.assertEquals(cursor, inventory['cursor'])
+        # change the digest of one resource and remove another one from the
+        # inventory
+        changed_so = StorageObject.objects.filter(publication_status=INGESTED)[0]
+        changed_so.digest_checksum = '0' * 32
+        changed_so.save()
+        removed_so = StorageObject.objects.filter(publication_status=PUBLISHED)[0]
+        removed_so.publication_status = INTERNAL
+        removed_so.save()
+        response = Client().get(self.INVENTORY_URL
+          + "?sync_protocol=2.0&cursor={}".format(cursor))
+        inventory = self.extract_inventory(response)
+        self.assertFalse(inventory['full'])
+        self.assertEquals({changed_so.identifier: '0' * 32},
+                          inventory['inventory'])
+        self.assertEquals([removed_so.identifier], inventory['deleted'])
+        self.assertTrue(inventory['cursor'] > cursor)
+
+    def test_incremental_inventory_serves_recent_changes_again(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        changed_so = StorageObject.objects.filter(publication_status=INGESTED)[0]
+        changed_so.digest_checksum = '0' * 32
+        changed_so.save()
+        # the change is served again even to a peer whose cursor already
+        # covers it, as it may not have been visible to that peer before
+        cursor = get_last_inventory_change()
+        response = Client().get(self.INVENTORY_URL
+          + "?sync_protocol=2.0&cursor={}".format(cursor))
+        inventory = self.extract_inventory(response)
+        self.assertFalse(inventory['full'])
+        self.assertEquals('0' * 32,
+                          inventory['inventory'][changed_so.identifier])
+        self.assertEquals(cursor, inventory['cursor'])
+
+    def test_incremental_inventory_invalid_cursor_is_full(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        for _cursor in ('abc', '-1', '999999999'):
+            response = Client().get(self.INVENTORY_URL
+              + "?sync_protocol=2.0&cursor={}".format(_cursor))
+            inventory = self.extract_inventory(response)
+            self.assertTrue(inventory['full'])
+            self.assertEquals(2, len(inventory['inventory']))
+
+    def test_unchanged_inventory_is_not_modified(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        for protocol in ('1.0', '2.0'):
+            url = self.INVENTORY_URL + "?sync_protocol={}".format(protocol)
+            response = Client().get(url)
+            self.assertValidInventoryResponse(response)
+            etag = response['ETag']
+            response = Client().get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(304, response.status_code)
+            self.assertEquals('', response.content)
+            self.assertEquals(protocol, response['Sync-Protocol'])
+
+    def test_changed_inventory_is_sent_again(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        response = Client().get(self.INVENTORY_URL + "?sync_protocol=1.0")
+        etag = response['ETag']
+        changed_so = StorageObject.objects.filter(publication_status=INGESTED)[0]
+        changed_so.digest_checksum = '0' * 32
+        changed_so.save()
+        response = Client().get(self.INVENTORY_URL + "?sync_protocol=1.0",
+                                HTTP_IF_NONE_MATCH=etag)
+        self.assertValidInventoryResponse(response)
+        self.assertNotEquals(etag, response['ETag'])
+        inventory = self.extract_inventory(response)
+        self.assertEquals(2, len(inventory))
+        self.assertEquals('0' * 32, inventory[changed_so.identifier])
+        # the snapshot is also updated on deletions
+        removed_so = StorageObject.objects.filter(publication_status=PUBLISHED)[0]
+        removed_so.publication_status = INTERNAL
+        removed_so.save()
+        response = Client().get(self.INVENTORY_URL + "?sync_protocol=1.0")
+        inventory = self.extract_inventory(response)
+        self.assertEquals([changed_so.identifier], inventory.keys())
+
     def test_proxy_check(self):
         
         # define proxied nodes
@@ -341,3 +509,28 @@ class MetadataSyncTest (TestCase):
         self.assertFalse(os.path.isdir(res1_folder))
         self.assertFalse(os.path.isdir(res2_folder))
         self.assertTrue(os.path.isdir(res3_folder))        
+
+
+class SyncSessionTest(TestCase):
+    """
+    Tests the pooled HTTP session used for talking to other nodes.
+    """
+    def test_session_pools_connections_and_retries(self):
+        session = SyncSession(pool_size=7)
+        try:
+            for url in ('http://www.example.com/', 'https://www.example.com/'):
+                adapter = session.session.get_adapter(url)
+                self.assertEquals(7, adapter._pool_maxsize)
+                self.assertEquals(MAX_RETRIES, adapter.max_retries.total)
+                self.assertEquals(RETRY_BACKOFF_FACTOR,
+                                  adapter.max_retries.backoff_factor)
+        finally:
+            session.close()
+
+    def test_session_defaults_to_sync_workers_pool_size(self):
+        session = SyncSession()
+        try:
+            self.assertEquals(settings.SYNC_WORKERS, session.session \
+                .get_adapter('http://www.example.com/')._pool_maxsize)
+        finally:
+            session.close()
@@ -1,11 +1,36 @@
 from django.http import HttpResponse
 import json
+import os
 from zipfile import ZipFile
 from metashare import settings
+from metashare.utils import stream_zip, Lock
 from django.db.models import Q
 from django.shortcuts import get_object_or_404
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from metashare.storage.models import StorageObject, MASTER, PROXY, INTERNAL, \
-    REMOTE
+    REMOTE, InventoryChange, get_last_inventory_change, record_inventory_change
+from metashare.sync.sync_utils import INCREMENTAL_SYNC_PROTOCOL
+
+# block size in bytes for streaming digest zip files
+MAXIMUM_READ_BLOCK_SIZE = 4096
+
+# name of the inventory snapshot file in the storage folder
+INVENTORY_SNAPSHOT_NAME = 'inventory.zip'
+
+# maximum number of resources which may be requested at once from
+# `full_metadata_batch()`
+MAX_BATCH_SIZE = 500
+
+# number of inventory changes before a given cursor which are served again
+# with each incremental inventory; change sequence numbers are assigned when
+# the changes are recorded but may become visible in a different order (e.g.,
+# on PostgreSQL when a transaction with a lower sequence number commits after
+# one with a higher sequence number), so a change below a handed out cursor
+# may still appear afterwards; serving changes again is harmless as peers
+# compare the digests with their local copies
+INVENTORY_CHANGE_WINDOW = 1000
 
 
 def inventory(request):
@@ -26,33 +51,199 @@ def inventory(request):
         # no match was found between the client and server supported sync 
         # protocols
         return HttpResponse(status=501)
-    
-    response = HttpResponse(status=200, content_type='application/zip')
+
+    # the incremental sync protocol only returns the changes since the given
+    # cursor if it is valid (e.g., it may stem from before a reset of this node)
+    cursor = None
+    if sync_protocol == INCREMENTAL_SYNC_PROTOCOL:
+        try:
+            cursor = int(request.GET.get('cursor'))
+        except (TypeError, ValueError):
+            pass
+        if cursor is not None and \
+                (cursor < 0 or cursor > get_last_inventory_change()):
+            cursor = None
+
+    if cursor is None:
+        # full inventories are served from the inventory snapshot
+        snapshot, snapshot_cursor = _open_inventory_snapshot()
+        etag = quote_etag('{0}-{1}'.format(sync_protocol, snapshot_cursor))
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            snapshot.close()
+            response = HttpResponse(status=304)
+        elif sync_protocol == INCREMENTAL_SYNC_PROTOCOL:
+            with ZipFile(snapshot, 'r') as inzip:
+                json_response = {'cursor': snapshot_cursor, 'full': True,
+                  'inventory': json.load(inzip.open('inventory.json')),
+                  'deleted': []}
+            snapshot.close()
+            response = _get_inventory_response(json_response)
+        else:
+            # the snapshot is exactly the full inventory of sync protocol 1.0
+            response = HttpResponse(_stream_file(snapshot), status=200,
+                                    content_type='application/zip')
+            response['Content-Length'] = os.fstat(snapshot.fileno()).st_size
+        response['ETag'] = etag
+    else:
+        response = _get_inventory_response(_get_inventory_changes(cursor))
+
     response['Metashare-Version'] = settings.METASHARE_VERSION
-    response['Content-Disposition'] = 'attachment; filename="inventory.zip"'
     response['Sync-Protocol'] = sync_protocol
+    if response.status_code == 200:
+        response['Content-Disposition'] = 'attachment; filename="inventory.zip"'
+    return response
+
+
+def _get_inventory_response(json_response):
+    """
+    Returns an HTTP response with a zipped inventory containing the given JSON
+    structure.
+    """
+    response = HttpResponse(status=200, content_type='application/zip')
+    with ZipFile(response, 'w') as outzip:
+        outzip.writestr('inventory.json', json.dumps(json_response))
+    return response
+
 
-    # collect inventory for existing resources;
-    # consists of key - value pairs of resource identifiers and digest checksums
+def _stream_file(infile):
+    """
+    Generator which yields the content of the given file object block by block
+    and closes the file at the end.
+    """
+    try:
+        _chunk = infile.read(MAXIMUM_READ_BLOCK_SIZE)
+        while _chunk:
+            yield _chunk
+            _chunk = infile.read(MAXIMUM_READ_BLOCK_SIZE)
+    finally:
+        infile.close()
+
+
+def _get_full_inventory(log_changes=False):
+    """
+    Returns the inventory for all existing resources as a dictionary of resource
+    identifiers and digest checksums.
+    
+    log_changes (optional): if True, make sure that all resources of the
+        inventory are in the inventory change log, as deletions can only be
+        reported incrementally for logged resources
+    """
     json_response = {}
+    logged = {}
+    if log_changes:
+        logged = dict(InventoryChange.objects.filter(deleted=False) \
+            .values_list('identifier', 'digest_checksum'))
+    # digests are only read here; they are kept up-to-date by the
+    # `update_digests` command
     objects_to_sync = StorageObject.objects \
         .filter(Q(copy_status=MASTER) | Q(copy_status=PROXY)) \
-        .exclude(publication_status=INTERNAL)
+        .exclude(publication_status=INTERNAL) \
+        .exclude(digest_checksum__isnull=True)
     # 'from' parameter for restricting the inventory CAN NOT be used anymore
-    # since it would break to automatic detection of deleted resources
-#    if 'from' in request.GET:
-#        try:
-#            fromdate = dateutil.parser.parse(request.GET['from'])
-#            objects_to_sync = objects_to_sync.filter(digest_modified__gte=fromdate)
-#        except ValueError:
-#            # If we cannot parse the date string, act as if none was provided
-#            pass
+    # since it would break to automatic detection of deleted resources; use the
+    # 'cursor' parameter of the incremental sync protocol instead
     for obj in objects_to_sync:
-        json_response[obj.identifier] = obj.get_digest_checksum()
+        json_response[obj.identifier] = obj.digest_checksum
+        if log_changes and logged.get(obj.identifier) != obj.digest_checksum:
+            record_inventory_change(obj)
+    return json_response
+
+
+def _get_inventory_changes(cursor):
+    """
+    Returns the inventory changes since the given change sequence number.
     
-    with ZipFile(response, 'w') as outzip:
-        outzip.writestr('inventory.json', json.dumps(json_response))
-    return response
+    The result is a dictionary with the following keys:
+    - 'cursor': the sequence number to send with the next request
+    - 'full': always False, i.e., 'inventory' only contains the resources
+      changed since the given cursor
+    - 'inventory': dictionary of resource identifiers and digest checksums
+    - 'deleted': list of identifiers of resources deleted since the cursor
+    
+    The last `INVENTORY_CHANGE_WINDOW` changes up to the given cursor are
+    included again in case some of them have only become visible recently.
+    """
+    inventory = {}
+    deleted = set()
+    for change in InventoryChange.objects.filter(
+            id__gt=max(0, cursor - INVENTORY_CHANGE_WINDOW)).order_by('id'):
+        if change.deleted:
+            inventory.pop(change.identifier, None)
+            deleted.add(change.identifier)
+        else:
+            inventory[change.identifier] = change.digest_checksum
+            deleted.discard(change.identifier)
+        cursor = max(cursor, change.id)
+    return {'cursor': cursor, 'full': False, 'inventory': inventory,
+            'deleted': sorted(deleted)}
+
+
+def _get_inventory_snapshot_path():
+    """
+    Returns the path of the inventory snapshot in the storage folder.
+    """
+    return os.path.join(settings.STORAGE_PATH, INVENTORY_SNAPSHOT_NAME)
+
+
+def update_inventory_snapshot():
+    """
+    Brings the inventory snapshot up-to-date with the inventory change log.
+    
+    The snapshot is a zip archive in the storage folder which contains the full
+    inventory of sync protocol 1.0 in 'inventory.json'; the archive comment is
+    the change sequence number up to which the snapshot is up-to-date. Only the
+    changes since this sequence number are applied, so that the snapshot has
+    to be created from all storage objects only once.
+    """
+    _path = _get_inventory_snapshot_path()
+    lock = Lock('inventory')
+    lock.acquire()
+    try:
+        last_change = get_last_inventory_change()
+        snapshot_cursor = None
+        if os.path.isfile(_path):
+            with ZipFile(_path, 'r') as inzip:
+                try:
+                    snapshot_cursor = int(inzip.comment)
+                except ValueError:
+                    pass
+                if snapshot_cursor == last_change:
+                    return
+                if snapshot_cursor is not None and snapshot_cursor < last_change:
+                    _inventory = json.load(inzip.open('inventory.json'))
+        if snapshot_cursor is None or snapshot_cursor > last_change:
+            # no (valid) snapshot yet; any changes while creating it (including
+            # the ones for adding missing resources to the log) are applied
+            # below
+            _inventory = _get_full_inventory(log_changes=True)
+            snapshot_cursor = last_change
+        changes = _get_inventory_changes(snapshot_cursor)
+        _inventory.update(changes['inventory'])
+        for _id in changes['deleted']:
+            _inventory.pop(_id, None)
+        snapshot_cursor = changes['cursor']
+        # write to a temporary file first so that concurrent readers always
+        # see a complete snapshot
+        with ZipFile('{0}.tmp'.format(_path), 'w') as outzip:
+            outzip.writestr('inventory.json', json.dumps(_inventory))
+            outzip.comment = str(snapshot_cursor)
+        os.rename('{0}.tmp'.format(_path), _path)
+    finally:
+        lock.release()
+
+
+def _open_inventory_snapshot():
+    """
+    Returns a pair of the opened, up-to-date inventory snapshot file and the
+    change sequence number up to which the snapshot is up-to-date.
+    """
+    update_inventory_snapshot()
+    snapshot = open(_get_inventory_snapshot_path(), 'rb')
+    with ZipFile(snapshot, 'r') as inzip:
+        snapshot_cursor = int(inzip.comment)
+    snapshot.seek(0)
+    return snapshot, snapshot_cursor
+
 
 def full_metadata(request, resource_uuid):
     if settings.SYNC_NEEDS_AUTHENTICATION and not request.user.has_perm('storage.can_sync'):
@@ -63,19 +254,60 @@ def full_metadata(request, resource_uuid):
     if storage_object.copy_status == REMOTE:
         return HttpResponse("Forbidden: the specified resource is a `REMOTE` " \
             "resource and cannot be distributed by this node.", status=403)
-    response = HttpResponse(status=200, content_type='application/zip')
-    response['Metashare-Version'] = settings.METASHARE_VERSION
-    response['Content-Disposition'] = 'attachment; filename="full-metadata.zip"'
     if storage_object.digest_checksum is None:
-        storage_object.update_storage()
-    #if storage_object.digest_checksum is None: # still no digest? something is very wrong here:
-    #    raise Exception("Object {0} has no digest".format(resource_uuid))
+        # digests are never created here but by the `update_digests` command
+        return HttpResponse("Not found: there is no digest for the given " \
+            "resource at this time.", status=404)
     zipfilename = "{0}/resource.zip".format(storage_object._storage_folder())
-    with open(zipfilename, 'rb') as inzip:
-        zipfiledata = inzip.read()
-        response.write(zipfiledata)
-#    with ZipFile(response, 'w') as outzip:
-#        outzip.writestr('storage-global.json', str(storage_object.identifier))
-#        outzip.writestr('metadata.xml', storage_object.metadata.encode('utf-8'))
+
+    # the response content is a stream of the digest zip file
+    response = HttpResponse(_stream_file(open(zipfilename, 'rb')), status=200,
+                            content_type='application/zip')
+    response['Metashare-Version'] = settings.METASHARE_VERSION
+    response['Content-Disposition'] = 'attachment; filename="full-metadata.zip"'
+    response['Content-Length'] = os.path.getsize(zipfilename)
+    return response
+
+
+@csrf_exempt
+@require_POST
+def full_metadata_batch(request):
+    """
+    Returns the full metadata of all resources whose identifiers are given in
+    the 'identifier' POST parameters as a single zip archive.
+    
+    For each resource the archive contains the entries
+    '<identifier>/metadata.xml' and '<identifier>/storage-global.json' with the
+    same content as the archive returned by `full_metadata()`. The archive is
+    streamed resource by resource. Its last entry 'missing.json' lists the
+    identifiers of the requested resources which cannot be provided.
+    
+    This view is part of sync protocol 2.0.
+    """
+    if settings.SYNC_NEEDS_AUTHENTICATION and not request.user.has_perm('storage.can_sync'):
+        return HttpResponse("Forbidden: only synchronization users can access this page.", status=403)
+    identifiers = request.POST.getlist('identifier')
+    if len(identifiers) > MAX_BATCH_SIZE:
+        return HttpResponse("Bad request: at most {} resources may be "
+            "requested at once.".format(MAX_BATCH_SIZE), status=400)
+
+    def entries_generator():
+        missing = set(identifiers)
+        for storage_object in StorageObject.objects \
+                .filter(identifier__in=identifiers) \
+                .filter(Q(copy_status=MASTER) | Q(copy_status=PROXY)) \
+                .exclude(publication_status=INTERNAL) \
+                .exclude(digest_checksum__isnull=True):
+            # the digest checksum is computed from exactly these serializations
+            yield ('{}/metadata.xml'.format(storage_object.identifier),
+                   unicode(storage_object.metadata).encode('utf-8'))
+            yield ('{}/storage-global.json'.format(storage_object.identifier),
+                   unicode(storage_object.global_storage).encode('utf-8'))
+            missing.discard(storage_object.identifier)
+        yield ('missing.json', json.dumps(sorted(missing)))
+
+    response = HttpResponse(stream_zip(entries_generator()), status=200,
+                            content_type='application/zip')
+    response['Metashare-Version'] = settings.METASHARE_VERSION
+    response['Content-Disposition'] = 'attachment; filename="full-metadata.zip"'
     return response
-    
\ No newline at end of file
@@ -3,6 +3,7 @@ Utility functions for unit tests useful across apps.
 """
 from django.contrib.auth.models import Group, User
 from django.core.management import call_command
+from django.db import connection
 from django.test.client import Client
 from django.test.testcases import TestCase
 from metashare import settings, xml_utils
@@ -11,7 +12,8 @@ from metashare.accounts.admin import EditorGroupManagersAdmin, \
 from metashare.accounts.models import EditorGroupApplication, EditorGroup, \
     EditorGroupManagers, RegistrationRequest, ResetRequest, UserProfile, \
     OrganizationApplication, OrganizationManagers, Organization
-from metashare.recommendations.models import TogetherManager
+from metashare.recommendations.models import TogetherManager, \
+    reset_together_counts
 from metashare.repository import supermodel
 from metashare.repository.management import GROUP_GLOBAL_EDITORS
 from metashare.repository.models import resourceInfoType_model, \
@@ -19,9 +21,12 @@ from metashare.repository.models import resourceInfoType_model, \
     documentInfoType_model, targetResourceInfoType_model, organizationInfoType_model, \
     projectInfoType_model
 from metashare.settings import LOGIN_URL
-from metashare.storage.models import PUBLISHED, MASTER, StorageObject, INTERNAL
+from metashare.storage.models import PUBLISHED, MASTER, StorageObject, INTERNAL, \
+    InventoryChange, IndexUpdate
+from metashare.sync.models import InventoryCursor
 from metashare.xml_utils import import_from_file
 import os
+from metashare.stats import model_utils as stats_model_utils
 from metashare.stats.models import LRStats, UsageStats, QueryStats
 
 
@@ -43,6 +48,11 @@ def clean_resources_db():
     # delete storage objects
     for sto in StorageObject.objects.all():
         sto.delete()
+    # delete the synchronization state
+    InventoryChange.objects.all().delete()
+    InventoryCursor.objects.all().delete()
+    # delete the pending search index updates
+    IndexUpdate.objects.all().delete()
     # delete all reusable entities
     for ait in actorInfoType_model.objects.all():
         ait.delete()
@@ -61,8 +71,13 @@ def clean_resources_db():
     # delete recommendation objects
     for tgm in TogetherManager.objects.all():
         tgm.delete()
+    reset_together_counts()
     # delete object cache used for duplicate recognition in import
-    supermodel.OBJECT_XML_CACHE = {}
+    supermodel.OBJECT_XML_CACHE.clear()
+    # drop the pending statistics events of the deleted resources so that they
+    # are not written by a timer thread later on
+    # pylint: disable-msg=W0212
+    stats_model_utils._take_pending_lr_stats()
 
 def clean_user_db():
     """
@@ -95,6 +110,10 @@ def clean_storage():
     # to sure, check that we only delete it if its the test storage path
     if settings.STORAGE_PATH == TEST_STORAGE_PATH:
         for _folder in os.listdir(settings.STORAGE_PATH):
+            if os.path.isfile(os.path.join(settings.STORAGE_PATH, _folder)):
+                # e.g., the synchronization inventory snapshot
+                os.remove(os.path.join(settings.STORAGE_PATH, _folder))
+                continue
             for _file in os.listdir(os.path.join(settings.STORAGE_PATH, _folder)):
                 os.remove(os.path.join(settings.STORAGE_PATH, _folder, _file))
             os.rmdir(os.path.join(settings.STORAGE_PATH, _folder))
@@ -125,6 +144,20 @@ def import_xml_or_zip(filename, copy_status=MASTER):
     _xml = open(filename, 'rb')
     return import_from_file(_xml, filename, PUBLISHED, copy_status)
 
+def count_queries(func, *args):
+    """
+    Returns the number of database queries which are issued when calling the
+    given function with the given arguments.
+    """
+    _debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    try:
+        _start = len(connection.queries)
+        func(*args)
+        return len(connection.queries) - _start
+    finally:
+        connection.use_debug_cursor = _debug_cursor
+
 def set_index_active(is_active):
     """
     A helper allowing tests to disable the index if it is not needed,
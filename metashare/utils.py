@@ -6,7 +6,10 @@ import logging
 import os
 import re
 import sys
+from collections import OrderedDict
 from datetime import tzinfo, timedelta
+from threading import RLock
+from zipfile import ZipFile, ZIP_DEFLATED
 
 from django.conf import settings
 
@@ -116,6 +119,145 @@ class Lock():
             self.handle.close()
 
 
+class LRUCache(object):
+    """
+    A dictionary-like cache for string values which holds at most `max_size`
+    bytes; once this limit is exceeded, the least recently used entries are
+    evicted first.
+    
+    The numbers of cache hits, misses and evictions are counted and can be
+    retrieved with `get_stats()`.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for the given key or the given default value.
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # re-insert the entry to mark it as the most recently used one
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                raise KeyError(key)
+            return self.get(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self.pop(key)
+            if len(value) > self.max_size:
+                # values larger than the whole cache are not cached at all
+                return
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                _unused, _evicted = self._entries.popitem(last=False)
+                self.size -= len(_evicted)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def has_key(self, key):
+        """
+        Returns whether a value is cached for the given key.
+        """
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def pop(self, key, default=None):
+        """
+        Removes the given key from the cache and returns its value or the
+        given default value if the key was not cached.
+        """
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                return default
+            self.size -= len(value)
+            return value
+
+    def clear(self):
+        """
+        Removes all entries from the cache; the statistics are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        """
+        Returns a dictionary with the current usage statistics of this cache.
+        """
+        return {'entries': len(self._entries), 'size': self.size,
+                'max_size': self.max_size, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+class _ZipStreamBuffer(object):
+    """
+    A minimal write-only file-like object which collects the data written by a
+    `ZipFile` until it is taken out again with `pop()`.
+    """
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._offset += len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """
+        Returns and removes all data which has been written so far.
+        """
+        data = ''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(entries, compression=ZIP_DEFLATED):
+    """
+    Generator which yields the binary content of a zip archive piece by piece.
+    
+    `entries` is an iterable of pairs of archive names and (byte) strings; each
+    entry is yielded as soon as it has been compressed so that the archive never
+    needs to be kept in memory as a whole.
+    """
+    _buffer = _ZipStreamBuffer()
+    _zip = ZipFile(_buffer, 'w', compression)
+    for _name, _data in entries:
+        _zip.writestr(_name, _data)
+        yield _buffer.pop()
+    _zip.close()
+    yield _buffer.pop()
+
+
 class SimpleTimezone(tzinfo):
     """
     A fixed offset timezone with an unknown name and an unknown DST adjustment.
@@ -7,10 +7,12 @@ import logging
 import os
 import re
 import sys
+import time
 from subprocess import call, STDOUT
 from zipfile import is_zipfile, ZipFile
 
 from django import db
+from django.db import transaction
 from django.contrib.admin.models import LogEntry, ADDITION
 from django.contrib.contenttypes.models import ContentType
 from django.utils.encoding import force_unicode
@@ -33,6 +35,10 @@ XML_DECL = re.compile(r'\s*<\?xml version=".+" encoding=".+"\?>\s*\n?',
 XML_DECL_2 = re.compile(r"\s*<\?xml version='.+' encoding='.+'\?>\s*\n?",
   re.I|re.S|re.U)
 
+# number of records whose database entries are created in a single transaction
+# by bulk_import_from_file()
+BULK_IMPORT_BATCH_SIZE = 100
+
 def xml_compare(file1, file2, outfile=None):
     """
     Compare two XML files with the external program xdiff.
@@ -75,8 +81,23 @@ def import_from_string(xml_string, targetstatus, copy_status, owner_id=None):
     
     Returns the imported resource object on success, raises and Exception on failure.
     """
+    resource = _create_resource(ElementTree.fromstring(xml_string),
+                                targetstatus, copy_status, owner_id)
+    _finish_resource_import(resource, owner_id)
+    return resource
+
+
+def _create_resource(element_tree, targetstatus, copy_status, owner_id=None):
+    """
+    Creates the database entries of a single resource from its XML tree and
+    saves it with the given target status.
+
+    Returns the created resource object on success, raises and Exception on
+    failure.
+    """
     from metashare.repository.models import resourceInfoType_model
-    result = resourceInfoType_model.import_from_string(xml_string, copy_status=copy_status)
+    result = resourceInfoType_model.import_from_elementtree(element_tree,
+                                                            copy_status=copy_status)
     
     if not result[0]:
         msg = u''
@@ -101,6 +122,14 @@ def import_from_string(xml_string, targetstatus, copy_status, owner_id=None):
     else:
         resource.storage_object.save()
 
+    return resource
+
+
+def _finish_resource_import(resource, owner_id=None):
+    """
+    Serializes the given newly imported resource to the storage folder and
+    records the import in the admin log and in the statistics.
+    """
     # explicitly write metadata XML and storage object to the storage folder
     resource.storage_object.update_storage()
 
@@ -116,8 +145,6 @@ def import_from_string(xml_string, targetstatus, copy_status, owner_id=None):
 
     # Update statistics
     saveLRStats(resource, UPDATE_STAT)
-
-    return resource
     
     
 def import_from_file(filehandle, descriptor, targetstatus, copy_status, owner_id=None):
@@ -181,6 +208,130 @@ def import_from_file(filehandle, descriptor, targetstatus, copy_status, owner_id
     return imported_resources, erroneous_descriptors
 
 
+def _read_xml_record(zip_file, xml_name):
+    """
+    Reads and parses the XML record with the given name from the given opened
+    zip archive.
+
+    Returns a pair of the parsed XML tree (or None) and an exception (or None
+    on success).
+    """
+    try:
+        return ElementTree.fromstring(zip_file.read(xml_name)), None
+    # pylint: disable-msg=W0703
+    except Exception as problem:
+        return None, problem
+
+
+def bulk_import_from_file(filehandle, descriptor, targetstatus, copy_status,
+                          owner_id=None, batch_size=BULK_IMPORT_BATCH_SIZE):
+    """
+    Import the xml metadata records contained in the opened file identified by
+    filehandle like `import_from_file()`, but optimized for large archives.
+
+    The database entries of `batch_size` records at a time are created in a
+    single transaction; only the records of the current batch are parsed and
+    kept in memory. Serializing the resources to the storage folder, the admin
+    log and the statistics are deferred to a final phase.
+
+    Returns a pair of lists, the first list containing the successfully
+    imported resource objects, the second containing pairs of descriptors of
+    the erroneous XML file(s) and error messages.
+    """
+    if not is_zipfile(filehandle):
+        filehandle.seek(0)
+        return import_from_file(filehandle, descriptor, targetstatus,
+                                copy_status, owner_id)
+    filehandle.seek(0)
+
+    imported_resources = []
+    erroneous_descriptors = []
+    _start = time.time()
+    temp_zip = ZipFile(filehandle)
+    _names = [name for name in temp_zip.namelist()
+              if not (name.endswith('/') or name.endswith('\\'))]
+    LOGGER.info('Bulk importing {0} XML files from ZIP file "{1}"'.format(
+        len(_names), descriptor))
+
+    # phase 1: parse the records and create the database entries in batched
+    # transactions
+    for i in range(0, len(_names), batch_size):
+        _created = []
+        try:
+            with transaction.commit_on_success():
+                for xml_name in _names[i:i + batch_size]:
+                    element_tree, problem = \
+                        _read_xml_record(temp_zip, xml_name)
+                    if problem is None:
+                        _sid = transaction.savepoint()
+                        try:
+                            _created.append((xml_name, _create_resource(
+                              element_tree, targetstatus, copy_status,
+                              owner_id)))
+                            transaction.savepoint_commit(_sid)
+                        # pylint: disable-msg=W0703
+                        except Exception as _problem:
+                            transaction.savepoint_rollback(_sid)
+                            problem = _problem
+                    if problem is not None:
+                        LOGGER.warn('Caught an exception while importing %s '
+                            'from %s: %s', xml_name, descriptor, problem)
+                        erroneous_descriptors.append((xml_name, problem))
+        except db.utils.DatabaseError as problem:
+            # the whole batch has been rolled back
+            LOGGER.warn('Caught an exception while importing a batch of '
+                        'records from %s:', descriptor, exc_info=True)
+            # reset database connection (required for PostgreSQL)
+            db.close_connection()
+            erroneous_descriptors.extend(
+                (xml_name, problem) for xml_name, _resource in _created)
+            _created = []
+        imported_resources.extend(_resource for _name, _resource in _created)
+        LOGGER.info('Created {0} of {1} resources ({2:.1f} records/s).' \
+            .format(len(imported_resources), len(_names),
+                    (len(imported_resources) + len(erroneous_descriptors))
+                    / max(time.time() - _start, 0.001)))
+
+    # phase 2: serialize the resources to the storage folder and update the
+    # admin log and the statistics
+    successful_resources = []
+    for i in range(0, len(imported_resources), batch_size):
+        _finished = []
+        try:
+            with transaction.commit_on_success():
+                for resource in imported_resources[i:i + batch_size]:
+                    _sid = transaction.savepoint()
+                    try:
+                        _finish_resource_import(resource, owner_id)
+                        transaction.savepoint_commit(_sid)
+                        _finished.append(resource)
+                    # pylint: disable-msg=W0703
+                    except Exception as problem:
+                        LOGGER.warn('Caught an exception while storing %s:',
+                            resource, exc_info=True)
+                        erroneous_descriptors.append((resource \
+                            .storage_object.identifier, problem))
+                        transaction.savepoint_rollback(_sid)
+        except db.utils.DatabaseError as problem:
+            # the whole batch has been rolled back
+            LOGGER.warn('Caught an exception while storing a batch of '
+                        'resources:', exc_info=True)
+            # reset database connection (required for PostgreSQL)
+            db.close_connection()
+            erroneous_descriptors.extend(
+                (resource.storage_object.identifier, problem)
+                for resource in _finished)
+            _finished = []
+        successful_resources.extend(_finished)
+
+    _duration = max(time.time() - _start, 0.001)
+    LOGGER.info('Bulk imported {0} resources from "{1}" in {2:.1f}s ' \
+        '({3:.1f} records/s), errors occurred in {4} cases.'.format(
+        len(successful_resources), descriptor, _duration,
+        len(_names) / _duration, len(erroneous_descriptors)))
+    return successful_resources, erroneous_descriptors
+
+
 def to_xml_string(node, encoding="ASCII"):
     """
     Serialize the given XML node as Unicode string using the given encoding.
@@ -196,6 +347,23 @@ def to_xml_string(node, encoding="ASCII"):
     return u'<?xml version="1.0" encoding="{}"?>{}'.format(encoding, xml_string)
 
 
+
+def get_resource_xml(resource):
+    """
+    Returns the metadata XML of the given resource as a UTF-8 encoded string.
+    
+    For ingested and published resources, the serialization which is kept
+    up-to-date in the storage object is reused (see
+    `StorageObject.update_storage()`); internal resources are serialized anew.
+    """
+    from metashare.storage.models import INGESTED, PUBLISHED
+    _storage_object = resource.storage_object
+    if _storage_object.publication_status in (INGESTED, PUBLISHED) \
+            and _storage_object.metadata:
+        return unicode(_storage_object.metadata).encode('utf-8')
+    return to_xml_string(resource.export_to_elementtree(),
+                         encoding="utf-8").encode('utf-8')
+
 html_escape_table = {
     "&": "&amp;",
     '"': "&quot;",